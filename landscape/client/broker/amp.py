@@ -1,7 +1,10 @@
-from twisted.internet.defer import maybeDeferred, execute, succeed
-from twisted.python.compat import iteritems
+from itertools import groupby
 
-from landscape.lib.amp import RemoteObject, MethodCallArgument
+from twisted.internet.defer import Deferred, maybeDeferred, execute, succeed
+from twisted.python.compat import iteritems, unicode
+
+from landscape.lib.amp import (
+    RemoteObject, MethodCallArgument, MethodCallError)
 from landscape.client.amp import ComponentConnector, get_remote_methods
 from landscape.client.broker.server import BrokerServer
 from landscape.client.broker.client import BrokerClient
@@ -10,9 +13,124 @@ from landscape.client.manager.manager import Manager
 
 
 class RemoteBroker(RemoteObject):
+    """A L{RemoteObject} for the L{BrokerServer}.
+
+    Broker clients, which are told when the acceptance of message types
+    changes, can keep a local cache of the accepted types with
+    L{cache_accepted_types}, so that L{call_if_accepted} doesn't need a
+    round trip to the broker. They can also send the messages of their
+    plugins in batches, see L{batch_messages}.
+    """
+
+    _accepted_types = None
+    _acceptance_changes = None
+    _send_queue = None
+
+    def _call_remote(self, method, *args, **kwargs):
+        """Call a remote method, even if it's shadowed by a local one."""
+        deferred = Deferred()
+        self._send_method_call(method, args, kwargs, deferred)
+        return deferred
+
+    def batch_messages(self):
+        """Batch the messages sent during a reactor iteration.
+
+        From now on, L{send_message} queues messages, and the ones queued
+        during a reactor iteration are sent together at the end of it, with
+        a single C{send_messages} call. Brokers older than their clients may
+        not know about C{send_messages}, so only clients started along with
+        the broker should do this.
+        """
+        self._send_queue = []
+
+    def send_message(self, message, session_id, urgent=False):
+        """Queue C{message} for delivery to the server at the next exchange.
+
+        @see: L{BrokerServer.send_message}.
+        @return: A L{Deferred} firing with the message identifier.
+        """
+        if self._send_queue is None:
+            return self._call_remote("send_message", message, session_id,
+                                     urgent=urgent)
+        if not self._send_queue:
+            self._factory.clock.callLater(0, self._flush_messages)
+        deferred = Deferred()
+        self._send_queue.append((message, session_id, urgent, deferred))
+        return deferred
+
+    def _flush_messages(self):
+        """Send the queued messages.
+
+        Consecutive messages with the same session ID and urgency are sent
+        with a single call, so that their order is kept.
+        """
+        queue = self._send_queue
+        self._send_queue = []
+        for (session_id, urgent), items in groupby(
+                queue, lambda item: item[1:3]):
+            items = list(items)
+            deferreds = [item[3] for item in items]
+            result = self._call_remote(
+                "send_messages", [item[0] for item in items], session_id,
+                urgent=urgent)
+            result.addCallbacks(self._sent_messages, self._failed_messages,
+                                callbackArgs=(deferreds,),
+                                errbackArgs=(deferreds,))
+
+    def _sent_messages(self, results, deferreds):
+        for deferred, result in zip(deferreds, results):
+            if isinstance(result, unicode):
+                deferred.errback(MethodCallError(result))
+            else:
+                deferred.callback(result)
+
+    def _failed_messages(self, failure, deferreds):
+        for deferred in deferreds:
+            deferred.errback(failure)
+
+    def cache_accepted_types(self):
+        """Fetch the accepted message types, and keep them in the cache.
+
+        The cache must then be kept up to date with
+        L{set_message_type_acceptance}.
+
+        @return: A L{Deferred} firing once the cache is filled.
+        """
+        # Changes made while the types are being fetched may come before the
+        # reply, so they're recorded and applied on top of it.
+        self._acceptance_changes = {}
+
+        def got_accepted_types(types):
+            accepted_types = set(types)
+            for type, accepted in iteritems(self._acceptance_changes):
+                if accepted:
+                    accepted_types.add(type)
+                else:
+                    accepted_types.discard(type)
+            self._accepted_types = accepted_types
+            self._acceptance_changes = None
+
+        result = self.get_accepted_message_types()
+        return result.addCallback(got_accepted_types)
+
+    def set_message_type_acceptance(self, type, accepted):
+        """Update the cache after the acceptance of C{type} changed."""
+        if self._acceptance_changes is not None:
+            self._acceptance_changes[type] = accepted
+        elif self._accepted_types is None:
+            return
+        elif accepted:
+            self._accepted_types.add(type)
+        else:
+            self._accepted_types.discard(type)
 
     def call_if_accepted(self, type, callable, *args):
         """Call C{callable} if C{type} is an accepted message type."""
+        if self._accepted_types is not None:
+            if type in self._accepted_types:
+                return maybeDeferred(callable, *args)
+            return succeed(None)
+
         deferred_types = self.get_accepted_message_types()
 
         def got_accepted_types(result):
@@ -62,6 +180,12 @@ class FakeRemoteBroker(object):
         else:
             raise AttributeError(name)
 
+    def cache_accepted_types(self):
+        return succeed(None)
+
+    def set_message_type_acceptance(self, type, accepted):
+        pass
+
     def call_if_accepted(self, type, callable, *args):
         if type in self.message_store.get_accepted_types():
             return maybeDeferred(callable, *args)
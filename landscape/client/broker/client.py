@@ -256,6 +256,7 @@ class BrokerClient(object):
         if event_type == "message-type-acceptance-changed":
             message_type = args[0]
             acceptance = args[1]
+            self.broker.set_message_type_acceptance(message_type, acceptance)
             results = self.reactor.fire((event_type, message_type), acceptance)
         else:
             results = self.reactor.fire(event_type, *args, **kwargs)
@@ -272,10 +273,14 @@ class BrokerClient(object):
 
           - Re-register ourselves as client, so the broker knows we exist and
             will talk to us firing events and dispatching messages.
+
+          - Refresh the cache of the accepted message types, since changes
+            may have been missed while disconnected.
         """
         for type in self._registered_messages:
             self.broker.register_client_accepted_message_type(type)
         self.broker.register_client(self.name)
+        self.broker.cache_accepted_types()
 
     @remote
     def exit(self):
@@ -1,8 +1,13 @@
 """Configuration class for the broker."""
 
 import os
+import sys
 
 from landscape.client.deployment import Configuration
+from landscape.client.broker.merging import get_mergers
+from landscape.client.broker.storage import (
+    FILES, SQLITE, COMPRESSIONS, NO_COMPRESSION)
+from landscape.client.broker.transport import CURL, HTTP_TRANSPORTS
 
 
 class BrokerConfiguration(Configuration):
@@ -32,6 +37,12 @@ class BrokerConfiguration(Configuration):
               - C{urgent_exchange_interval} (C{1*60})
               - C{http_proxy}
               - C{https_proxy}
+              - C{message_store_engine} (C{"files"})
+              - C{message_store_compression} (C{"none"})
+              - C{message_store_max_size} (C{0})
+              - C{merge_message_types} (C{""})
+              - C{max_payload_size} (C{10240})
+              - C{http_transport} (C{"curl"})
         """
         parser = super(BrokerConfiguration, self).make_parser()
 
@@ -62,14 +73,60 @@ class BrokerConfiguration(Configuration):
         parser.add_option("--tags",
                           help="Comma separated list of tag names to be sent "
                                "to the server.")
+        parser.add_option("--message-store-engine", default=FILES,
+                          choices=[FILES, SQLITE], metavar="ENGINE",
+                          help="The storage engine used to queue messages "
+                               "for the server, either 'files' or 'sqlite'. "
+                               "Messages are migrated automatically when "
+                               "the engine changes.")
+        parser.add_option("--message-store-compression",
+                          default=NO_COMPRESSION, choices=COMPRESSIONS,
+                          metavar="METHOD",
+                          help="The method used to compress queued messages, "
+                               "one of %s." % ", ".join(COMPRESSIONS))
+        parser.add_option("--message-store-max-size", default=0, type="int",
+                          metavar="MEGABYTES",
+                          help="The maximum size of queued messages, in "
+                               "megabytes. Low priority messages are "
+                               "evicted when it's exceeded. The default, 0, "
+                               "means no limit.")
+        parser.add_option("--merge-message-types", default="",
+                          metavar="TYPES",
+                          help="Comma separated list of time series message "
+                               "types whose pending messages are merged "
+                               "together, or 'ALL'.")
+        parser.add_option("--max-payload-size", default=10 * 1024,
+                          type="int", metavar="KILOBYTES",
+                          help="The maximum size of the messages sent in a "
+                               "single exchange, in kilobytes. Smaller "
+                               "payloads are sent over slow links.")
+        parser.add_option("--http-transport", default=CURL,
+                          choices=HTTP_TRANSPORTS, metavar="TRANSPORT",
+                          help="The HTTP client used to exchange messages "
+                               "with the server, either 'curl', run in a "
+                               "thread, or 'twisted', which doesn't block "
+                               "a thread but ignores the proxy settings.")
 
         return parser
 
+    @property
+    def merged_message_types(self):
+        """Get the list of message types to merge while pending."""
+        if self.merge_message_types == "ALL":
+            return ["ALL"]
+        return [x.strip() for x in self.merge_message_types.split(",")
+                if x.strip()]
+
     @property
     def message_store_path(self):
         """Get the path to the message store."""
         return os.path.join(self.data_path, "messages")
 
+    @property
+    def message_store_database_path(self):
+        """Get the path to the message store database."""
+        return os.path.join(self.data_path, "messages.database")
+
     def load(self, args):
         """
         Load options from command line arguments and a config file.
@@ -77,8 +134,15 @@ class BrokerConfiguration(Configuration):
         Load the configuration with L{Configuration.load}, and then set
         C{http_proxy} and C{https_proxy} environment variables based on
         that config data.
+
+        @raise: A SystemExit if message types that can't be merged are
+            configured to be merged.
         """
         super(BrokerConfiguration, self).load(args)
+        try:
+            get_mergers(self.merged_message_types)
+        except ValueError as error:
+            sys.exit("error: bad merge_message_types setting: %s" % error)
         if self.http_proxy:
             os.environ["http_proxy"] = self.http_proxy
         elif self._original_http_proxy:
@@ -82,6 +82,7 @@ Additionally, payloads to registered clients will include these fields::
   {'next-expected-sequence': EXPECTED_SEQUENCE_NUMBER,
    'next-expected-token': EXPECTED_EXCHANGE_TOKEN,
    'client-accepted-types-hash': CLIENT_ACCEPTED_TYPES_DIGEST,
+   'accepted-content-encodings': CONTENT_ENCODINGS (optional)}
 
 where:
 
@@ -100,6 +101,11 @@ where:
     to know whether to send to the server an up-to-date list the message types
     it now accepts (see CLIENT_ACCEPTED_TYPES in the client->server payload).
 
+  - C{CONTENT_ENCODINGS}: Optionally, a list of the encodings the server
+    accepts for the body of the following exchange requests. Only C{gzip} is
+    used by the client, which compresses the payloads it sends as long as the
+    server keeps advertising it (see L{landscape.broker.transport}).
+
 Individual Messages
 ===================
 
@@ -349,14 +355,61 @@ from landscape.lib.hashlib import md5
 from twisted.internet.defer import Deferred, succeed
 from twisted.python.compat import _PY3
 
+from landscape.lib import bpickle
+from landscape.lib.backoff import Backoff
 from landscape.lib.fetch import HTTPCodeError, PyCurlError
 from landscape.lib.format import format_delta
 from landscape.lib.message import got_next_expected, ANCIENT
 from landscape.lib.versioning import is_version_higher, sort_versions
+from landscape.client.broker.timing import ExchangeTimings, PAYLOAD, DISPATCH
 
 from landscape import DEFAULT_SERVER_API, SERVER_API, CLIENT_API
 
 
+class PayloadBudget(object):
+    """The number of bytes of messages to send in the next exchange.
+
+    The budget adapts to how long exchanges take, which depends on both the
+    upload throughput and the time the server takes to process messages: it
+    shrinks when exchanges take longer than C{target_duration} or fail, so
+    that exchanges over slow links don't time out, and grows when full
+    payloads are exchanged quickly, so that backlogs drain sooner on fast
+    links.
+
+    @param maximum: The maximum budget, in bytes.
+    @param minimum: The minimum budget, in bytes.
+    @param target_duration: The number of seconds an exchange should take.
+    """
+
+    def __init__(self, maximum, minimum=64 * 1024, target_duration=60):
+        self.maximum = maximum
+        self.minimum = min(minimum, maximum)
+        self.target_duration = target_duration
+        self.bytes = max(self.minimum, maximum // 10)
+
+    def record_success(self, size, duration):
+        """Adapt the budget to a successful exchange.
+
+        @param size: The size of the messages sent in the exchange.
+        @param duration: The number of seconds the exchange took.
+        """
+        if duration > self.target_duration:
+            # Aim for the throughput observed in this exchange.
+            self.bytes = size * self.target_duration // duration
+        elif duration < self.target_duration / 2 and size >= self.bytes / 2:
+            self.bytes *= 2
+        self.bytes = int(max(self.minimum, min(self.maximum, self.bytes)))
+
+    def record_failure(self):
+        """Adapt the budget to a failed exchange."""
+        self.bytes = max(self.minimum, self.bytes // 2)
+
+
+# The backlog of pending messages, in number of batches, from which the
+# exchanger starts draining it with back-to-back exchanges.
+DRAIN_BACKLOG_BATCHES = 5
+
+
 class MessageExchange(object):
     """Schedule and handle message exchanges with the server.
 
@@ -376,7 +429,9 @@ class MessageExchange(object):
     _api = SERVER_API
 
     def __init__(self, reactor, store, transport, registration_info,
-                 exchange_store, config, max_messages=100):
+                 exchange_store, config, max_messages=100,
+                 drain_duration=600, drain_size=100 * 1024 * 1024,
+                 max_backoff=4 * 60 * 60, timings_log_interval=60 * 60):
         """
         @param reactor: The L{LandscapeReactor} used to fire events in response
             to messages received by the server.
@@ -387,7 +442,20 @@ class MessageExchange(object):
             and `urgent_exchange_interval` parameters, respectively holding
             the time interval between subsequent exchanges of non-urgent
             messages, and the time interval between subsequent exchanges
-            of urgent messages.
+            of urgent messages, and the `max_payload_size` parameter,
+            holding the maximum size of the messages sent in an exchange,
+            in kilobytes.
+        @param max_messages: The maximum number of messages sent in an
+            exchange.
+        @param drain_duration: The maximum number of seconds spent
+            draining a large backlog of pending messages with back-to-back
+            exchanges, before going back to the urgent exchange interval.
+        @param drain_size: The maximum size of the messages sent while
+            draining a backlog, in bytes.
+        @param max_backoff: The maximum number of seconds between exchanges
+            after consecutive failures.
+        @param timings_log_interval: The number of seconds between log lines
+            summarizing how long the phases of exchanges take.
         """
         self._reactor = reactor
         self._message_store = store
@@ -397,6 +465,15 @@ class MessageExchange(object):
         self._exchange_interval = config.exchange_interval
         self._urgent_exchange_interval = config.urgent_exchange_interval
         self._max_messages = max_messages
+        self._payload_budget = PayloadBudget(config.max_payload_size * 1024)
+        self._drain_duration = drain_duration
+        self._drain_size = drain_size
+        self._drain_deadline = None
+        self._drain_bytes_left = 0
+        self._backoff = Backoff(max_backoff)
+        self._timings = ExchangeTimings()
+        self._timings_log_interval = timings_log_interval
+        self._timings_log_id = None
         self._notification_id = None
         self._exchange_id = None
         self._exchanging = False
@@ -461,6 +538,8 @@ class MessageExchange(object):
     def start(self):
         """Start scheduling exchanges. The first one will be urgent."""
         self.schedule_exchange(urgent=True)
+        self._timings_log_id = self._reactor.call_every(
+            self._timings_log_interval, self._log_timings)
 
     def stop(self):
         """Stop scheduling exchanges."""
@@ -472,6 +551,9 @@ class MessageExchange(object):
             # Cancel the next scheduled notification of an impending exchange
             self._reactor.cancel_call(self._notification_id)
             self._notification_id = None
+        if self._timings_log_id is not None:
+            self._reactor.cancel_call(self._timings_log_id)
+            self._timings_log_id = None
         self._stopped = True
 
     def _handle_accepted_types(self, message):
@@ -540,7 +622,9 @@ class MessageExchange(object):
 
         self._reactor.fire("pre-exchange")
 
+        start_time = time.time()
         payload = self._make_payload()
+        payload_time = time.time() - start_time
 
         start_time = time.time()
         if self._urgent_exchange:
@@ -552,6 +636,13 @@ class MessageExchange(object):
 
         deferred = Deferred()
 
+        def record_timings(dispatch_time=None):
+            timings = dict(self._transport.timings)
+            timings[PAYLOAD] = payload_time
+            if dispatch_time is not None:
+                timings[DISPATCH] = dispatch_time
+            self._timings.record(timings)
+
         def exchange_completed():
             self.schedule_exchange(force=True)
             self._reactor.fire("exchange-done")
@@ -562,12 +653,23 @@ class MessageExchange(object):
         def handle_result(result):
             self._exchanging = False
             if result:
+                self._payload_budget.record_success(
+                    self._get_messages_size(payload["messages"]),
+                    time.time() - start_time)
                 if self._urgent_exchange:
                     logging.info("Switching to normal exchange mode.")
                     self._urgent_exchange = False
+                self._backoff.succeeded()
+                dispatch_start_time = time.time()
                 self._handle_result(payload, result)
+                record_timings(time.time() - dispatch_start_time)
                 self._message_store.record_success(int(self._reactor.time()))
             else:
+                record_timings()
+                self._payload_budget.record_failure()
+                self._stop_draining()
+                self._back_off()
+                self._message_store.record_failure(int(self._reactor.time()))
                 self._reactor.fire("exchange-failed")
                 logging.info("Message exchange failed.")
             exchange_completed()
@@ -596,22 +698,86 @@ class MessageExchange(object):
 
             self._reactor.fire("exchange-failed", ssl_error=ssl_error)
 
+            record_timings()
+            self._payload_budget.record_failure()
+            self._stop_draining()
+            self._back_off()
             self._message_store.record_failure(int(self._reactor.time()))
             logging.info("Message exchange failed.")
             exchange_completed()
 
-        self._reactor.call_in_thread(handle_result, handle_failure,
-                                     self._transport.exchange, payload,
-                                     self._registration_info.secure_id,
-                                     self._get_exchange_token(),
-                                     payload.get("server-api"))
+        self._call_transport(handle_result, handle_failure, payload,
+                             self._registration_info.secure_id,
+                             self._get_exchange_token(),
+                             payload.get("server-api"))
         return deferred
 
+    def _call_transport(self, callback, errback, *args):
+        """Call the exchange method of the transport with the given args.
+
+        Asynchronous transports return a L{Deferred}, while the others block
+        and are run in a thread. Either way, C{callback} is called with the
+        result in the main thread, and C{errback} with a C{(type, value,
+        traceback)} tuple describing the error.
+        """
+        if not self._transport.asynchronous:
+            self._reactor.call_in_thread(callback, errback,
+                                         self._transport.exchange, *args)
+            return
+
+        def got_failure(failure):
+            errback(failure.type, failure.value, failure.tb)
+
+        result = self._transport.exchange(*args)
+        result.addCallbacks(callback, got_failure)
+
     def is_urgent(self):
         """Return a bool showing whether there is an urgent exchange scheduled.
         """
         return self._urgent_exchange
 
+    def get_timings(self):
+        """
+        Return a C{dict} summarizing how long the phases of the recent
+        exchanges took, see L{ExchangeTimings.get_summary}.
+        """
+        return self._timings.get_summary()
+
+    def _log_timings(self):
+        """Log how long the phases of the recent exchanges took."""
+        if self._timings.get_summary():
+            logging.info("Exchange phase timings (median/90th percentile): "
+                         "%s.", self._timings.format())
+
+    def get_backoff_state(self):
+        """
+        Return a C{dict} with the number of consecutive failed exchanges, and
+        the current delay between exchanges, or C{None} if they aren't being
+        delayed.
+        """
+        return self._backoff.get_state()
+
+    def _back_off(self):
+        """Delay the next exchanges after a failed one."""
+        delay = self._backoff.failed(self._get_interval())
+        logging.info("Backing off for %s after %d failed exchanges.",
+                     format_delta(delay), self._backoff.failures)
+
+    def _get_interval(self):
+        """Return the interval before the next exchange, without backoff."""
+        if self.is_draining():
+            return 0
+        if self._urgent_exchange:
+            return self._config.urgent_exchange_interval
+        return self._config.exchange_interval
+
+    def is_draining(self):
+        """
+        Return a bool showing whether a backlog of pending messages is being
+        drained with back-to-back exchanges.
+        """
+        return self._drain_deadline is not None
+
     def schedule_exchange(self, urgent=False, force=False):
         """Schedule an exchange to happen.
 
@@ -638,16 +804,18 @@ class MessageExchange(object):
             if self._exchange_id:
                 self._reactor.cancel_call(self._exchange_id)
 
-            if self._urgent_exchange:
-                interval = self._config.urgent_exchange_interval
-            else:
-                interval = self._config.exchange_interval
+            # Exchanges are delayed after failures, even urgent ones, so that
+            # a fleet of clients doesn't hit a server coming back from an
+            # outage all at once.
+            interval = self._backoff.get_interval(self._get_interval())
 
             if self._notification_id is not None:
                 self._reactor.cancel_call(self._notification_id)
-            notification_interval = interval - 10
-            self._notification_id = self._reactor.call_later(
-                notification_interval, self._notify_impending_exchange)
+                self._notification_id = None
+            if interval > 0:
+                notification_interval = interval - 10
+                self._notification_id = self._reactor.call_later(
+                    notification_interval, self._notify_impending_exchange)
 
             self._exchange_id = self._reactor.call_later(
                 interval, self.exchange)
@@ -680,11 +848,14 @@ class MessageExchange(object):
 
         The payload will contain all pending messages eligible for
         delivery, up to a maximum of C{max_messages} as passed to
-        the L{__init__} method.
+        the L{__init__} method, and up to the current payload budget in
+        bytes.
         """
         store = self._message_store
         accepted_types_digest = self._hash_types(store.get_accepted_types())
-        messages = store.get_pending_messages(self._max_messages)
+        messages = store.get_pending_stored_messages(
+            self._max_messages, max_bytes=self._payload_budget.bytes,
+            in_flight=True)
         total_messages = store.count_pending_messages()
         if messages:
             # Each message is tagged with the API that the client was
@@ -715,6 +886,16 @@ class MessageExchange(object):
             payload["client-accepted-types"] = accepted_client_types
         return payload
 
+    def _get_messages_size(self, messages):
+        """Return the serialized size of the given payload messages."""
+        size = 0
+        for message in messages:
+            data = getattr(message, "data", None)
+            if data is None:
+                data = bpickle.dumps(message)
+            size += len(data)
+        return size
+
     def _hash_types(self, types):
         accepted_types_str = ";".join(types).encode("ascii")
         return md5(accepted_types_str).digest()
@@ -813,7 +994,46 @@ class MessageExchange(object):
             # otherwise have more messages even after transferring
             # what we could.
             if next_expected != old_sequence:
+                self._update_draining(payload, next_expected - old_sequence)
                 self.schedule_exchange(urgent=True)
+            else:
+                self._stop_draining()
+        else:
+            self._stop_draining()
+
+    def _update_draining(self, payload, acknowledged):
+        """Decide whether to keep exchanging back-to-back after a result.
+
+        Draining starts when the backlog of pending messages is many times
+        larger than the batch just sent, and goes on while the server keeps
+        acknowledging the messages we send, until the drain duration or size
+        is exhausted.
+
+        @param payload: The payload that was sent to the server.
+        @param acknowledged: The number of messages the server acknowledged.
+        """
+        messages = payload["messages"]
+        if acknowledged <= 0 or not messages:
+            self._stop_draining()
+            return
+        if not self.is_draining():
+            total_messages = payload["total-messages"]
+            if total_messages < len(messages) * DRAIN_BACKLOG_BATCHES:
+                return
+            logging.info("Draining a backlog of %d pending messages.",
+                         total_messages)
+            self._drain_deadline = self._reactor.time() + self._drain_duration
+            self._drain_bytes_left = self._drain_size
+        self._drain_bytes_left -= self._get_messages_size(messages)
+        if (self._drain_bytes_left <= 0 or
+                self._reactor.time() >= self._drain_deadline):
+            self._stop_draining()
+
+    def _stop_draining(self):
+        """Go back to exchanging at the configured intervals."""
+        if self.is_draining():
+            logging.info("Stopped draining the backlog of pending messages.")
+            self._drain_deadline = None
 
     def register_message(self, type, handler):
         """Register a handler for the given message type.
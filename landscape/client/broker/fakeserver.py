@@ -0,0 +1,230 @@
+"""A stand-in for the message system of a Landscape server.
+
+The L{FakeMessageServer} speaks the bpickle message exchange protocol
+described in L{landscape.client.broker.exchange}: it keeps track of the
+sequence numbers of the messages exchanged with each computer, tells them
+which message types it accepts, and can queue messages for them, which
+L{FakeMessageServer.ping} reports as available.
+
+Computers are known by their secure ID, which is the one they exchange
+messages with. Computers sending a C{register} message are given a new
+secure ID and an insecure ID, with a C{set-id} message, and the insecure
+ID is the one they ping the server with.
+
+It can be used in-process in place of a transport, since its C{exchange}
+method has the same signature, or over HTTP with L{get_site}, to benchmark
+the broker without a live server.
+"""
+import uuid
+import zlib
+
+from twisted.python.compat import _PY3, iteritems, unicode
+from twisted.web import resource, server
+
+from landscape import SERVER_API
+from landscape.lib import bpickle
+from landscape.lib.hashlib import md5
+
+
+def hash_types(types):
+    """Return the digest of a list of message types, as sent by clients."""
+    return md5(";".join(types).encode("ascii")).digest()
+
+
+class ComputerState(object):
+    """What the server knows about a computer.
+
+    @ivar messages: The messages received from the computer.
+    @ivar next_expected: The sequence number of the next message expected
+        from the computer.
+    @ivar outgoing: The messages queued for the computer, which weren't
+        acknowledged yet.
+    @ivar outgoing_sequence: The sequence number of the first message in
+        C{outgoing}.
+    @ivar client_accepted_types: The message types the computer accepts.
+    """
+
+    def __init__(self):
+        self.messages = []
+        self.next_expected = 0
+        self.outgoing = []
+        self.outgoing_sequence = 0
+        self.client_accepted_types = []
+
+
+class FakeMessageServer(object):
+    """The message system of a fake Landscape server.
+
+    @param accepted_types: The message types the server accepts.
+    @param server_uuid: The UUID of the server, a random one by default.
+    @param keep_messages: Whether to keep the messages received, which
+        memory-bound load tests may not want.
+    @param url: The URL reported when the server is used in-process as the
+        transport of a L{MessageExchange}.
+    """
+
+    asynchronous = False
+    timings = {}
+
+    def __init__(self, accepted_types=(), server_uuid=None,
+                 keep_messages=True, url="http://localhost/message-system"):
+        self._url = url
+        self.accepted_types = sorted(accepted_types)
+        self.server_uuid = server_uuid or unicode(uuid.uuid4())
+        self.keep_messages = keep_messages
+        self.computers = {}
+        self.insecure_ids = {}
+        self.exchanges = 0
+        self.received = 0
+
+    def get_url(self):
+        return self._url
+
+    def set_url(self, url):
+        self._url = url
+
+    def close(self):
+        pass
+
+    def get_computer(self, computer_id):
+        """Return the L{ComputerState} of a computer, by secure ID."""
+        if computer_id not in self.computers:
+            self.computers[computer_id] = ComputerState()
+        return self.computers[computer_id]
+
+    def queue_message(self, computer_id, message):
+        """
+        Queue a message to be sent at the next exchange of the computer with
+        the given secure ID.
+        """
+        self.get_computer(computer_id).outgoing.append(message)
+
+    def ping(self, insecure_id):
+        """
+        Return whether messages are queued for the computer with the given
+        insecure ID.
+        """
+        computer = self.computers.get(self.insecure_ids.get(insecure_id))
+        return computer is not None and bool(computer.outgoing)
+
+    def register(self, computer_id):
+        """Give new IDs to the computer exchanging with C{computer_id}.
+
+        The state of the computer is moved to its new secure ID, so that
+        the sequence numbers go on once it starts using it.
+
+        @return: The new secure ID and insecure ID of the computer.
+        """
+        secure_id = unicode(uuid.uuid4())
+        insecure_id = len(self.insecure_ids) + 1
+        self.insecure_ids[insecure_id] = secure_id
+        computer = self.get_computer(computer_id)
+        del self.computers[computer_id]
+        self.computers[secure_id] = computer
+        computer.outgoing.append(
+            {"type": "set-id", "id": secure_id, "insecure-id": insecure_id})
+        return secure_id, insecure_id
+
+    def exchange(self, payload, computer_id=None, exchange_token=None,
+                 message_api=SERVER_API):
+        """Handle an exchange request, and return the response.
+
+        The parameters are the ones of L{HTTPTransport.exchange}.
+        """
+        self.exchanges += 1
+        computer = self.get_computer(computer_id)
+        sequence = payload.get("sequence", 0)
+        messages = payload.get("messages", [])
+        # Skip the messages we already got, and ignore the ones following
+        # missing messages: the client will send them again when it sees
+        # which sequence number we expect.
+        if sequence <= computer.next_expected:
+            new_messages = messages[computer.next_expected - sequence:]
+            computer.next_expected += len(new_messages)
+            self.received += len(new_messages)
+            if self.keep_messages:
+                computer.messages.extend(new_messages)
+            if any(message["type"] == "register" for message in new_messages):
+                self.register(computer_id)
+
+        client_accepted_types = payload.get("client-accepted-types")
+        if client_accepted_types is not None:
+            computer.client_accepted_types = sorted(client_accepted_types)
+
+        # The client tells which of our messages it expects next, so the
+        # ones before it were delivered. If it lost track of some, they
+        # can't be sent again, and the numbering restarts from there.
+        delivered = payload.get("next-expected-sequence", 0)
+        del computer.outgoing[:max(0, delivered - computer.outgoing_sequence)]
+        computer.outgoing_sequence = delivered
+
+        accepted_types = {"type": "accepted-types",
+                          "types": self.accepted_types}
+        types_hash = hash_types(self.accepted_types)
+        if (payload.get("accepted-types") != types_hash and
+                accepted_types not in computer.outgoing):
+            computer.outgoing.append(accepted_types)
+
+        return {"server-uuid": self.server_uuid,
+                "server-api": SERVER_API,
+                "messages": list(computer.outgoing),
+                "next-expected-sequence": computer.next_expected,
+                "next-exchange-token": unicode(uuid.uuid4()),
+                "client-accepted-types-hash": hash_types(
+                    computer.client_accepted_types)}
+
+
+class MessageSystemResource(resource.Resource):
+    """Serve exchanges with a L{FakeMessageServer} over HTTP."""
+
+    isLeaf = True
+
+    def __init__(self, message_server):
+        resource.Resource.__init__(self)
+        self.message_server = message_server
+
+    def render_POST(self, request):
+        body = request.content.read()
+        if request.getHeader("content-encoding") == "gzip":
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        computer_id = request.getHeader("x-computer-id")
+        message_api = request.getHeader("x-message-api")
+        if _PY3 and message_api is not None:
+            message_api = message_api.encode("ascii")
+        result = self.message_server.exchange(
+            bpickle.loads(body), computer_id=computer_id,
+            exchange_token=request.getHeader("x-exchange-token"),
+            message_api=message_api)
+        result["accepted-content-encodings"] = ["gzip"]
+        return bpickle.dumps(result)
+
+
+class PingResource(resource.Resource):
+    """Serve pings with a L{FakeMessageServer} over HTTP."""
+
+    isLeaf = True
+
+    def __init__(self, message_server):
+        resource.Resource.__init__(self)
+        self.message_server = message_server
+
+    def render_POST(self, request):
+        args = dict((key, values[0])
+                    for key, values in iteritems(request.args))
+        try:
+            insecure_id = int(args[b"insecure_id"])
+        except (KeyError, ValueError):
+            insecure_id = None
+        return bpickle.dumps(
+            {"messages": self.message_server.ping(insecure_id)})
+
+
+def get_site(message_server):
+    """
+    Return a L{server.Site} serving the given L{FakeMessageServer} at
+    C{/message-system}, and its pings at C{/ping}.
+    """
+    root = resource.Resource()
+    root.putChild(b"message-system", MessageSystemResource(message_server))
+    root.putChild(b"ping", PingResource(message_server))
+    return server.Site(root)
@@ -0,0 +1,143 @@
+"""Merge time series messages of the same type while they're pending.
+
+Monitor plugins like C{CPUUsage} or C{LoadAverage} queue a small message
+holding the samples taken since the previous one, every time the monitor
+exchanges with the broker. When the server can't be reached for a while,
+thousands of them pile up in the message store.
+
+The L{MessageStore} can instead merge the samples of a new message into the
+most recent pending message of the same type, using the I{mergers} defined
+here. A merger is a function taking the pending message and the new one,
+and returning the merged message, or C{None} if they can't be merged, for
+example because the merged message would be too big.
+
+Mergers are also used to supersede pending snapshot messages, like the ones
+sent by C{DataWatcher} plugins, of which only the newest one matters.
+"""
+
+# The maximum number of samples of a series in a merged message.
+MAX_MERGED_ITEMS = 1000
+
+
+def merge_lists(key, max_items=MAX_MERGED_ITEMS):
+    """Return a merger concatenating the lists held by C{key}.
+
+    @param key: The message key holding the list of samples.
+    @param max_items: The maximum number of samples of a merged message.
+    """
+
+    def merge(pending, new):
+        items = pending[key] + new[key]
+        if len(items) > max_items:
+            return None
+        merged = dict(pending)
+        merged[key] = items
+        return merged
+
+    return merge
+
+
+def merge_dicts_of_lists(key, max_items=MAX_MERGED_ITEMS):
+    """
+    Return a merger concatenating the lists of a C{dict} held by C{key},
+    like the per-interface samples of C{network-activity} messages.
+
+    @param key: The message key holding the C{dict} of lists of samples.
+    @param max_items: The maximum number of samples of each list of a
+        merged message.
+    """
+
+    def merge(pending, new):
+        series = dict(pending[key])
+        for name, items in new[key].items():
+            items = series.get(name, []) + items
+            if len(items) > max_items:
+                return None
+            series[name] = items
+        merged = dict(pending)
+        merged[key] = series
+        return merged
+
+    return merge
+
+
+def merge_custom_graphs(max_items=MAX_MERGED_ITEMS):
+    """Return a merger concatenating the values of C{custom-graph} messages.
+
+    The error of each graph is taken from the newest message. Values of
+    graphs whose script changed can't be merged, as they're reported along
+    with the hash of the script that produced them.
+
+    @param max_items: The maximum number of values of each graph of a
+        merged message.
+    """
+
+    def merge(pending, new):
+        graphs = dict(pending["data"])
+        for graph_id, graph in new["data"].items():
+            pending_graph = graphs.get(graph_id)
+            if pending_graph is not None:
+                if pending_graph["script-hash"] != graph["script-hash"]:
+                    return None
+                values = pending_graph["values"] + graph["values"]
+                if len(values) > max_items:
+                    return None
+                graph = dict(graph, values=values)
+            graphs[graph_id] = graph
+        merged = dict(pending)
+        merged["data"] = graphs
+        return merged
+
+    return merge
+
+
+def supersede(pending, new):
+    """A merger replacing the pending message with the new one."""
+    return new
+
+
+def update(pending, new):
+    """
+    A merger updating the pending message with the keys of the new one, for
+    snapshot messages holding only what changed, like C{computer-info}.
+    """
+    merged = dict(pending)
+    merged.update(new)
+    return merged
+
+
+MERGERS = {
+    "cpu-usage": merge_lists("cpu-usages"),
+    "load-average": merge_lists("load-averages"),
+    "memory-info": merge_lists("memory-info"),
+    "mount-info": merge_lists("mount-info"),
+    "network-activity": merge_dicts_of_lists("activities"),
+    "custom-graph": merge_custom_graphs(),
+    }
+
+SUPERSEDERS = {
+    "computer-info": update,
+    "distribution-info": supersede,
+    "processor-info": supersede,
+    "hardware-info": supersede,
+    }
+
+
+def get_mergers(types):
+    """Return the mergers for the given message types.
+
+    The mergers in L{SUPERSEDERS} are always included.
+
+    @param types: A list of message types, or C{["ALL"]} for all the types
+        having a merger in L{MERGERS}.
+    @raises ValueError: If one of the types has no merger.
+    """
+    if types == ["ALL"]:
+        types = list(MERGERS)
+    unknown = sorted(set(types) - set(MERGERS))
+    if unknown:
+        raise ValueError(
+            "Messages of type %s can't be merged." % ", ".join(unknown))
+    mergers = SUPERSEDERS.copy()
+    mergers.update((type, MERGERS[type]) for type in types)
+    return mergers
@@ -44,6 +44,7 @@ from twisted.python.failure import Failure
 from twisted.internet import defer
 
 from landscape.lib import bpickle
+from landscape.lib.backoff import Backoff
 from landscape.lib.fetch import fetch
 from landscape.lib.log import log_failure
 
@@ -105,16 +106,19 @@ class Pinger(object):
         to hit when pinging, and 'ping_interval' how frequently to ping.
         Changes in the configuration object will take effect from the next
         scheduled ping.
+    @param max_backoff: The maximum number of seconds between pings after
+        consecutive failures.
     """
 
     def __init__(self, reactor, identity, exchanger, config,
-                 ping_client_factory=PingClient):
+                 ping_client_factory=PingClient, max_backoff=30 * 60):
         self._config = config
         self._identity = identity
         self._reactor = reactor
         self._exchanger = exchanger
         self._call_id = None
         self._ping_client = None
+        self._backoff = Backoff(max_backoff)
         self.ping_client_factory = ping_client_factory
         reactor.call_on("message", self._handle_set_intervals)
 
@@ -124,6 +128,13 @@ class Pinger(object):
     def get_interval(self):
         return self._config.ping_interval
 
+    def get_backoff_state(self):
+        """
+        Return a C{dict} with the number of consecutive failed pings, and the
+        current delay between pings, or C{None} if they aren't being delayed.
+        """
+        return self._backoff.get_state()
+
     def start(self):
         """Start pinging."""
         self._ping_client = self.ping_client_factory(self._reactor)
@@ -138,6 +149,7 @@ class Pinger(object):
         deferred.addBoth(lambda _: self._schedule())
 
     def _got_result(self, exchange):
+        self._backoff.succeeded()
         if exchange:
             info("Ping indicates message available. "
                  "Scheduling an urgent exchange.")
@@ -146,12 +158,16 @@ class Pinger(object):
     def _got_error(self, failure):
         log_failure(failure,
                     "Error contacting ping server at %s" %
-                    (self._ping_client.url,))
+                    (self._config.ping_url,))
+        self._backoff.failed(self._config.ping_interval)
 
     def _schedule(self):
-        """Schedule a new ping using the current ping interval."""
-        self._call_id = self._reactor.call_later(self._config.ping_interval,
-                                                 self.ping)
+        """
+        Schedule a new ping using the current ping interval, delayed after
+        failed pings.
+        """
+        self._call_id = self._reactor.call_later(
+            self._backoff.get_interval(self._config.ping_interval), self.ping)
 
     def _handle_set_intervals(self, message):
         if message["type"] == "set-intervals" and "ping" in message:
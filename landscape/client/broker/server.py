@@ -46,6 +46,7 @@ Diagram::
 import logging
 
 from twisted.internet.defer import Deferred
+from twisted.python.compat import unicode
 
 from landscape.lib.twisted_util import gather_results
 from landscape.client.amp import remote
@@ -213,11 +214,47 @@ class BrokerServer(object):
         if self._message_store.is_valid_session_id(session_id):
             return self._exchanger.send(message, urgent=urgent)
 
+    @remote
+    def send_messages(self, messages, session_id, urgent=False):
+        """Queue several messages for delivery to the server.
+
+        @param messages: A list of message C{dict}s, see L{send_message}.
+        @param session_id: A session ID, see L{send_message}.
+        @param urgent: If C{True}, exchange urgently, otherwise exchange
+            during the next regularly scheduled exchange.
+        @return: A list holding, for each message, the identifier created
+            when queuing it, C{None} if it was dropped because C{session_id}
+            isn't valid anymore, or the description of the error raised if
+            it couldn't be queued.
+        """
+        if session_id is None:
+            raise RuntimeError(
+                "Session ID must be set before attempting to send a message")
+        if not self._message_store.is_valid_session_id(session_id):
+            return [None] * len(messages)
+        results = []
+        for message in messages:
+            # An invalid message doesn't prevent the others from being sent.
+            try:
+                results.append(self._exchanger.send(message, urgent=urgent))
+            except Exception as error:
+                results.append(unicode(error))
+        return results
+
     @remote
     def is_message_pending(self, message_id):
         """Indicate if a message with given C{message_id} is pending."""
         return self._message_store.is_pending(message_id)
 
+    @remote
+    def are_messages_pending(self, message_ids):
+        """Indicate which of the messages with the given ids are pending.
+
+        @param message_ids: A list of message identifiers.
+        @return: A list of bools, one for each identifier.
+        """
+        return self._message_store.are_pending(message_ids)
+
     @remote
     def stop_clients(self):
         """Tell all the clients to exit."""
@@ -254,6 +291,31 @@ class BrokerServer(object):
         """Return the uuid of the Landscape server we're pointing at."""
         return self._message_store.get_server_uuid()
 
+    @remote
+    def get_exchange_timings(self):
+        """
+        Return how long the phases of the recent exchanges with the Landscape
+        server took.
+
+        @return: A C{dict} mapping the phases of exchanges to C{dict}s
+            summarizing their duration, in seconds, see
+            L{landscape.client.broker.timing}.
+        """
+        return self._exchanger.get_timings()
+
+    @remote
+    def get_backoff_state(self):
+        """
+        Return the state of the backoff of the exchanges and pings with the
+        Landscape server, after consecutive failures.
+
+        @return: A C{dict} mapping C{"exchange"} and C{"ping"} to C{dict}s
+            holding the number of consecutive C{failures} and the current
+            C{delay} between attempts, or C{None} if they aren't delayed.
+        """
+        return {"exchange": self._exchanger.get_backoff_state(),
+                "ping": self._pinger.get_backoff_state()}
+
     @remote
     def register_client_accepted_message_type(self, type):
         """Register a new message type which can be accepted by this client.
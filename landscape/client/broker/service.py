@@ -6,11 +6,14 @@ from landscape.client.service import LandscapeService, run_landscape_service
 from landscape.client.amp import ComponentPublisher
 from landscape.client.broker.registration import RegistrationHandler, Identity
 from landscape.client.broker.config import BrokerConfiguration
-from landscape.client.broker.transport import HTTPTransport
+from landscape.client.broker.transport import (
+    HTTPTransport, CURL, get_transport_factory)
 from landscape.client.broker.exchange import MessageExchange
 from landscape.client.broker.exchangestore import ExchangeStore
 from landscape.client.broker.ping import Pinger
 from landscape.client.broker.store import get_default_message_store
+from landscape.client.broker.storage import get_message_storage
+from landscape.client.broker.merging import get_mergers
 from landscape.client.broker.server import BrokerServer
 
 
@@ -28,8 +31,9 @@ class BrokerService(LandscapeService):
         C{self.persist_filename}.
     @ivar message_store: A L{MessageStore} used by the C{exchanger} to
         queue outgoing messages.
-    @ivar transport: An L{HTTPTransport} used by the C{exchanger} to deliver
-        messages.
+    @ivar transport: An L{HTTPTransport}, or the L{AsyncHTTPTransport}
+        selected with the C{http_transport} option, used by the
+        C{exchanger} to deliver messages.
     @ivar identity: The L{Identity} of the Landscape client the broker runs on.
     @ivar exchanger: The L{MessageExchange} exchanges messages with the server.
     @ivar pinger: The L{Pinger} checks if the server has new messages for us.
@@ -48,10 +52,20 @@ class BrokerService(LandscapeService):
             config.data_path, "%s.bpickle" % (self.service_name,))
         super(BrokerService, self).__init__(config)
 
-        self.transport = self.transport_factory(
+        transport_factory = self.transport_factory
+        if config.http_transport != CURL:
+            transport_factory = get_transport_factory(config.http_transport)
+        self.transport = transport_factory(
             self.reactor, config.url, config.ssl_public_key)
+        storage = get_message_storage(
+            config.message_store_engine, config.message_store_path,
+            config.message_store_database_path)
         self.message_store = get_default_message_store(
-            self.persist, config.message_store_path)
+            self.persist, config.message_store_path, storage=storage,
+            compression=config.message_store_compression,
+            max_size=config.message_store_max_size * 1024 * 1024,
+            reactor=self.reactor,
+            mergers=get_mergers(config.merged_message_types))
         self.identity = Identity(self.config, self.persist)
         exchange_store = ExchangeStore(self.config.exchange_store_path)
         self.exchanger = MessageExchange(
@@ -81,11 +95,17 @@ class BrokerService(LandscapeService):
         self.pinger.start()
 
     def stopService(self):
-        """Stop the broker."""
+        """Stop the broker.
+
+        @return: What closing the transport returns, a L{Deferred} firing
+            once its connections are closed for asynchronous transports.
+        """
         self.publisher.stop()
         self.exchanger.stop()
         self.pinger.stop()
+        result = self.transport.close()
         super(BrokerService, self).stopService()
+        return result
 
 
 def run(args):
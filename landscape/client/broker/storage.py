@@ -0,0 +1,557 @@
+"""Storage engines used by the L{MessageStore} to keep queued messages.
+
+A storage engine keeps an ordered queue of serialized messages, each of them
+tagged with a (possibly empty) string of single-character flags. Entries are
+identified by opaque I{keys}, which are only meaningful to the engine that
+handed them out and which may change when the entry flags change or when the
+entry gets moved to the end of the queue.
+
+Two engines are available:
+
+  - L{FileMessageStorage}, which keeps one file per message in a directory
+    hierarchy, encoding the position of the message in the file name and its
+    flags in the file name suffix. This is the historical on-disk format.
+
+  - L{SQLiteMessageStorage}, which keeps messages in a single SQLite table
+    indexed on queue position, flags and message type.
+
+Messages can be moved from one engine to another with L{migrate_messages}.
+
+Changes made by engines are durable when their methods return, unless they
+are made between calls to C{begin} and C{commit}: in that case they're made
+durable all at once by C{commit}, which is much cheaper for bursts of
+changes.
+
+Engines store serialized messages as they are given, which the message store
+may have compressed with L{compress_message}. Compressed messages start with
+a header byte telling the compression method, which can't be mistaken for the
+first byte of an uncompressed bpickle, so queues mixing compressed and
+uncompressed messages can be read back with L{decompress_message}.
+"""
+import logging
+import os
+import zlib
+
+try:
+    import lzma
+except ImportError:  # Python 2
+    lzma = None
+
+try:
+    import sqlite3
+except ImportError:
+    from pysqlite2 import dbapi2 as sqlite3
+
+from landscape.lib import bpickle
+from landscape.lib.fs import create_binary_file, read_binary_file
+from landscape.lib.store import with_cursor
+
+
+FILES = "files"
+SQLITE = "sqlite"
+
+NO_COMPRESSION = "none"
+ZLIB = "zlib"
+LZMA = "lzma"
+
+COMPRESSIONS = [NO_COMPRESSION, ZLIB]
+if lzma is not None:
+    COMPRESSIONS.append(LZMA)
+
+# Uncompressed messages start with a bpickle type code, which is a letter.
+
+_ZLIB_HEADER = b"\x01"
+_LZMA_HEADER = b"\x02"
+_DECOMPRESSION_ERRORS = (zlib.error,)
+if lzma is not None:
+    _DECOMPRESSION_ERRORS += (lzma.LZMAError, EOFError)
+
+# The number of messages moved by L{migrate_messages} in each commit.
+MIGRATION_BATCH_SIZE = 500
+
+
+class FileMessageStorage(object):
+    """Store messages in a file system hierarchy.
+
+    Each message is a file in a sub-directory of C{directory}. Both the
+    sub-directories and the files are named after increasing natural
+    numbers, and each sub-directory holds at most C{directory_size} files.
+    Message flags are appended to the file name after an underscore.
+
+    The identifier of a stored message is the inode number of its file, as
+    it doesn't change when the file is renamed.
+
+    @param directory: Base of the file system hierarchy.
+    @param directory_size: Maximum number of files in each sub-directory.
+    """
+
+    # The maximum number of descriptors of written files kept open until
+    # L{commit}, past which they're flushed right away.
+    max_unsynced_files = 64
+
+    def __init__(self, directory, directory_size=1000):
+        self._directory = directory
+        self._directory_size = directory_size
+        # Descriptors of written files and paths of changed directories
+        # which still have to be flushed, when changes are being collected.
+        self._unsynced_files = None
+        self._unsynced_dirs = None
+        # The numbers of the sub-directory and of the file of the next
+        # message, found in the file system the first time they're needed.
+        self._next_position = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def begin(self):
+        """Start collecting changes, until L{commit} is called."""
+        if self._unsynced_files is None:
+            self._unsynced_files = []
+            self._unsynced_dirs = set()
+
+    def commit(self):
+        """Make the changes collected since L{begin} durable."""
+        if self._unsynced_files is None:
+            return
+        dirs, self._unsynced_dirs = self._unsynced_dirs, None
+        try:
+            self._flush_files()
+        finally:
+            self._unsynced_files = None
+        for path in sorted(dirs):
+            # The directory may have been removed along with its last file.
+            if os.path.isdir(path):
+                _fsync(path)
+
+    def add(self, data, type=None, flags=""):
+        """Append a message to the end of the queue.
+
+        @param data: The serialized message.
+        @param type: The message type, unused by this engine.
+        @param flags: The initial message flags.
+        @return: The key of the new entry.
+        """
+        filename = self._get_next_message_filename()
+        if flags:
+            filename += "_" + _sorted_flags(flags)
+        temp_path = filename + ".tmp"
+        create_binary_file(temp_path, data)
+        self._sync_file(temp_path)
+        os.rename(temp_path, filename)
+        self._sync_dir(os.path.dirname(filename))
+        return filename
+
+    def replace(self, key, data):
+        """Replace the message stored at C{key}, keeping its position.
+
+        The identifier of the message changes, as the file is replaced.
+        """
+        temp_path = key + ".tmp"
+        create_binary_file(temp_path, data)
+        self._sync_file(temp_path)
+        os.rename(temp_path, key)
+        self._sync_dir(os.path.dirname(key))
+
+    def walk(self, exclude=None):
+        """Iterate over the queue, yielding C{(key, flags)} tuples.
+
+        @param exclude: Optionally, a string of flags. Entries having any
+            of them are skipped.
+        """
+        if exclude:
+            exclude = set(exclude)
+        for message_dir in self._get_sorted_filenames():
+            for filename in self._get_sorted_filenames(message_dir):
+                flags = self._get_flags(filename)
+                if not exclude or not exclude & set(flags):
+                    yield self._message_dir(message_dir, filename), flags
+
+    def read(self, key):
+        """Return the serialized message stored at C{key}."""
+        return read_binary_file(key)
+
+    def get_id(self, key):
+        """Return the identifier of the message stored at C{key}."""
+        return os.stat(key).st_ino
+
+    def get_size(self, key):
+        """Return the size of the message stored at C{key}."""
+        return os.path.getsize(key)
+
+    def set_flags(self, key, flags):
+        """Replace the flags of the entry at C{key}, returning its new key."""
+        dirname, basename = os.path.split(key)
+        new_key = os.path.join(dirname, basename.split("_")[0])
+        if flags:
+            new_key += "_" + _sorted_flags(flags)
+        os.rename(key, new_key)
+        self._sync_dir(dirname)
+        return new_key
+
+    def requeue(self, key, flags):
+        """Move the entry at C{key} to the end of the queue.
+
+        @param flags: The flags the entry should have after being moved.
+        @return: The new key of the entry.
+        """
+        new_key = self._get_next_message_filename()
+        os.rename(key, new_key)
+        self._sync_dir(os.path.dirname(key))
+        return self.set_flags(new_key, flags)
+
+    def delete(self, key):
+        """Remove the entry at C{key}, along with its directory if empty."""
+        os.unlink(key)
+        containing_dir = os.path.split(key)[0]
+        if not os.listdir(containing_dir):
+            os.rmdir(containing_dir)
+
+    def delete_all(self):
+        """Remove all the entries in the queue."""
+        for key, flags in self.walk():
+            os.unlink(key)
+
+    def _sync_file(self, path):
+        """Make the content of the file at C{path} durable, now or later."""
+        fd = os.open(path, os.O_RDONLY)
+        if self._unsynced_files is None:
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        else:
+            # Keep the descriptor around, as the file may be renamed or
+            # removed before the changes are committed.
+            self._unsynced_files.append(fd)
+            if len(self._unsynced_files) >= self.max_unsynced_files:
+                self._flush_files()
+
+    def _flush_files(self):
+        """Flush and close the descriptors of the files written so far."""
+        files, self._unsynced_files = self._unsynced_files, []
+        try:
+            for fd in files:
+                os.fsync(fd)
+        finally:
+            for fd in files:
+                os.close(fd)
+
+    def _sync_dir(self, path):
+        """Make changes to the directory at C{path} durable, now or later."""
+        if self._unsynced_dirs is None:
+            _fsync(path)
+        else:
+            self._unsynced_dirs.add(path)
+
+    def _get_flags(self, path):
+        basename = os.path.basename(path)
+        if "_" in basename:
+            return basename.split("_")[1]
+        return ""
+
+    def _get_next_message_filename(self):
+        """Return the file name of the next message appended to the queue.
+
+        The position of the last message is kept in memory, so that the
+        file system is only scanned for it once.
+        """
+        if self._next_position is None:
+            self._next_position = self._find_next_position()
+        dir_number, file_number = self._next_position
+        if file_number >= self._directory_size:
+            dir_number, file_number = dir_number + 1, 0
+        message_dir = self._message_dir(str(dir_number))
+        if not os.path.isdir(message_dir):
+            # The directory is new, or it was removed with its last file.
+            os.makedirs(message_dir)
+        self._next_position = (dir_number, file_number + 1)
+        return os.path.join(message_dir, str(file_number))
+
+    def _find_next_position(self):
+        """
+        Return the numbers of the sub-directory and of the file following
+        the last message in the file system.
+        """
+        message_dirs = self._get_sorted_filenames()
+        if not message_dirs:
+            return (0, 0)
+        newest_dir = message_dirs[-1]
+        message_filenames = self._get_sorted_filenames(newest_dir)
+        if not message_filenames:
+            return (int(newest_dir), 0)
+        return (int(newest_dir),
+                int(message_filenames[-1].split("_")[0]) + 1)
+
+    def _get_sorted_filenames(self, dir=""):
+        message_files = [x for x in os.listdir(self._message_dir(dir))
+                         if not x.endswith(".tmp")]
+        message_files.sort(key=lambda x: int(x.split("_")[0]))
+        return message_files
+
+    def _message_dir(self, *args):
+        return os.path.join(self._directory, *args)
+
+
+class SQLiteMessageStorage(object):
+    """Store messages in a SQLite database.
+
+    The database has a single table called "message", whose schema is
+    defined in L{ensure_message_schema}. The key of an entry is the
+    C{id} of its row, which is also used as message identifier, while
+    the queue order is given by the C{sequence} column.
+
+    @param filename: The file where the database is persisted to.
+    """
+    _db = None
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._defer_commit = False
+
+    def begin(self):
+        """Start a transaction, committed when L{commit} is called."""
+        self._defer_commit = True
+
+    def commit(self):
+        """Commit the transaction started by L{begin}."""
+        self._defer_commit = False
+        if self._db:
+            self._db.commit()
+
+    def _ensure_schema(self):
+        ensure_message_schema(self._db)
+
+    @with_cursor
+    def add(self, cursor, data, type=None, flags=""):
+        """Append a message to the end of the queue.
+
+        @param data: The serialized message.
+        @param type: The message type, indexed to allow lookups by type.
+        @param flags: The initial message flags.
+        @return: The key of the new entry.
+        """
+        cursor.execute(
+            "INSERT INTO message (sequence, flags, type, data) VALUES "
+            "((SELECT IFNULL(MAX(sequence), -1) + 1 FROM message), ?, ?, ?)",
+            (_sorted_flags(flags), type, sqlite3.Binary(data)))
+        return cursor.lastrowid
+
+    @with_cursor
+    def replace(self, cursor, key, data):
+        """Replace the message stored at C{key}, keeping its position."""
+        cursor.execute("UPDATE message SET data=? WHERE id=?",
+                       (sqlite3.Binary(data), key))
+
+    @with_cursor
+    def _select(self, cursor, exclude=None):
+        query = "SELECT id, flags FROM message"
+        params = ()
+        if exclude:
+            query += " WHERE " + " AND ".join(
+                ["INSTR(flags, ?) = 0"] * len(exclude))
+            params = tuple(exclude)
+        cursor.execute(query + " ORDER BY sequence", params)
+        return cursor.fetchall()
+
+    def walk(self, exclude=None):
+        """Iterate over the queue, yielding C{(key, flags)} tuples.
+
+        @param exclude: Optionally, a string of flags. Entries having any
+            of them are skipped.
+        """
+        for key, flags in self._select(exclude):
+            yield key, flags
+
+    @with_cursor
+    def read(self, cursor, key):
+        """Return the serialized message stored at C{key}."""
+        cursor.execute("SELECT data FROM message WHERE id=?", (key,))
+        return bytes(cursor.fetchone()[0])
+
+    def get_id(self, key):
+        """Return the identifier of the message stored at C{key}."""
+        return key
+
+    @with_cursor
+    def get_size(self, cursor, key):
+        """Return the size of the message stored at C{key}."""
+        cursor.execute("SELECT LENGTH(data) FROM message WHERE id=?", (key,))
+        return cursor.fetchone()[0]
+
+    @with_cursor
+    def set_flags(self, cursor, key, flags):
+        """Replace the flags of the entry at C{key}, returning its new key."""
+        cursor.execute("UPDATE message SET flags=? WHERE id=?",
+                       (_sorted_flags(flags), key))
+        return key
+
+    @with_cursor
+    def requeue(self, cursor, key, flags):
+        """Move the entry at C{key} to the end of the queue.
+
+        @param flags: The flags the entry should have after being moved.
+        @return: The new key of the entry.
+        """
+        cursor.execute(
+            "UPDATE message SET flags=?, "
+            "sequence=(SELECT MAX(sequence) + 1 FROM message) WHERE id=?",
+            (_sorted_flags(flags), key))
+        return key
+
+    @with_cursor
+    def delete(self, cursor, key):
+        """Remove the entry at C{key}."""
+        cursor.execute("DELETE FROM message WHERE id=?", (key,))
+
+    @with_cursor
+    def delete_all(self, cursor):
+        """Remove all the entries in the queue."""
+        cursor.execute("DELETE FROM message")
+
+
+def _sorted_flags(flags):
+    return "".join(sorted(set(flags)))
+
+
+def _fsync(path):
+    """Flush the directory at C{path} to disk."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def compress_message(data, compression):
+    """Compress a serialized message for storage.
+
+    @param data: The serialized message.
+    @param compression: One of L{COMPRESSIONS}.
+    @return: The compressed message, prefixed with its header byte, or
+        C{data} itself if it's not compressed or compression doesn't make
+        it smaller.
+    """
+    if compression == ZLIB:
+        compressed = _ZLIB_HEADER + zlib.compress(data)
+    elif compression == LZMA and lzma is not None:
+        compressed = _LZMA_HEADER + lzma.compress(data)
+    else:
+        return data
+    if len(compressed) >= len(data):
+        return data
+    return compressed
+
+
+def decompress_message(data):
+    """Return the serialized message stored as C{data}.
+
+    @param data: A message possibly compressed with L{compress_message}.
+    @raises ValueError: If the message can't be decompressed.
+    """
+    header = data[:1]
+    try:
+        if header == _ZLIB_HEADER:
+            return zlib.decompress(data[1:])
+        if header == _LZMA_HEADER and lzma is not None:
+            return lzma.decompress(data[1:])
+    except _DECOMPRESSION_ERRORS as error:
+        raise ValueError("Corrupted compressed message: %s" % (error,))
+    return data
+
+
+def ensure_message_schema(db):
+    """Create all tables needed by a L{SQLiteMessageStorage}.
+
+    @param db: A connection to a SQLite database.
+    """
+    cursor = db.cursor()
+    try:
+        cursor.execute(
+            "CREATE TABLE message"
+            " (id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            "  sequence INTEGER NOT NULL, flags TEXT NOT NULL DEFAULT '',"
+            "  type TEXT, data BLOB NOT NULL)")
+        cursor.execute(
+            "CREATE UNIQUE INDEX message_sequence_idx ON message(sequence)")
+        cursor.execute(
+            "CREATE INDEX message_flags_idx ON message(flags, sequence)")
+        cursor.execute(
+            "CREATE INDEX message_type_idx ON message(type, sequence)")
+    except (sqlite3.OperationalError, sqlite3.DatabaseError):
+        cursor.close()
+        db.rollback()
+    else:
+        cursor.close()
+        db.commit()
+
+
+def migrate_messages(source, target, batch_size=MIGRATION_BATCH_SIZE):
+    """Move all the messages stored in C{source} to C{target}.
+
+    Messages keep their relative order and their flags, and they are
+    appended after any message already stored in C{target}. They are
+    added to C{target} in batches of C{batch_size} messages, each within a
+    C{begin()}/C{commit()} group, and only removed from C{source} once
+    their batch is committed, so no message is lost if the migration is
+    interrupted. Only the groups of L{SQLiteMessageStorage} are atomic
+    though: with L{FileMessageStorage} as C{target}, the messages of the
+    batch copied when the migration got interrupted are copied again when
+    it's resumed, and end up duplicated.
+
+    Note that message identifiers are engine-specific, so identifiers
+    handed out by C{source} are not valid anymore after the migration.
+
+    @return: The number of migrated messages.
+    """
+    entries = list(source.walk())
+    if not entries:
+        return 0
+    for start in range(0, len(entries), batch_size):
+        batch = entries[start:start + batch_size]
+        target.begin()
+        for key, flags in batch:
+            data = source.read(key)
+            try:
+                type = bpickle.loads(decompress_message(data))["type"]
+            except Exception:
+                # Broken or legacy messages are migrated anyway, the
+                # message store will deal with them when trying to deliver
+                # them.
+                type = None
+            if isinstance(type, bytes):
+                type = type.decode("ascii")
+            target.add(data, type=type, flags=flags)
+        target.commit()
+        for key, flags in batch:
+            source.delete(key)
+    logging.info("Migrated %d messages to the new message storage.",
+                 len(entries))
+    logging.warning(
+        "The identifiers of the migrated messages changed, so messages "
+        "waited for by their previous identifier, like the ones the "
+        "package reporter sent to request package hash IDs, are "
+        "considered delivered.")
+    return len(entries)
+
+
+def get_message_storage(engine, directory, database_filename):
+    """Return the message storage for the given C{engine}.
+
+    Any message left in the storage of the other engine, for example
+    because the engine was changed in the configuration, is migrated to
+    the returned storage.
+
+    @param engine: Either L{FILES} or L{SQLITE}.
+    @param directory: The directory used by L{FileMessageStorage}.
+    @param database_filename: The database used by L{SQLiteMessageStorage}.
+    """
+    if engine == SQLITE:
+        storage = SQLiteMessageStorage(database_filename)
+        if os.path.isdir(directory):
+            migrate_messages(FileMessageStorage(directory), storage)
+    elif engine == FILES:
+        storage = FileMessageStorage(directory)
+        if os.path.isfile(database_filename):
+            migrate_messages(SQLiteMessageStorage(database_filename), storage)
+    else:
+        raise ValueError("Unknown message storage engine: %s" % (engine,))
+    return storage
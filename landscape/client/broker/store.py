@@ -94,23 +94,121 @@ strategy for updating the pending offset and the sequence is implemented.
 
 import itertools
 import logging
-import os
 import uuid
 
+try:
+    from collections.abc import Mapping
+except ImportError:  # Python 2
+    from collections import Mapping
+
 from twisted.python.compat import iteritems
 
 from landscape import DEFAULT_SERVER_API
 from landscape.lib import bpickle
-from landscape.lib.fs import create_binary_file, read_binary_file
 from landscape.lib.versioning import sort_versions, is_version_higher
+from landscape.client.broker.storage import (
+    FileMessageStorage, NO_COMPRESSION, compress_message, decompress_message)
 
 
 HELD = "h"
 BROKEN = "b"
 
+# When the store grows over its size limit, messages with the lowest
+# eviction priority are evicted first, oldest first. Broken messages are
+# always evicted before anything else.
+LOW_PRIORITY = 0
+NORMAL_PRIORITY = 1
+HIGH_PRIORITY = 2
+
+DEFAULT_EVICTION_PRIORITIES = {
+    # Time series samples, losing some of them only leaves gaps in graphs.
+    "cpu-usage": LOW_PRIORITY,
+    "load-average": LOW_PRIORITY,
+    "network-activity": LOW_PRIORITY,
+    # Results of activities requested by the server.
+    "operation-result": HIGH_PRIORITY,
+    "change-packages-result": HIGH_PRIORITY,
+    }
+
+
+class _IndexEntry(object):
+    """An entry of the in-memory index of the messages in a L{MessageStore}.
+
+    @ivar key: The key of the message in the storage engine.
+    @ivar flags: The flags of the message, sorted.
+    @ivar id: The message identifier, or C{None} if not yet known.
+    @ivar position: A number increasing with the position of the entry in
+        the queue, it's updated when the entry is moved.
+    @ivar size: The size of the message in the storage, or C{None} if not
+        known because the store has no size limit.
+    @ivar type: The message type, or C{None} if not yet known.
+    """
+    __slots__ = ("key", "flags", "id", "position", "size", "type")
+
+    def __init__(self, key, flags, id=None, size=None, type=None):
+        self.key = key
+        self.flags = flags
+        self.id = id
+        self.position = None
+        self.size = size
+        self.type = type
+
+    def is_sendable(self):
+        """Whether the message is neither held nor broken."""
+        return HELD not in self.flags and BROKEN not in self.flags
+
+
+class StoredMessage(Mapping):
+    """A pending message, kept in the serialized form it was stored with.
+
+    Only the C{type} and C{api} of the message are kept decoded. When a
+    L{StoredMessage} is passed to L{bpickle.dumps}, for example as part of
+    an exchange payload, the stored bytes are embedded verbatim instead of
+    being encoded again. The complete message is decoded only when some
+    other key is looked up.
+
+    @ivar data: The serialized message.
+    """
+    __slots__ = ("data", "_type", "_api", "_message")
+
+    def __init__(self, data, type, api):
+        self.data = data
+        self._type = type
+        self._api = api
+        self._message = None
+
+    def _load(self):
+        if self._message is None:
+            self._message = bpickle.loads(self.data, as_is=True)
+        return self._message
+
+    def __getitem__(self, key):
+        if key == "type":
+            return self._type
+        if key == "api":
+            return self._api
+        return self._load()[key]
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+    def copy(self):
+        """Return the decoded message as a C{dict}."""
+        return dict(self._load())
+
+    def __repr__(self):
+        return repr(self._load())
+
+
+# Splice stored messages into payloads without encoding them again.
+bpickle.dumps_table[StoredMessage] = lambda message: message.data
+
 
 class MessageStore(object):
-    """A message store which stores its messages in a file system hierarchy.
+    """A message store which queues messages using a pluggable storage engine.
 
     Beside the "sequence" and the "pending offset" values described in the
     module docstring above, the L{MessageStore} also stores what we call
@@ -124,7 +222,36 @@ class MessageStore(object):
 
     @param persist: a L{Persist} used to save state parameters like the
         accepted message types, sequence, server uuid etc.
-    @param directory: base of the file system hierarchy
+    @param directory: base of the file system hierarchy, used when no
+        C{storage} is given.
+    @param storage: optionally, the storage engine to keep messages in, see
+        L{landscape.client.broker.storage}. It defaults to a
+        L{FileMessageStorage} rooted at C{directory}.
+    @param compression: the method used to compress messages before handing
+        them to the storage engine, one of
+        L{landscape.client.broker.storage.COMPRESSIONS}. Messages are read
+        back whatever the method they were compressed with.
+    @param max_size: optionally, the maximum number of bytes taken by the
+        stored messages. When it's exceeded, messages waiting to be sent
+        are evicted according to their type, see
+        L{DEFAULT_EVICTION_PRIORITIES}.
+    @param eviction_priorities: optionally, a C{dict} mapping message types
+        to their eviction priority, overriding the default ones. Types
+        not listed have a L{NORMAL_PRIORITY}.
+    @param reactor: optionally, the reactor used to group the writes made
+        to the storage within the same reactor iteration, for example when
+        all monitor plugins send their messages at once, and make them
+        durable together at the end of the iteration. Without a reactor,
+        each write is durable by itself.
+    @param mergers: optionally, a C{dict} mapping message types to the
+        function used to merge new messages of that type into the most
+        recent pending one, see L{landscape.client.broker.merging}.
+
+    The store keeps an in-memory index of the stored messages, holding their
+    storage keys and flags in queue order, and the number of messages which
+    are neither held nor broken. The index is loaded from the storage engine
+    the first time it's needed and then updated incrementally, so counting
+    and locating pending messages doesn't need to scan the storage.
     """
 
     # The initial message API version that we use to communicate with the
@@ -134,18 +261,46 @@ class MessageStore(object):
     # in case the server supports it.
     _api = DEFAULT_SERVER_API
 
-    def __init__(self, persist, directory, directory_size=1000):
-        self._directory = directory
-        self._directory_size = directory_size
+    def __init__(self, persist, directory, directory_size=1000, storage=None,
+                 compression=NO_COMPRESSION, max_size=None,
+                 eviction_priorities=None, reactor=None, mergers=None):
+        if storage is None:
+            storage = FileMessageStorage(directory, directory_size)
+        self._storage = storage
+        self._compression = compression
+        self._max_size = max_size
+        self._eviction_priorities = DEFAULT_EVICTION_PRIORITIES.copy()
+        if eviction_priorities:
+            self._eviction_priorities.update(eviction_priorities)
+        self._reactor = reactor
+        self._pending_commit = None
+        self._mergers = mergers or {}
+        # The entries of the most recently added messages of mergeable
+        # types, as long as they are pending. They are found in the index
+        # the first time a message is merged.
+        self._merge_targets = {}
+        self._merge_targets_loaded = False
+        # The position of the last entry handed out for delivery, until the
+        # exchange it's part of is acknowledged or fails.
+        self._in_flight_position = None
+        # The position of the last entry handed out for delivery, until the
+        # server acknowledges the messages it got, since it may have got
+        # them even if the exchange failed.
+        self._sent_position = None
+        self._index = None
+        self._ids = None
+        self._sendable_count = 0
+        self._size = 0
+        self._next_position = 0
         self._schemas = {}
+        self._resolved_schemas = {}
+        self._resolved_apis = {}
         self._original_persist = persist
         self._persist = persist.root_at("message-store")
-        message_dir = self._message_dir()
-        if not os.path.isdir(message_dir):
-            os.makedirs(message_dir)
 
     def commit(self):
-        """Persist metadata to disk."""
+        """Persist metadata to disk, along with any pending write."""
+        self._commit_writes()
         self._original_persist.save()
 
     def set_accepted_types(self, types):
@@ -228,6 +383,7 @@ class MessageStore(object):
         tagged with the given server API version.
         """
         self._persist.set("server_api", server_api)
+        self._clear_resolved_versions()
 
     def get_exchange_token(self):
         """Get the authentication token to use for the next exchange."""
@@ -246,8 +402,20 @@ class MessageStore(object):
 
         Set the offset into the message pool to consider assigned to the
         current sequence number as returned by l{get_sequence}.
+
+        This is how the server acknowledges the messages handed out for
+        delivery, so they aren't considered in flight anymore.
         """
         self._persist.set("pending_offset", val)
+        self._in_flight_position = None
+        self._sent_position = None
+        if self._merge_targets:
+            # Messages acknowledged by the server can't be merged into.
+            first_pending = next(self._walk_pending_messages(), None)
+            for type, entry in list(self._merge_targets.items()):
+                if (first_pending is None or
+                        entry.position < first_pending.position):
+                    del self._merge_targets[type]
 
     def add_pending_offset(self, val):
         """Increment the current pending offset by C{val}."""
@@ -255,25 +423,54 @@ class MessageStore(object):
 
     def count_pending_messages(self):
         """Return the number of pending messages."""
-        return sum(1 for x in self._walk_pending_messages())
+        self._get_index()
+        return max(0, self._sendable_count - self.get_pending_offset())
 
     def get_pending_messages(self, max=None):
         """Get any pending messages that aren't being held, up to max."""
+        return [message.copy()
+                for message in self.get_pending_stored_messages(max)]
+
+    def get_pending_stored_messages(self, max=None, max_bytes=None,
+                                    in_flight=False):
+        """Like L{get_pending_messages}, but returning L{StoredMessage}s.
+
+        Messages that can't be embedded verbatim, like the ones serialized
+        by Python 2 clients, are returned as C{dict}s.
+
+        @param max: The maximum number of messages to return.
+        @param max_bytes: The maximum total size of the returned messages,
+            once serialized. At least one message is returned in any case.
+        @param in_flight: Whether the returned messages are handed out for
+            delivery. If so, they are considered in flight, and can't be
+            evicted, until the server acknowledges them with
+            L{set_pending_offset}, or L{record_failure} is called. They
+            aren't merged into until the server acknowledges them.
+        """
         accepted_types = self.get_accepted_types()
         server_api = self.get_server_api()
         messages = []
-        for filename in self._walk_pending_messages():
+        size = 0
+        if in_flight:
+            self._in_flight_position = None
+        for entry in self._walk_pending_messages():
             if max is not None and len(messages) >= max:
                 break
-            data = read_binary_file(self._message_dir(filename))
             try:
-                # don't reinterpret messages that are meant to be sent out
-                message = bpickle.loads(data, as_is=True)
+                data = self._read(entry.key)
+                if (max_bytes is not None and messages and
+                        size + len(data) > max_bytes):
+                    break
+                # don't reinterpret messages that are meant to be sent out,
+                # and only decode the keys needed to filter them.
+                message = bpickle.loads_keys(
+                    data, (u"type", u"api"), as_is=True)
             except ValueError as e:
                 logging.exception(e)
-                self._add_flags(filename, BROKEN)
+                self._set_flags(entry, entry.flags + BROKEN)
             else:
                 if u"type" not in message:
+                    message = bpickle.loads(data, as_is=True)
                     # Special case to decode keys for messages which were
                     # serialized by py27 prior to py3 upgrade, and having
                     # implicit byte message keys. Message may still get
@@ -283,29 +480,61 @@ class MessageStore(object):
                         (k if isinstance(k, str) else k.decode("ascii")): v
                         for k, v in message.items()}
                     message[u"type"] = message[u"type"].decode("ascii")
+                else:
+                    message = StoredMessage(
+                        data, message[u"type"], message.get(u"api"))
 
                 unknown_type = message["type"] not in accepted_types
-                unknown_api = not is_version_higher(server_api, message["api"])
+                unknown_api = not self._is_api_supported(
+                    server_api, message["api"])
                 if unknown_type or unknown_api:
-                    self._add_flags(filename, HELD)
+                    self._set_flags(entry, entry.flags + HELD)
                 else:
                     messages.append(message)
+                    size += len(data)
+                    if in_flight:
+                        self._in_flight_position = entry.position
+        if in_flight and self._in_flight_position is not None and (
+                self._sent_position is None or
+                self._in_flight_position > self._sent_position):
+            self._sent_position = self._in_flight_position
         return messages
 
     def delete_old_messages(self):
         """Delete messages which are unlikely to be needed in the future."""
-        for fn in itertools.islice(self._walk_messages(exclude=HELD + BROKEN),
-                                   self.get_pending_offset()):
-            os.unlink(fn)
-            containing_dir = os.path.split(fn)[0]
-            if not os.listdir(containing_dir):
-                os.rmdir(containing_dir)
+        old_messages = list(itertools.islice(
+            (entry for entry in self._get_index() if entry.is_sendable()),
+            self.get_pending_offset()))
+        for entry in old_messages:
+            self._storage.delete(entry.key)
+        if old_messages:
+            self._remove_entries(old_messages)
 
     def delete_all_messages(self):
         """Remove ALL stored messages."""
         self.set_pending_offset(0)
-        for filename in self._walk_messages():
-            os.unlink(filename)
+        self._storage.delete_all()
+        self._index = []
+        self._ids = None
+        self._sendable_count = 0
+        self._size = 0
+        self._merge_targets.clear()
+
+    def get_size(self):
+        """Return the number of bytes taken by the stored messages.
+
+        This is only tracked when the store has a size limit, otherwise
+        C{0} is returned.
+        """
+        self._get_index()
+        return self._size
+
+    def get_evicted_count(self):
+        """
+        Return the number of messages evicted because the store exceeded
+        its size limit.
+        """
+        return self._persist.get("evicted-messages", 0)
 
     def add_schema(self, schema):
         """Add a schema to be applied to messages of the given type.
@@ -316,23 +545,37 @@ class MessageStore(object):
         api = schema.api if schema.api else self._api
         schemas = self._schemas.setdefault(schema.type, {})
         schemas[api] = schema
+        self._clear_resolved_versions()
 
     def is_pending(self, message_id):
         """Return bool indicating if C{message_id} still hasn't been delivered.
 
         @param message_id: Identifier returned by the L{add()} method.
         """
-        i = 0
-        pending_offset = self.get_pending_offset()
-        for filename in self._walk_messages(exclude=BROKEN):
-            flags = self._get_flags(filename)
-            if ((HELD in flags or i >= pending_offset) and
-                os.stat(filename).st_ino == message_id
-                ):
-                return True
-            if BROKEN not in flags and HELD not in flags:
-                i += 1
-        return False
+        return self.are_pending([message_id])[0]
+
+    def are_pending(self, message_ids):
+        """Tell which of the given messages still haven't been delivered.
+
+        Held messages are considered pending, while broken messages are
+        considered gone.
+
+        @param message_ids: A list of identifiers returned by L{add()}.
+        @return: A list of bools, one for each identifier.
+        """
+        ids = self._get_ids()
+        first_pending = next(self._walk_pending_messages(), None)
+        results = []
+        for message_id in message_ids:
+            entry = ids.get(message_id)
+            if entry is None or BROKEN in entry.flags:
+                results.append(False)
+            elif HELD in entry.flags:
+                results.append(True)
+            else:
+                results.append(first_pending is not None and
+                               entry.position >= first_pending.position)
+        return results
 
     def record_success(self, timestamp):
         """Record a successful exchange."""
@@ -343,7 +586,10 @@ class MessageStore(object):
         """
         Record a failed exchange, if all exchanges for the past week have
         failed then blackhole any future ones and request a full re-sync.
+
+        The messages handed out for delivery aren't in flight anymore.
         """
+        self._in_flight_position = None
         if not self._persist.has("first-failure-time"):
             self._persist.set("first-failure-time", timestamp)
         continued_failure_time = timestamp - self._persist.get(
@@ -366,7 +612,9 @@ class MessageStore(object):
             to the L{Message} schema for that specific message type.
 
         @return: message_id, which is an identifier for the added
-                 message or C{None} if the message was rejected.
+                 message or C{None} if the message was rejected. Merged
+                 messages get the identifier of the message they were
+                 merged into, which may have changed.
         """
         assert "type" in message
         if self._persist.get("blackhole-messages"):
@@ -378,82 +626,318 @@ class MessageStore(object):
         if "api" not in message:
             message["api"] = server_api
 
-        # We apply the schema with the highest API version that is greater
-        # or equal to the API version the message is tagged with.
-        schemas = self._schemas[message["type"]]
-        for api in sort_versions(schemas.keys()):
-            if is_version_higher(server_api, api):
-                schema = schemas[api]
-                break
+        schema = self._get_schema(message["type"], server_api)
         message = schema.coerce(message)
 
-        message_data = bpickle.dumps(message)
+        flags = ""
+        if not self.accepts(message["type"]):
+            flags = HELD
+        # Make sure the index is loaded before adding the message to the
+        # storage, or the new message would end up being indexed twice.
+        self._get_index()
+        self._group_writes()
+        if not flags:
+            entry = self._merge(message)
+            if entry is not None:
+                return entry.id
+
+        message_data = compress_message(
+            bpickle.dumps(message), self._compression)
+        key = self._storage.add(message_data, type=message["type"],
+                                flags=flags)
+
+        # The message id is provided by the storage engine and is stable
+        # across holding/unholding: the file engine uses the inode of the
+        # message file, while the SQLite engine uses the row id.
+        entry = _IndexEntry(key, flags, self._storage.get_id(key),
+                            type=message["type"])
+        if self._max_size:
+            entry.size = len(message_data)
+        self._append_entry(entry)
+        if not flags and message["type"] in self._mergers:
+            self._merge_targets[message["type"]] = entry
+        self._evict_messages()
+        return entry.id
+
+    def _merge(self, message):
+        """
+        Merge C{message} into the most recent pending message of the same
+        type, unless it was handed out for delivery and the server didn't
+        acknowledge it yet, as the server may have got it already.
+
+        @return: The index entry of the merged message, or C{None} if the
+            message couldn't be merged.
+        """
+        merge = self._mergers.get(message["type"])
+        if merge is None:
+            return None
+        self._load_merge_targets()
+        entry = self._merge_targets.get(message["type"])
+        if entry is None or not entry.is_sendable():
+            return None
+        if (self._sent_position is not None and
+                entry.position <= self._sent_position):
+            return None
+        try:
+            pending = bpickle.loads(self._read(entry.key))
+        except ValueError:
+            return None
+        if pending.get("api") != message["api"]:
+            return None
+        merged = merge(pending, message)
+        if merged is None:
+            return None
+        message_data = compress_message(
+            bpickle.dumps(merged), self._compression)
+        self._storage.replace(entry.key, message_data)
+        # The file engine changes the identifier of replaced messages, and
+        # the one of messages found in storage at startup isn't known yet.
+        message_id = self._storage.get_id(entry.key)
+        if self._ids is not None:
+            self._ids.pop(entry.id, None)
+            self._ids[message_id] = entry
+        entry.id = message_id
+        if entry.size is not None:
+            self._size += len(message_data) - entry.size
+            entry.size = len(message_data)
+        self._evict_messages()
+        return entry
+
+    def _load_merge_targets(self):
+        """
+        Find the most recent pending messages of the mergeable types in the
+        index, like the ones left over by a previous run.
+        """
+        if self._merge_targets_loaded:
+            return
+        self._merge_targets_loaded = True
+        types = set(self._mergers) - set(self._merge_targets)
+        for entry in reversed(list(self._walk_pending_messages())):
+            if not types:
+                break
+            try:
+                type = self._get_entry_type(entry)
+            except ValueError:
+                continue
+            if type in types:
+                self._merge_targets[type] = entry
+                types.remove(type)
+
+    def _group_writes(self):
+        """
+        Make the storage collect writes until the end of the current reactor
+        iteration, if we have a reactor.
+        """
+        if self._reactor is None or self._pending_commit is not None:
+            return
+        self._storage.begin()
+        self._pending_commit = self._reactor.call_later(
+            0, self._commit_writes)
 
-        filename = self._get_next_message_filename()
-        temp_path = filename + ".tmp"
-        create_binary_file(temp_path, message_data)
-        os.rename(temp_path, filename)
+    def _commit_writes(self):
+        """Make the writes collected by the storage durable."""
+        if self._pending_commit is None:
+            return
+        self._reactor.cancel_call(self._pending_commit)
+        self._pending_commit = None
+        self._storage.commit()
 
-        if not self.accepts(message["type"]):
-            filename = self._set_flags(filename, HELD)
-
-        # For now we use the inode as the message id, as it will work
-        # correctly even faced with holding/unholding.  It will break
-        # if the store is copied over for some reason, but this shouldn't
-        # present an issue given the current uses.  In the future we
-        # should have a nice transactional storage (e.g. sqlite) which
-        # will offer a more strong primary key.
-        message_id = os.stat(filename).st_ino
-
-        return message_id
-
-    def _get_next_message_filename(self):
-        message_dirs = self._get_sorted_filenames()
-        if message_dirs:
-            newest_dir = message_dirs[-1]
-        else:
-            os.makedirs(self._message_dir("0"))
-            newest_dir = "0"
-
-        message_filenames = self._get_sorted_filenames(newest_dir)
-        if not message_filenames:
-            filename = self._message_dir(newest_dir, "0")
-        elif len(message_filenames) < self._directory_size:
-            filename = str(int(message_filenames[-1].split("_")[0]) + 1)
-            filename = self._message_dir(newest_dir, filename)
+    def _read(self, key):
+        """Return the serialized message at C{key}, decompressing it."""
+        return decompress_message(self._storage.read(key))
+
+    def _get_schema(self, type, server_api):
+        """Return the schema to apply to messages of the given type.
+
+        We apply the schema with the highest API version that is lower or
+        equal to the server API version. The resolution is cached, since
+        parsing and sorting the versions is much slower than coercing most
+        messages.
+        """
+        key = (type, server_api)
+        schema = self._resolved_schemas.get(key)
+        if schema is None:
+            schemas = self._schemas[type]
+            for api in sort_versions(schemas.keys()):
+                if is_version_higher(server_api, api):
+                    schema = self._resolved_schemas[key] = schemas[api]
+                    break
+        return schema
+
+    def _is_api_supported(self, server_api, api):
+        """
+        Tell whether messages tagged with C{api} can be sent to a server
+        speaking C{server_api}, caching the answer.
+        """
+        key = (server_api, api)
+        supported = self._resolved_apis.get(key)
+        if supported is None:
+            supported = is_version_higher(server_api, api)
+            self._resolved_apis[key] = supported
+        return supported
+
+    def _clear_resolved_versions(self):
+        """Forget the cached version resolutions."""
+        self._resolved_schemas.clear()
+        self._resolved_apis.clear()
+
+    def _get_index(self):
+        """Return the index entries of all stored messages, in queue order.
+
+        The index is loaded from the storage engine on first use.
+        """
+        if self._index is None:
+            self._index = []
+            self._sendable_count = 0
+            self._size = 0
+            for key, flags in self._storage.walk():
+                entry = _IndexEntry(key, flags)
+                if self._max_size:
+                    entry.size = self._storage.get_size(key)
+                self._append_entry(entry)
+        return self._index
+
+    def _get_ids(self):
+        """Return a C{dict} mapping message identifiers to index entries.
+
+        Identifiers of messages indexed at load time are looked up in the
+        storage the first time this mapping is needed.
+        """
+        if self._ids is None:
+            self._ids = {}
+            for entry in self._get_index():
+                if entry.id is None:
+                    entry.id = self._storage.get_id(entry.key)
+                self._ids[entry.id] = entry
+        return self._ids
+
+    def _append_entry(self, entry):
+        entry.position = self._next_position
+        self._next_position += 1
+        self._index.append(entry)
+        if entry.is_sendable():
+            self._sendable_count += 1
+        if entry.size is not None:
+            self._size += entry.size
+        if self._ids is not None and entry.id is not None:
+            self._ids[entry.id] = entry
+
+    def _remove_entries(self, entries):
+        """Remove the given entries from the index."""
+        removed = set(entries)
+        self._index[:] = [
+            entry for entry in self._index if entry not in removed]
+        for entry in removed:
+            if entry.is_sendable():
+                self._sendable_count -= 1
+            if entry.size is not None:
+                self._size -= entry.size
+            if self._merge_targets.get(entry.type) is entry:
+                del self._merge_targets[entry.type]
+            if self._ids is not None:
+                self._ids.pop(entry.id, None)
+
+    def _set_flags(self, entry, flags):
+        """Change the flags of the given entry, in storage and in the index.
+
+        Like additions, the changes made within a reactor iteration are made
+        durable together, since messages are often flagged in bulk.
+        """
+        flags = "".join(sorted(set(flags)))
+        was_sendable = entry.is_sendable()
+        self._group_writes()
+        entry.key = self._storage.set_flags(entry.key, flags)
+        entry.flags = flags
+        self._sendable_count += entry.is_sendable() - was_sendable
+
+    def _requeue(self, entry, flags):
+        """Move the given entry to the end of the queue."""
+        self._group_writes()
+        self._remove_entries([entry])
+        entry.flags = "".join(sorted(set(flags)))
+        entry.key = self._storage.requeue(entry.key, entry.flags)
+        self._append_entry(entry)
+
+    def _evict_messages(self):
+        """Evict messages until the store fits in its size limit.
+
+        Only messages which weren't sent yet, or are held or broken, can be
+        evicted: the ones already sent, or in flight, are still needed in
+        case the server asks for them again, and they are deleted anyway
+        once the server acknowledges them.
+        """
+        if not self._max_size or self._size <= self._max_size:
+            return
+        first_pending = next(self._walk_pending_messages(), None)
+        if first_pending is None:
+            first_position = None
+        elif self._in_flight_position is None:
+            first_position = first_pending.position
         else:
-            newest_dir = self._message_dir(str(int(newest_dir) + 1))
-            os.makedirs(newest_dir)
-            filename = os.path.join(newest_dir, "0")
+            first_position = max(first_pending.position,
+                                 self._in_flight_position + 1)
+        candidates = [
+            entry for entry in self._index
+            if not entry.is_sendable() or (
+                first_position is not None and
+                entry.position >= first_position)]
+        candidates.sort(
+            key=lambda entry: (self._get_eviction_priority(entry),
+                               entry.position))
+        evicted = []
+        excess = self._size - self._max_size
+        for entry in candidates:
+            if excess <= 0:
+                break
+            self._storage.delete(entry.key)
+            evicted.append(entry)
+            excess -= entry.size
+        self._remove_entries(evicted)
+        self._persist.set("evicted-messages",
+                          self.get_evicted_count() + len(evicted))
+        types = sorted(set(entry.type or "unknown" for entry in evicted))
+        logging.warning(
+            "Message store exceeded its size limit of %d bytes, evicted "
+            "%d messages (%s).", self._max_size, len(evicted),
+            ", ".join(types))
+
+    def _get_eviction_priority(self, entry):
+        """Return the eviction priority of the message in C{entry}."""
+        if BROKEN in entry.flags:
+            return LOW_PRIORITY - 1
+        try:
+            type = self._get_entry_type(entry)
+        except ValueError:
+            return LOW_PRIORITY - 1
+        return self._eviction_priorities.get(type, NORMAL_PRIORITY)
+
+    def _get_entry_type(self, entry):
+        """
+        Return the type of the message in C{entry}, reading it from storage
+        if the index doesn't know it yet.
 
-        return filename
+        @raise ValueError: If the message can't be decoded.
+        """
+        if entry.type is None:
+            message = bpickle.loads_keys(self._read(entry.key), ("type",))
+            message_type = message.get("type")
+            if isinstance(message_type, bytes):
+                message_type = message_type.decode("ascii")
+            entry.type = message_type
+        return entry.type
 
     def _walk_pending_messages(self):
-        """Walk the files which are definitely pending."""
+        """Walk the index entries of messages which are definitely pending."""
+        index = self._get_index()
         pending_offset = self.get_pending_offset()
-        for i, filename in enumerate(
-                self._walk_messages(exclude=HELD + BROKEN)):
-            if i >= pending_offset:
-                yield filename
-
-    def _walk_messages(self, exclude=None):
-        if exclude:
-            exclude = set(exclude)
-        message_dirs = self._get_sorted_filenames()
-        for message_dir in message_dirs:
-            for filename in self._get_sorted_filenames(message_dir):
-                flags = set(self._get_flags(filename))
-                if (not exclude or not exclude & flags):
-                    yield self._message_dir(message_dir, filename)
-
-    def _get_sorted_filenames(self, dir=""):
-        message_files = [x for x in os.listdir(self._message_dir(dir))
-                         if not x.endswith(".tmp")]
-        message_files.sort(key=lambda x: int(x.split("_")[0]))
-        return message_files
-
-    def _message_dir(self, *args):
-        return os.path.join(self._directory, *args)
+        if pending_offset >= self._sendable_count:
+            return
+        i = 0
+        for entry in index:
+            if entry.is_sendable():
+                if i >= pending_offset:
+                    yield entry
+                i += 1
 
     def _reprocess_holding(self):
         """
@@ -463,43 +947,29 @@ class MessageStore(object):
         offset = 0
         pending_offset = self.get_pending_offset()
         accepted_types = self.get_accepted_types()
-        for old_filename in self._walk_messages():
-            flags = self._get_flags(old_filename)
+        for entry in list(self._get_index()):
+            flags = entry.flags
             try:
-                message = bpickle.loads(read_binary_file(old_filename))
+                message = bpickle.loads_keys(
+                    self._read(entry.key), ("type",))
             except ValueError as e:
                 logging.exception(e)
                 if HELD not in flags:
                     offset += 1
             else:
-                accepted = message["type"] in accepted_types
+                message_type = message.get("type")
+                if isinstance(message_type, bytes):
+                    # Legacy message serialized by py27 (lp: #1718689).
+                    message_type = message_type.decode("ascii")
+                accepted = message_type in accepted_types
                 if HELD in flags:
                     if accepted:
-                        new_filename = self._get_next_message_filename()
-                        os.rename(old_filename, new_filename)
-                        self._set_flags(new_filename, set(flags) - set(HELD))
+                        self._requeue(entry, flags.replace(HELD, ""))
                 else:
                     if not accepted and offset >= pending_offset:
-                        self._set_flags(old_filename, set(flags) | set(HELD))
+                        self._set_flags(entry, flags + HELD)
                     offset += 1
 
-    def _get_flags(self, path):
-        basename = os.path.basename(path)
-        if "_" in basename:
-            return basename.split("_")[1]
-        return ""
-
-    def _set_flags(self, path, flags):
-        dirname, basename = os.path.split(path)
-        new_path = os.path.join(dirname, basename.split("_")[0])
-        if flags:
-            new_path += "_" + "".join(sorted(set(flags)))
-        os.rename(path, new_path)
-        return new_path
-
-    def _add_flags(self, path, flags):
-        self._set_flags(path, self._get_flags(path) + flags)
-
     def get_session_id(self, scope=None):
         """Generate a unique session identifier, persist it and return it.
 
@@ -1,5 +1,8 @@
 import mock
 
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+
 from landscape.lib.amp import MethodCallError
 from landscape.client.tests.helpers import (
         LandscapeTest, DEFAULT_ACCEPTED_TYPES)
@@ -61,6 +64,85 @@ class RemoteBrokerTest(LandscapeTest):
         self.assertTrue(isinstance(message_id, int))
         self.assertTrue(self.exchanger.is_urgent())
 
+    def test_batch_messages(self):
+        """
+        After L{RemoteBroker.batch_messages} is called, the messages sent
+        during a reactor iteration are sent with a single C{send_messages}
+        call at the end of it.
+        """
+        clock = Clock()
+        self.remote._factory.clock = clock
+        self.broker.send_messages = mock.Mock(wraps=self.broker.send_messages)
+        self.mstore.set_accepted_types(["test"])
+        session_id = self.successResultOf(self.remote.get_session_id())
+        self.remote.batch_messages()
+        result1 = self.remote.send_message({"type": "test"}, session_id)
+        result2 = self.remote.send_message({"type": "test"}, session_id)
+        self.assertEqual(0, self.broker.send_messages.call_count)
+        clock.advance(0)
+        message_ids = [self.successResultOf(result1),
+                       self.successResultOf(result2)]
+        self.assertEqual([True, True], self.mstore.are_pending(message_ids))
+        self.assertEqual(1, self.broker.send_messages.call_count)
+
+    def test_batch_messages_with_urgent(self):
+        """
+        Consecutive messages with the same urgency are sent together, keeping
+        the order of the messages.
+        """
+        clock = Clock()
+        self.remote._factory.clock = clock
+        self.broker.send_messages = mock.Mock(wraps=self.broker.send_messages)
+        self.mstore.set_accepted_types(["test"])
+        session_id = self.successResultOf(self.remote.get_session_id())
+        self.remote.batch_messages()
+        self.remote.send_message({"type": "test", "sequence": 1}, session_id)
+        self.remote.send_message({"type": "test", "sequence": 2}, session_id,
+                                 urgent=True)
+        self.remote.send_message({"type": "test", "sequence": 3}, session_id,
+                                 urgent=True)
+        clock.advance(0)
+        self.assertEqual(
+            [([1], False), ([2, 3], True)],
+            [([message["sequence"] for message in args[0]], kwargs["urgent"])
+             for name, args, kwargs in self.broker.send_messages.mock_calls])
+        self.assertTrue(self.exchanger.is_urgent())
+        self.assertEqual(
+            [1, 2, 3], [message["sequence"]
+                        for message in self.mstore.get_pending_messages()])
+
+    def test_batch_messages_with_invalid_message(self):
+        """
+        If a batched message can't be queued, a L{MethodCallError} is raised
+        for it only.
+        """
+        clock = Clock()
+        self.remote._factory.clock = clock
+        self.mstore.set_accepted_types(["test"])
+        session_id = self.successResultOf(self.remote.get_session_id())
+        self.remote.batch_messages()
+        result1 = self.remote.send_message(
+            {"type": "test", "sequence": "bad"}, session_id)
+        result2 = self.remote.send_message({"type": "test"}, session_id)
+        clock.advance(0)
+        failure = self.failureResultOf(result1)
+        self.assertEqual(MethodCallError, failure.type)
+        self.assertTrue(self.mstore.is_pending(self.successResultOf(result2)))
+
+    def test_batch_messages_with_failure(self):
+        """
+        If the C{send_messages} call fails, the failure is propagated to all
+        the batched messages.
+        """
+        clock = Clock()
+        self.remote._factory.clock = clock
+        self.remote.batch_messages()
+        result1 = self.remote.send_message({"type": "test"}, None)
+        result2 = self.remote.send_message({"type": "test"}, None)
+        clock.advance(0)
+        self.assertEqual(MethodCallError, self.failureResultOf(result1).type)
+        self.assertEqual(MethodCallError, self.failureResultOf(result2).type)
+
     def test_is_message_pending(self):
         """
         The L{RemoteBroker.is_message_pending} method calls the
@@ -70,6 +152,15 @@ class RemoteBrokerTest(LandscapeTest):
         result = self.remote.is_message_pending(1234)
         return self.assertSuccess(result, False)
 
+    def test_are_messages_pending(self):
+        """
+        The L{RemoteBroker.are_messages_pending} method calls the
+        C{are_messages_pending} method of the remote L{BrokerServer} instance
+        and returns its result with a L{Deferred}.
+        """
+        result = self.remote.are_messages_pending([1234, 5678])
+        return self.assertSuccess(result, [False, False])
+
     def test_stop_clients(self):
         """
         The L{RemoteBroker.stop_clients} method calls the C{stop_clients}
@@ -163,6 +254,57 @@ class RemoteBrokerTest(LandscapeTest):
         result = self.remote.call_if_accepted("test", function)
         return self.assertSuccess(result, None)
 
+    def test_call_if_accepted_with_cache(self):
+        """
+        Once L{RemoteBroker.cache_accepted_types} was called, the
+        L{RemoteBroker.call_if_accepted} method checks the cached types,
+        without asking the broker.
+        """
+        self.mstore.set_accepted_types(["test"])
+        self.successResultOf(self.remote.cache_accepted_types())
+        self.mstore.set_accepted_types([])
+        function = mock.Mock(return_value="cool")
+        result = self.remote.call_if_accepted("test", function, 123)
+        self.assertEqual("cool", self.successResultOf(result))
+        function.assert_called_once_with(123)
+
+    def test_set_message_type_acceptance(self):
+        """
+        The L{RemoteBroker.set_message_type_acceptance} method updates the
+        cache of the accepted types.
+        """
+        self.successResultOf(self.remote.cache_accepted_types())
+        self.remote.set_message_type_acceptance("test", True)
+        function = mock.Mock()
+        self.successResultOf(self.remote.call_if_accepted("test", function))
+        self.remote.set_message_type_acceptance("test", False)
+        self.successResultOf(self.remote.call_if_accepted("test", function))
+        function.assert_called_once_with()
+
+    def test_set_message_type_acceptance_while_caching(self):
+        """
+        Changes made while the accepted types are being fetched are applied
+        on top of the fetched ones.
+        """
+        deferred = Deferred()
+        self.remote.get_accepted_message_types = lambda: deferred
+        result = self.remote.cache_accepted_types()
+        self.remote.set_message_type_acceptance("test", False)
+        self.remote.set_message_type_acceptance("new", True)
+        deferred.callback(["test", "other"])
+        self.successResultOf(result)
+        self.assertEqual({"other", "new"}, self.remote._accepted_types)
+
+    def test_set_message_type_acceptance_without_cache(self):
+        """
+        The L{RemoteBroker.set_message_type_acceptance} method doesn't
+        create a cache, and the broker is still asked for the accepted types.
+        """
+        self.remote.set_message_type_acceptance("test", True)
+        function = (lambda: 1 / 0)
+        result = self.remote.call_if_accepted("test", function)
+        return self.assertSuccess(result, None)
+
     def test_listen_events(self):
         """
         L{RemoteBroker.listen_events} returns a deferred which fires when
@@ -398,11 +398,25 @@ class BrokerClientTest(LandscapeTest):
         self.client.fire_event(event_type, "test", False)
         callback.assert_called_once_with(False)
 
+    def test_fire_event_with_acceptance_changed_updates_cache(self):
+        """
+        When the given event type is C{message-type-acceptance-changed}, the
+        cache of the accepted types kept by the broker is updated.
+        """
+        self.successResultOf(self.client.broker.cache_accepted_types())
+        self.client.fire_event("message-type-acceptance-changed", "test",
+                               True)
+        function = mock.Mock()
+        result = self.client.broker.call_if_accepted("test", function)
+        self.successResultOf(result)
+        function.assert_called_once_with()
+
     def test_handle_reconnect(self):
         """
         The L{BrokerClient.handle_reconnect} method is triggered by a
         broker-reconnect event, and it causes any message types previously
-        registered with the broker to be registered again.
+        registered with the broker to be registered again, and the cache of
+        the accepted types to be refreshed.
         """
         result1 = self.client.register_message("foo", lambda m: None)
         result2 = self.client.register_message("bar", lambda m: None)
@@ -417,6 +431,7 @@ class BrokerClientTest(LandscapeTest):
             broker.register_client_accepted_message_type.assert_has_calls(
                 calls, any_order=True)
             broker.register_client.assert_called_once_with("client")
+            broker.cache_accepted_types.assert_called_once_with()
 
         return gather_results([result1, result2]).addCallback(got_result)
 
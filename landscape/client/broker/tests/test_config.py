@@ -124,3 +124,95 @@ class ConfigurationTests(LandscapeTest):
 
         self.assertEqual(configuration.url,
                          "https://landscape.canonical.com/message-system")
+
+    def test_message_store_engine(self):
+        """
+        The message store engine defaults to 'files' and can be set to
+        'sqlite', which keeps messages in the message store database.
+        """
+        configuration = BrokerConfiguration()
+        configuration.load(["--url", "whatever"])
+        self.assertEqual("files", configuration.message_store_engine)
+
+        filename = self.makeFile("[client]\n"
+                                 "message_store_engine = sqlite\n")
+        configuration.load(["--config", filename, "--url", "whatever"])
+        self.assertEqual("sqlite", configuration.message_store_engine)
+        self.assertEqual(
+            os.path.join(configuration.data_path, "messages.database"),
+            configuration.message_store_database_path)
+
+    def test_message_store_compression(self):
+        """
+        Queued messages are not compressed by default, and can be compressed
+        with zlib.
+        """
+        configuration = BrokerConfiguration()
+        configuration.load(["--url", "whatever"])
+        self.assertEqual("none", configuration.message_store_compression)
+
+        filename = self.makeFile("[client]\n"
+                                 "message_store_compression = zlib\n")
+        configuration.load(["--config", filename, "--url", "whatever"])
+        self.assertEqual("zlib", configuration.message_store_compression)
+
+    def test_message_store_max_size(self):
+        """
+        The message store has no size limit by default, and can be limited
+        to a number of megabytes.
+        """
+        configuration = BrokerConfiguration()
+        configuration.load(["--url", "whatever"])
+        self.assertEqual(0, configuration.message_store_max_size)
+
+        filename = self.makeFile("[client]\n"
+                                 "message_store_max_size = 100\n")
+        configuration.load(["--config", filename, "--url", "whatever"])
+        self.assertEqual(100, configuration.message_store_max_size)
+
+    def test_max_payload_size(self):
+        """The maximum payload size defaults to 10 megabytes."""
+        configuration = BrokerConfiguration()
+        configuration.load(["--url", "whatever"])
+        self.assertEqual(10240, configuration.max_payload_size)
+
+    def test_http_transport(self):
+        """The curl HTTP transport is used by default."""
+        configuration = BrokerConfiguration()
+        configuration.load(["--url", "whatever"])
+        self.assertEqual("curl", configuration.http_transport)
+        configuration.load(["--url", "whatever",
+                            "--http-transport", "twisted"])
+        self.assertEqual("twisted", configuration.http_transport)
+
+    def test_merged_message_types(self):
+        """
+        No message type is merged by default, and the types to merge can
+        be configured as a comma separated list.
+        """
+        configuration = BrokerConfiguration()
+        configuration.load(["--url", "whatever"])
+        self.assertEqual([], configuration.merged_message_types)
+
+        configuration.load(["--url", "whatever", "--merge-message-types",
+                            "cpu-usage, load-average"])
+        self.assertEqual(["cpu-usage", "load-average"],
+                         configuration.merged_message_types)
+
+        configuration.load(["--url", "whatever", "--merge-message-types",
+                            "ALL"])
+        self.assertEqual(["ALL"], configuration.merged_message_types)
+
+    def test_unknown_merged_message_types(self):
+        """
+        Loading the configuration fails if it asks to merge message types
+        that can't be merged.
+        """
+        configuration = BrokerConfiguration()
+        filename = self.makeFile("[client]\n"
+                                 "merge_message_types = load-average, foo\n")
+        with self.assertRaises(SystemExit) as cm:
+            configuration.load(["--config", filename, "--url", "whatever"])
+        self.assertEqual(
+            "error: bad merge_message_types setting: Messages of type foo "
+            "can't be merged.", str(cm.exception))
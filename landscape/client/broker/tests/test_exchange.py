@@ -1,5 +1,8 @@
+import itertools
 import mock
 
+from twisted.internet.defer import maybeDeferred
+
 from landscape import CLIENT_API
 from landscape.lib.persist import Persist
 from landscape.lib.fetch import HTTPCodeError, PyCurlError
@@ -8,9 +11,9 @@ from landscape.lib.schema import Int
 from landscape.message_schemas.message import Message
 from landscape.client.broker.config import BrokerConfiguration
 from landscape.client.broker.exchange import (
-        get_accepted_types_diff, MessageExchange)
+        get_accepted_types_diff, MessageExchange, PayloadBudget)
 from landscape.client.broker.transport import FakeTransport
-from landscape.client.broker.store import MessageStore
+from landscape.client.broker.store import MessageStore, StoredMessage
 from landscape.client.broker.ping import Pinger
 from landscape.client.broker.registration import RegistrationHandler
 from landscape.client.tests.helpers import (
@@ -202,6 +205,16 @@ class MessageExchangeTest(LandscapeTest):
         self.assertMessages(self.transport.payloads[0]["messages"],
                             [{"type": "holdme"}])
 
+    def test_accepted_types_dont_mark_messages_in_flight(self):
+        """
+        Checking for pending messages after the accepted types change
+        doesn't consider them in flight, since they aren't being sent yet.
+        """
+        self.exchanger.send({"type": "holdme"})
+        self.exchanger.handle_message(
+            {"type": "accepted-types", "types": ["holdme"]})
+        self.assertIs(None, self.mstore._in_flight_position)
+
     def test_accepted_types_no_urgent_without_held(self):
         """
         If an accepted-types message does *not* "unhold" any exist messages,
@@ -364,6 +377,40 @@ class MessageExchangeTest(LandscapeTest):
         self.wait_for_exchange(urgent=True)
         self.assertEqual(len(self.transport.payloads), 1)  # no change
 
+    def test_asynchronous_transport(self):
+        """
+        The exchange method of asynchronous transports is called directly,
+        instead of in a thread, and the L{Deferred} it returns is used to
+        handle the result.
+        """
+
+        class AsyncFakeTransport(FakeTransport):
+
+            asynchronous = True
+
+            def exchange(self, *args):
+                return maybeDeferred(FakeTransport.exchange, self, *args)
+
+        transport = AsyncFakeTransport()
+        self.reactor.call_in_thread = mock.Mock()
+        exchanger = MessageExchange(self.reactor, self.mstore, transport,
+                                    self.identity, self.exchange_store,
+                                    self.config)
+        self.mstore.set_accepted_types(["empty"])
+        self.mstore.add({"type": "empty"})
+        exchanger.exchange()
+        self.assertEqual(1, len(transport.payloads))
+        self.assertEqual(0, self.mstore.count_pending_messages())
+        self.reactor.call_in_thread.assert_not_called()
+
+        failed = []
+        self.reactor.call_on("exchange-failed",
+                             lambda ssl_error: failed.append(ssl_error))
+        transport.responses.append(PyCurlError(60, "SSL error"))
+        self.log_helper.ignore_errors("Message exchange failed")
+        exchanger.exchange()
+        self.assertEqual([True], failed)
+
     def test_successful_exchange_records_success(self):
         """
         When a successful exchange occurs, that success is recorded in the
@@ -581,6 +628,18 @@ class MessageExchangeTest(LandscapeTest):
         store = MessageStore(persist, self.config.message_store_path)
         self.assertIs(None, store.get_exchange_token())
 
+    def test_payload_embeds_stored_messages(self):
+        """
+        Messages are put in the payload as L{StoredMessage}s, so the
+        transport doesn't need to encode them again.
+        """
+        self.mstore.set_accepted_types(["empty"])
+        self.mstore.add({"type": "empty"})
+        self.exchanger.exchange()
+        [message] = self.transport.payloads[0]["messages"]
+        self.assertIsInstance(message, StoredMessage)
+        self.assertEqual("empty", message["type"])
+
     def test_include_total_messages_none(self):
         """
         The payload includes the total number of messages that the client has
@@ -615,6 +674,154 @@ class MessageExchangeTest(LandscapeTest):
         exchanger.exchange()
         self.assertEqual(self.transport.payloads[0]["total-messages"], 2)
 
+    def test_payload_size_budget(self):
+        """
+        The messages included in a payload fit in the payload budget, but
+        at least one message is sent.
+        """
+        self.mstore.set_accepted_types(["data"])
+        for i in range(3):
+            self.mstore.add({"type": "data", "data": i})
+        [message] = self.mstore.get_pending_stored_messages(1)
+        self.exchanger._payload_budget.bytes = len(message.data) * 2
+        self.exchanger.exchange()
+        self.assertEqual(2, len(self.transport.payloads[0]["messages"]))
+        self.assertEqual(3, self.transport.payloads[0]["total-messages"])
+        self.exchanger._payload_budget.bytes = 1
+        self.exchanger.exchange()
+        self.assertEqual(1, len(self.transport.payloads[1]["messages"]))
+
+    def test_payload_budget_adapts_to_exchanges(self):
+        """
+        The payload budget shrinks when exchanges take too long, and when
+        they fail.
+        """
+        budget = self.exchanger._payload_budget
+        budget.bytes = budget.maximum
+        self.mstore.set_accepted_types(["data"])
+        self.mstore.add({"type": "data", "data": 1})
+        with mock.patch("time.time", side_effect=itertools.count(0, 600)):
+            self.exchanger.exchange()
+        self.assertEqual(budget.minimum, budget.bytes)
+
+        budget.bytes = budget.maximum
+        self.transport.responses.append(RuntimeError("Failed!"))
+        self.log_helper.ignore_errors(RuntimeError)
+        self.exchanger.exchange()
+        self.assertEqual(budget.maximum // 2, budget.bytes)
+
+    def test_payload_budget_shrinks_without_result(self):
+        """
+        An exchange without result counts as a failure for the payload
+        budget, however quick it was.
+        """
+        budget = self.exchanger._payload_budget
+        budget.bytes = budget.minimum * 4
+        self.transport.exchange = lambda *args, **kwargs: None
+        self.mstore.set_accepted_types(["data"])
+        self.mstore.add({"type": "data", "data": 1})
+        self.exchanger.exchange()
+        self.assertEqual(budget.minimum * 2, budget.bytes)
+
+    def test_drain_backlog(self):
+        """
+        When the backlog of pending messages is much larger than a batch,
+        exchanges happen back-to-back until it's drained.
+        """
+        exchanger = MessageExchange(self.reactor, self.mstore, self.transport,
+                                    self.identity, self.exchange_store,
+                                    self.config, max_messages=2)
+        self.mstore.set_accepted_types(["empty"])
+        for i in range(20):
+            self.mstore.add({"type": "empty"})
+        exchanger.exchange()
+        self.assertTrue(exchanger.is_draining())
+        self.reactor.advance(0)
+        self.assertEqual(10, len(self.transport.payloads))
+        self.assertEqual(0, self.mstore.count_pending_messages())
+        self.assertFalse(exchanger.is_draining())
+        self.assertFalse(exchanger.is_urgent())
+
+    def test_no_drain_for_small_backlog(self):
+        """
+        Exchanges don't happen back-to-back when only a few batches are
+        pending.
+        """
+        exchanger = MessageExchange(self.reactor, self.mstore, self.transport,
+                                    self.identity, self.exchange_store,
+                                    self.config, max_messages=2)
+        self.mstore.set_accepted_types(["empty"])
+        for i in range(6):
+            self.mstore.add({"type": "empty"})
+        exchanger.exchange()
+        self.assertFalse(exchanger.is_draining())
+        self.reactor.advance(0)
+        self.assertEqual(1, len(self.transport.payloads))
+
+    def test_drain_duration(self):
+        """Draining stops once the drain duration is exhausted."""
+        exchanger = MessageExchange(self.reactor, self.mstore, self.transport,
+                                    self.identity, self.exchange_store,
+                                    self.config, max_messages=2,
+                                    drain_duration=10)
+        self.mstore.set_accepted_types(["empty"])
+        for i in range(20):
+            self.mstore.add({"type": "empty"})
+        exchanger.exchange()
+        self.assertTrue(exchanger.is_draining())
+        with mock.patch.object(self.reactor, "time", return_value=10):
+            self.reactor.advance(0)
+        self.assertEqual(2, len(self.transport.payloads))
+        self.assertFalse(exchanger.is_draining())
+        self.assertTrue(exchanger.is_urgent())
+
+    def test_drain_size(self):
+        """Draining stops once the drain size is exhausted."""
+        exchanger = MessageExchange(self.reactor, self.mstore, self.transport,
+                                    self.identity, self.exchange_store,
+                                    self.config, max_messages=2,
+                                    drain_size=1)
+        self.mstore.set_accepted_types(["empty"])
+        for i in range(20):
+            self.mstore.add({"type": "empty"})
+        exchanger.exchange()
+        self.assertFalse(exchanger.is_draining())
+        self.reactor.advance(0)
+        self.assertEqual(1, len(self.transport.payloads))
+
+    def test_drain_stops_without_acknowledgement(self):
+        """
+        Draining stops when the server doesn't acknowledge the messages sent.
+        """
+        exchanger = MessageExchange(self.reactor, self.mstore, self.transport,
+                                    self.identity, self.exchange_store,
+                                    self.config, max_messages=2)
+        self.mstore.set_accepted_types(["empty"])
+        for i in range(20):
+            self.mstore.add({"type": "empty"})
+        exchanger.exchange()
+        self.assertTrue(exchanger.is_draining())
+        self.transport.extra["next-expected-sequence"] = 2
+        self.reactor.advance(0)
+        self.assertEqual(2, len(self.transport.payloads))
+        self.assertFalse(exchanger.is_draining())
+
+    def test_drain_stops_on_failure(self):
+        """Draining stops when an exchange fails."""
+        exchanger = MessageExchange(self.reactor, self.mstore, self.transport,
+                                    self.identity, self.exchange_store,
+                                    self.config, max_messages=2)
+        self.mstore.set_accepted_types(["empty"])
+        for i in range(20):
+            self.mstore.add({"type": "empty"})
+        exchanger.exchange()
+        self.assertTrue(exchanger.is_draining())
+        self.transport.responses.append(RuntimeError("Failed!"))
+        self.log_helper.ignore_errors(RuntimeError)
+        self.reactor.advance(0)
+        self.assertEqual(2, len(self.transport.payloads))
+        self.assertFalse(exchanger.is_draining())
+
     def test_impending_exchange(self):
         """
         A reactor event is emitted shortly (10 seconds) before an exchange
@@ -1009,6 +1216,71 @@ class MessageExchangeTest(LandscapeTest):
         self.exchanger.exchange()
         self.assertEqual([None], events)
 
+    def test_timings(self):
+        """
+        The durations of the phases of exchanges are recorded, including the
+        ones measured by the transport.
+        """
+        self.transport.timings = {"transfer": 2.0}
+        self.exchanger.exchange()
+        timings = self.exchanger.get_timings()
+        self.assertEqual(["dispatch", "payload", "transfer"], sorted(timings))
+        self.assertEqual(1, timings["payload"]["count"])
+        self.assertEqual(2.0, timings["transfer"]["max"])
+
+    def test_timings_log(self):
+        """The timings of exchanges are logged periodically."""
+        exchanger = MessageExchange(self.reactor, self.mstore, self.transport,
+                                    self.identity, self.exchange_store,
+                                    self.config, timings_log_interval=3600)
+        exchanger.start()
+        self.reactor.advance(3600)
+        self.assertIn("Exchange phase timings (median/90th percentile): "
+                      "payload ", self.logfile.getvalue())
+        exchanger.stop()
+
+    def test_backoff_after_failures(self):
+        """
+        After consecutive failures, exchanges are delayed by an increasing
+        random amount of time, up to a maximum, even urgent ones. The
+        backoff is reset by a successful exchange.
+        """
+        self.log_helper.ignore_errors(RuntimeError)
+        self.config.exchange_interval = 60
+        self.transport.responses.extend(
+            [RuntimeError("Failed!"), RuntimeError("Failed!")])
+        with mock.patch("random.uniform", side_effect=lambda a, b: b):
+            self.exchanger.exchange()
+            self.assertEqual({"failures": 1, "delay": 180},
+                             self.exchanger.get_backoff_state())
+            self.exchanger.schedule_exchange(urgent=True)
+            self.reactor.advance(179)
+            self.assertEqual(1, len(self.transport.payloads))
+            self.reactor.advance(1)
+            self.assertEqual(2, len(self.transport.payloads))
+        self.assertEqual({"failures": 2, "delay": 540},
+                         self.exchanger.get_backoff_state())
+
+        self.reactor.advance(540)
+        self.assertEqual(3, len(self.transport.payloads))
+        self.assertEqual({"failures": 0, "delay": None},
+                         self.exchanger.get_backoff_state())
+        self.reactor.advance(60)
+        self.assertEqual(4, len(self.transport.payloads))
+
+    def test_max_backoff(self):
+        """The delay between failed exchanges is capped."""
+        self.log_helper.ignore_errors(RuntimeError)
+        exchanger = MessageExchange(self.reactor, self.mstore, self.transport,
+                                    self.identity, self.exchange_store,
+                                    self.config, max_backoff=3600)
+        self.transport.responses.extend([RuntimeError("Failed!")] * 10)
+        with mock.patch("random.uniform", side_effect=lambda a, b: b):
+            for i in range(10):
+                exchanger.exchange()
+        self.assertEqual({"failures": 10, "delay": 3600},
+                         exchanger.get_backoff_state())
+
     def test_SSL_error_exchanging_causes_failed_exchange(self):
         """
         If an SSL error occurs when exchanging, the 'exchange-failed'
@@ -1056,6 +1328,20 @@ class MessageExchangeTest(LandscapeTest):
         self.exchanger.exchange()
         self.assertEqual(123, self.mstore._persist.get("first-failure-time"))
 
+    def test_empty_result_records_failure_in_message_store(self):
+        """
+        If the transport returns no result, the failure is recorded in the
+        message store, so the messages of the payload aren't considered in
+        flight anymore.
+        """
+        self.reactor.advance(123)
+        self.transport.exchange = lambda *args, **kwargs: None
+        self.mstore.set_accepted_types(["empty"])
+        self.mstore.add({"type": "empty"})
+        self.exchanger.exchange()
+        self.assertEqual(123, self.mstore._persist.get("first-failure-time"))
+        self.assertIs(None, self.mstore._in_flight_position)
+
     def test_error_exchanging_marks_exchange_complete(self):
         """
         If a traceback occurs whilst exchanging, the exchange is still
@@ -1188,6 +1474,56 @@ class AcceptedTypesMessageExchangeTest(LandscapeTest):
         self.assertEqual(types, sorted(["typefoo"] + DEFAULT_ACCEPTED_TYPES))
 
 
+class PayloadBudgetTest(LandscapeTest):
+
+    def setUp(self):
+        super(PayloadBudgetTest, self).setUp()
+        self.budget = PayloadBudget(1000 * 1024, minimum=10 * 1024,
+                                    target_duration=60)
+
+    def test_initial_budget(self):
+        """The initial budget is a tenth of the maximum."""
+        self.assertEqual(100 * 1024, self.budget.bytes)
+
+    def test_slow_exchange(self):
+        """
+        The budget shrinks to what can be exchanged within the target
+        duration after a slow exchange.
+        """
+        self.budget.record_success(100 * 1024, 120)
+        self.assertEqual(50 * 1024, self.budget.bytes)
+
+    def test_fast_exchange(self):
+        """The budget doubles after a fast exchange of a full payload."""
+        self.budget.record_success(60 * 1024, 10)
+        self.assertEqual(200 * 1024, self.budget.bytes)
+
+    def test_fast_small_exchange(self):
+        """
+        The budget doesn't change after a fast exchange of a small payload,
+        which doesn't tell how much more could be sent.
+        """
+        self.budget.record_success(1024, 1)
+        self.assertEqual(100 * 1024, self.budget.bytes)
+
+    def test_limits(self):
+        """The budget stays between the minimum and the maximum."""
+        for i in range(10):
+            self.budget.record_success(self.budget.bytes, 1)
+        self.assertEqual(1000 * 1024, self.budget.bytes)
+        for i in range(10):
+            self.budget.record_success(self.budget.bytes, 600)
+        self.assertEqual(10 * 1024, self.budget.bytes)
+
+    def test_failure(self):
+        """The budget halves after a failed exchange."""
+        self.budget.record_failure()
+        self.assertEqual(50 * 1024, self.budget.bytes)
+        for i in range(10):
+            self.budget.record_failure()
+        self.assertEqual(10 * 1024, self.budget.bytes)
+
+
 class GetAcceptedTypesDiffTest(LandscapeTest):
 
     def test_diff_empty(self):
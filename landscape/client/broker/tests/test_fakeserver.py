@@ -0,0 +1,190 @@
+from io import BytesIO
+
+from twisted.internet import reactor
+from twisted.web import client
+from twisted.web.http_headers import Headers
+
+from landscape.lib import bpickle
+from landscape.lib.schema import Int
+from landscape.lib.testing import FakeReactor
+from landscape.message_schemas.message import Message
+from landscape.client.broker.fakeserver import (
+    FakeMessageServer, get_site, hash_types)
+from landscape.client.broker.transport import AsyncHTTPTransport
+from landscape.client.broker.tests.helpers import ExchangeHelper
+from landscape.client.tests.helpers import LandscapeTest
+
+
+class FakeMessageServerTest(LandscapeTest):
+
+    def setUp(self):
+        super(FakeMessageServerTest, self).setUp()
+        self.server = FakeMessageServer(["load-average", "test"])
+
+    def exchange(self, computer_id="secure", **payload):
+        payload.setdefault("accepted-types",
+                           hash_types(["load-average", "test"]))
+        return self.server.exchange(payload, computer_id=computer_id)
+
+    def test_receive_messages(self):
+        """
+        The messages sent by a computer are kept, and the next expected
+        sequence number is returned.
+        """
+        result = self.exchange(sequence=0, messages=[{"type": "test"}])
+        self.assertEqual(1, result["next-expected-sequence"])
+        self.assertEqual([{"type": "test"}],
+                         self.server.get_computer("secure").messages)
+        self.assertEqual(1, self.server.received)
+
+    def test_duplicate_messages(self):
+        """Messages which were already received are skipped."""
+        self.exchange(sequence=0, messages=[{"type": "test", "n": 0}])
+        result = self.exchange(
+            sequence=0, messages=[{"type": "test", "n": 0},
+                                  {"type": "test", "n": 1}])
+        self.assertEqual(2, result["next-expected-sequence"])
+        self.assertEqual([{"type": "test", "n": 0}, {"type": "test", "n": 1}],
+                         self.server.get_computer("secure").messages)
+
+    def test_missing_messages(self):
+        """
+        Messages following missing ones are ignored, and the sequence number
+        of the first missing message is returned.
+        """
+        result = self.exchange(sequence=3, messages=[{"type": "test"}])
+        self.assertEqual(0, result["next-expected-sequence"])
+        self.assertEqual([], self.server.get_computer("secure").messages)
+
+    def test_accepted_types(self):
+        """
+        An C{accepted-types} message is sent to computers which don't know
+        the accepted types, until they acknowledge it.
+        """
+        accepted_types = {"type": "accepted-types",
+                          "types": ["load-average", "test"]}
+        result = self.exchange(**{"accepted-types": b"old"})
+        self.assertEqual([accepted_types], result["messages"])
+        result = self.exchange(**{"accepted-types": b"old"})
+        self.assertEqual([accepted_types], result["messages"])
+        result = self.exchange(**{"next-expected-sequence": 1})
+        self.assertEqual([], result["messages"])
+
+    def test_queue_message(self):
+        """
+        Queued messages are sent until the computer acknowledges them, and
+        pings with its insecure ID report them.
+        """
+        secure_id, insecure_id = self.server.register("secure")
+        self.assertTrue(self.server.ping(insecure_id))
+        self.exchange(secure_id, **{"next-expected-sequence": 1})
+        self.assertFalse(self.server.ping(insecure_id))
+        self.server.queue_message(secure_id, {"type": "resynchronize"})
+        self.assertTrue(self.server.ping(insecure_id))
+        self.assertFalse(self.server.ping(insecure_id + 1))
+        result = self.exchange(secure_id, **{"next-expected-sequence": 1})
+        self.assertEqual([{"type": "resynchronize"}], result["messages"])
+        self.exchange(secure_id, **{"next-expected-sequence": 2})
+        self.assertFalse(self.server.ping(insecure_id))
+
+    def test_register(self):
+        """
+        Computers sending a C{register} message are given new IDs, and their
+        sequence numbers go on with their new secure ID.
+        """
+        result = self.exchange(
+            None, sequence=0, messages=[{"type": "register"}])
+        [set_id] = result["messages"]
+        self.assertEqual("set-id", set_id["type"])
+        self.assertEqual(1, set_id["insecure-id"])
+        self.assertEqual({1: set_id["id"]}, self.server.insecure_ids)
+        self.assertEqual(
+            [{"type": "register"}],
+            self.server.get_computer(set_id["id"]).messages)
+        self.assertNotIn(None, self.server.computers)
+
+    def test_client_accepted_types(self):
+        """The digest of the types accepted by the computer is returned."""
+        result = self.exchange(**{"client-accepted-types": ["b", "a"]})
+        self.assertEqual(hash_types(["a", "b"]),
+                         result["client-accepted-types-hash"])
+        self.assertEqual(hash_types(["a", "b"]),
+                         self.exchange()["client-accepted-types-hash"])
+
+
+class FakeMessageServerExchangeTest(LandscapeTest):
+
+    helpers = [ExchangeHelper]
+
+    def setUp(self):
+        super(FakeMessageServerExchangeTest, self).setUp()
+        self.mstore.add_schema(Message("data", {"data": Int()}))
+        self.server = FakeMessageServer(["data"], server_uuid=u"uuid")
+        self.exchanger._transport = self.server
+        self.identity.secure_id = "secure"
+
+    def test_exchange(self):
+        """
+        A L{MessageExchange} can use the server as its transport, and gets
+        its messages delivered once it learned the accepted types.
+        """
+        self.exchanger.exchange()
+        self.assertEqual(["data"], self.mstore.get_accepted_types())
+        self.assertEqual(u"uuid", self.mstore.get_server_uuid())
+        self.assertEqual(1, self.mstore.get_server_sequence())
+        self.mstore.add({"type": "data", "data": 42})
+        self.exchanger.exchange()
+        self.assertEqual([], self.mstore.get_pending_messages())
+        [message] = self.server.get_computer("secure").messages
+        self.assertEqual(42, message["data"])
+        self.assertEqual([], self.server.get_computer("secure").outgoing)
+
+
+class FakeMessageServerSiteTest(LandscapeTest):
+
+    def setUp(self):
+        super(FakeMessageServerSiteTest, self).setUp()
+        self.server = FakeMessageServer(["data"])
+        self.port = reactor.listenTCP(0, get_site(self.server),
+                                      interface="127.0.0.1")
+        self.addCleanup(self.port.stopListening)
+        self.url = "http://localhost:%d" % (self.port.getHost().port,)
+
+    def test_message_system(self):
+        """The site serves exchanges at C{/message-system}."""
+        transport = AsyncHTTPTransport(
+            FakeReactor(), self.url + "/message-system")
+        self.addCleanup(transport.close)
+        payload = {"sequence": 0, "messages": [{"type": "data", "data": 1}],
+                   "accepted-types": hash_types(["data"])}
+        result = transport.exchange(payload, computer_id="secure")
+
+        def got_result(response):
+            self.assertEqual(1, response["next-expected-sequence"])
+            self.assertEqual(["gzip"], response["accepted-content-encodings"])
+            self.assertEqual(1, self.server.received)
+
+        return result.addCallback(got_result)
+
+    def test_ping(self):
+        """
+        The site serves pings at C{/ping}, telling whether messages are
+        queued for the computer with the given insecure ID.
+        """
+        secure_id, insecure_id = self.server.register(None)
+        self.server.queue_message(secure_id, {"type": "resynchronize"})
+        pool = client.HTTPConnectionPool(reactor, persistent=False)
+        agent = client.Agent(reactor, pool=pool)
+        body = client.FileBodyProducer(
+            BytesIO(b"insecure_id=%d" % (insecure_id,)))
+        result = agent.request(
+            b"POST", (self.url + "/ping").encode("ascii"),
+            Headers({b"content-type":
+                     [b"application/x-www-form-urlencoded"]}),
+            body)
+        result.addCallback(client.readBody)
+
+        def got_body(data):
+            self.assertEqual({"messages": True}, bpickle.loads(data))
+
+        return result.addCallback(got_body)
@@ -0,0 +1,155 @@
+from landscape.client.broker.merging import (
+    merge_lists, merge_dicts_of_lists, merge_custom_graphs, supersede,
+    update, get_mergers, MERGERS, SUPERSEDERS)
+from landscape.client.tests.helpers import LandscapeTest
+
+
+class MergeListsTest(LandscapeTest):
+
+    def setUp(self):
+        super(MergeListsTest, self).setUp()
+        self.merge = merge_lists("load-averages", max_items=3)
+
+    def test_merge(self):
+        """The samples of the new message are appended to the pending ones.
+        """
+        pending = {"type": "load-average", "load-averages": [(1, 0.5)]}
+        new = {"type": "load-average", "load-averages": [(2, 1.0)]}
+        self.assertEqual(
+            {"type": "load-average", "load-averages": [(1, 0.5), (2, 1.0)]},
+            self.merge(pending, new))
+        self.assertEqual([(1, 0.5)], pending["load-averages"])
+
+    def test_too_many_items(self):
+        """Messages aren't merged if they'd have too many samples."""
+        pending = {"type": "load-average",
+                   "load-averages": [(1, 0.5), (2, 0.5)]}
+        new = {"type": "load-average", "load-averages": [(3, 1.0), (4, 1.0)]}
+        self.assertIs(None, self.merge(pending, new))
+
+
+class MergeDictsOfListsTest(LandscapeTest):
+
+    def setUp(self):
+        super(MergeDictsOfListsTest, self).setUp()
+        self.merge = merge_dicts_of_lists("activities", max_items=2)
+
+    def test_merge(self):
+        """The samples of each series are appended to the pending ones."""
+        pending = {"type": "network-activity",
+                   "activities": {b"eth0": [(1, 10, 20)]}}
+        new = {"type": "network-activity",
+               "activities": {b"eth0": [(2, 30, 40)], b"lo": [(2, 1, 1)]}}
+        self.assertEqual(
+            {"type": "network-activity",
+             "activities": {b"eth0": [(1, 10, 20), (2, 30, 40)],
+                            b"lo": [(2, 1, 1)]}},
+            self.merge(pending, new))
+
+    def test_too_many_items(self):
+        """Messages aren't merged if a series would have too many samples."""
+        pending = {"type": "network-activity",
+                   "activities": {b"eth0": [(1, 10, 20), (2, 10, 20)]}}
+        new = {"type": "network-activity",
+               "activities": {b"eth0": [(3, 30, 40)]}}
+        self.assertIs(None, self.merge(pending, new))
+
+
+class MergeCustomGraphsTest(LandscapeTest):
+
+    def setUp(self):
+        super(MergeCustomGraphsTest, self).setUp()
+        self.merge = merge_custom_graphs(max_items=2)
+
+    def test_merge(self):
+        """
+        The values of each graph are appended to the pending ones, and the
+        error is the newest one.
+        """
+        pending = {"type": "custom-graph",
+                   "data": {1: {"values": [(1.0, 1.0)], "error": u"oops",
+                                "script-hash": b"hash"}}}
+        new = {"type": "custom-graph",
+               "data": {1: {"values": [(2.0, 2.0)], "error": u"",
+                            "script-hash": b"hash"},
+                        2: {"values": [], "error": u"",
+                            "script-hash": b"other"}}}
+        self.assertEqual(
+            {"type": "custom-graph",
+             "data": {1: {"values": [(1.0, 1.0), (2.0, 2.0)], "error": u"",
+                          "script-hash": b"hash"},
+                      2: {"values": [], "error": u"",
+                          "script-hash": b"other"}}},
+            self.merge(pending, new))
+
+    def test_script_changed(self):
+        """Graphs whose script changed can't be merged."""
+        pending = {"type": "custom-graph",
+                   "data": {1: {"values": [(1.0, 1.0)], "error": u"",
+                                "script-hash": b"hash"}}}
+        new = {"type": "custom-graph",
+               "data": {1: {"values": [(2.0, 2.0)], "error": u"",
+                            "script-hash": b"new-hash"}}}
+        self.assertIs(None, self.merge(pending, new))
+
+    def test_too_many_items(self):
+        """Messages aren't merged if a graph would have too many values."""
+        graph = {"values": [(1.0, 1.0), (2.0, 2.0)], "error": u"",
+                 "script-hash": b"hash"}
+        self.assertIs(None, self.merge({"data": {1: graph}},
+                                       {"data": {1: graph}}))
+
+
+class SupersedeTest(LandscapeTest):
+
+    def test_supersede(self):
+        """The new message replaces the pending one."""
+        self.assertEqual(
+            {"type": "distribution-info", "release": u"20.04"},
+            supersede({"type": "distribution-info", "release": u"18.04",
+                       "code-name": u"bionic"},
+                      {"type": "distribution-info", "release": u"20.04"}))
+
+    def test_update(self):
+        """The keys of the new message override the pending ones."""
+        self.assertEqual(
+            {"type": "computer-info", "hostname": u"new",
+             "total-memory": 1024},
+            update({"type": "computer-info", "hostname": u"old",
+                    "total-memory": 1024},
+                   {"type": "computer-info", "hostname": u"new"}))
+
+    def test_superseders(self):
+        """Snapshot messages are superseded."""
+        self.assertEqual(
+            {"computer-info": update, "distribution-info": supersede,
+             "processor-info": supersede, "hardware-info": supersede},
+            SUPERSEDERS)
+
+
+class GetMergersTest(LandscapeTest):
+
+    def test_get_mergers(self):
+        """
+        The mergers of the given types are returned, along with the ones
+        superseding snapshot messages.
+        """
+        expected = SUPERSEDERS.copy()
+        expected["cpu-usage"] = MERGERS["cpu-usage"]
+        self.assertEqual(expected, get_mergers(["cpu-usage"]))
+        self.assertEqual(SUPERSEDERS, get_mergers([]))
+
+    def test_get_all_mergers(self):
+        """All mergers are returned for the special C{ALL} type."""
+        self.assertEqual(dict(SUPERSEDERS, **MERGERS), get_mergers(["ALL"]))
+        self.assertEqual(
+            ["cpu-usage", "custom-graph", "load-average", "memory-info",
+             "mount-info", "network-activity"],
+            sorted(MERGERS))
+
+    def test_unknown_type(self):
+        """A C{ValueError} is raised for types which can't be merged."""
+        error = self.assertRaises(ValueError, get_mergers,
+                                  ["cpu-usage", "operation-result"])
+        self.assertEqual("Messages of type operation-result can't be merged.",
+                         str(error))
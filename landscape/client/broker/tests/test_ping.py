@@ -1,3 +1,5 @@
+import mock
+
 from landscape.client.tests.helpers import LandscapeTest
 
 from twisted.internet.defer import fail
@@ -218,6 +220,32 @@ class PingerTest(LandscapeTest):
         self.assertIn("ZeroDivisionError", log)
         self.assertIn("Couldn't fetch page", log)
 
+    def test_backoff_after_errors(self):
+        """
+        After consecutive failed pings, pings are delayed by an increasing
+        random amount of time, until a ping succeeds.
+        """
+        self.log_helper.ignore_errors(AssertionError)
+        self.identity.insecure_id = 42
+        self.page_getter.response = {"messages": False}
+        self.pinger.start()
+        ping_client = self.pinger._ping_client
+        ping_client.get_page = self.page_getter.failing_get_page
+        with mock.patch("random.uniform", side_effect=lambda a, b: b):
+            self.reactor.advance(10)
+            self.assertEqual({"failures": 1, "delay": 30},
+                             self.pinger.get_backoff_state())
+            self.reactor.advance(30)
+        self.assertEqual({"failures": 2, "delay": 90},
+                         self.pinger.get_backoff_state())
+        ping_client.get_page = self.page_getter.get_page
+        self.reactor.advance(89)
+        self.assertEqual(0, len(self.page_getter.fetches))
+        self.reactor.advance(1)
+        self.assertEqual(1, len(self.page_getter.fetches))
+        self.assertEqual({"failures": 0, "delay": None},
+                         self.pinger.get_backoff_state())
+
     def test_get_interval(self):
         self.assertEqual(self.pinger.get_interval(), 10)
 
@@ -130,6 +130,64 @@ class BrokerServerTest(LandscapeTest):
         self.assertMessages(self.mstore.get_pending_messages(), [message])
         self.assertTrue(self.exchanger.is_urgent())
 
+    def test_send_messages(self):
+        """
+        The L{BrokerServer.send_messages} method forwards several messages to
+        the broker's exchanger, and returns their identifiers.
+        """
+        messages = [{"type": "test"}, {"type": "test"}]
+        self.mstore.set_accepted_types(["test"])
+        session_id = self.broker.get_session_id()
+        message_ids = self.broker.send_messages(messages, session_id)
+        self.assertEqual(2, len(message_ids))
+        self.assertTrue(all(self.mstore.are_pending(message_ids)))
+        self.assertMessages(self.mstore.get_pending_messages(), messages)
+        self.assertFalse(self.exchanger.is_urgent())
+
+    def test_send_messages_with_urgent(self):
+        """
+        The L{BrokerServer.send_messages} can optionally specify the urgency
+        of the messages.
+        """
+        self.mstore.set_accepted_types(["test"])
+        session_id = self.broker.get_session_id()
+        self.broker.send_messages([{"type": "test"}], session_id, urgent=True)
+        self.assertTrue(self.exchanger.is_urgent())
+
+    def test_send_messages_with_invalid_message(self):
+        """
+        Messages which can't be queued don't prevent the others from being
+        queued, and the description of their error is returned instead of
+        their identifier.
+        """
+        self.mstore.set_accepted_types(["test"])
+        session_id = self.broker.get_session_id()
+        messages = [{"type": "test", "sequence": "bad"}, {"type": "test"}]
+        [error, message_id] = self.broker.send_messages(messages, session_id)
+        self.assertIsInstance(error, type(u""))
+        self.assertTrue(self.mstore.is_pending(message_id))
+        self.assertMessages(self.mstore.get_pending_messages(),
+                            [{"type": "test"}])
+
+    def test_send_messages_wont_send_with_invalid_session_id(self):
+        """
+        The L{BrokerServer.send_messages} call drops the messages if their
+        session ID isn't valid anymore.
+        """
+        self.mstore.set_accepted_types(["test"])
+        self.assertEqual(
+            [None, None],
+            self.broker.send_messages([{"type": "test"}] * 2, "Not Valid"))
+        self.assertMessages(self.mstore.get_pending_messages(), [])
+
+    def test_send_messages_with_none_as_session_id_raises(self):
+        """
+        Like L{BrokerServer.send_message}, L{BrokerServer.send_messages}
+        raises if the session ID wasn't set.
+        """
+        self.assertRaises(
+            RuntimeError, self.broker.send_messages, [{"type": "test"}], None)
+
     def test_is_pending(self):
         """
         The L{BrokerServer.is_pending} method indicates if a message with
@@ -142,6 +200,21 @@ class BrokerServerTest(LandscapeTest):
         message_id = self.broker.send_message(message, session_id)
         self.assertTrue(self.broker.is_message_pending(message_id))
 
+    def test_are_messages_pending(self):
+        """
+        The L{BrokerServer.are_messages_pending} method tells which of the
+        messages with the given ids are pending, in a single call.
+        """
+        self.mstore.set_accepted_types(["test"])
+        session_id = self.broker.get_session_id()
+        message_id1 = self.broker.send_message({"type": "test"}, session_id)
+        message_id2 = self.broker.send_message({"type": "test"}, session_id)
+        self.mstore.set_pending_offset(1)
+        self.assertEqual(
+            [False, True, False],
+            self.broker.are_messages_pending(
+                [message_id1, message_id2, 123]))
+
     def test_register_client(self):
         """
         The L{BrokerServer.register_client} method can be used to register
@@ -262,6 +335,25 @@ class BrokerServerTest(LandscapeTest):
         self.mstore.set_server_uuid("the-uuid")
         self.assertEqual(self.broker.get_server_uuid(), "the-uuid")
 
+    def test_get_exchange_timings(self):
+        """
+        The L{BrokerServer.get_exchange_timings} method returns how long
+        the phases of recent exchanges took.
+        """
+        self.assertEqual({}, self.broker.get_exchange_timings())
+        self.exchanger.exchange()
+        self.assertIn("payload", self.broker.get_exchange_timings())
+
+    def test_get_backoff_state(self):
+        """
+        The L{BrokerServer.get_backoff_state} method returns the backoff
+        state of the exchanges and of the pings.
+        """
+        self.assertEqual(
+            {"exchange": {"failures": 0, "delay": None},
+             "ping": {"failures": 0, "delay": None}},
+            self.broker.get_backoff_state())
+
     def test_register_client_accepted_message_type(self):
         """
         The L{BrokerServer.register_client_accepted_message_type} method can
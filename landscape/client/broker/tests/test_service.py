@@ -5,7 +5,8 @@ from mock import Mock
 from landscape.client.tests.helpers import LandscapeTest
 from landscape.client.broker.tests.helpers import BrokerConfigurationHelper
 from landscape.client.broker.service import BrokerService
-from landscape.client.broker.transport import HTTPTransport
+from landscape.client.broker.transport import (
+    HTTPTransport, AsyncHTTPTransport)
 from landscape.client.broker.amp import RemoteBrokerConnector
 from landscape.lib.testing import FakeReactor
 
@@ -37,6 +38,27 @@ class BrokerServiceTest(LandscapeTest):
         self.assertTrue(isinstance(self.service.transport, HTTPTransport))
         self.assertEqual(self.service.transport.get_url(), self.config.url)
 
+    def test_twisted_transport(self):
+        """
+        The asynchronous transport is used if selected with the
+        C{http_transport} option.
+        """
+        self.config.http_transport = "twisted"
+        service = BrokerService(self.config)
+        self.addCleanup(service.transport.close)
+        self.assertTrue(isinstance(service.transport, AsyncHTTPTransport))
+        self.assertEqual(service.transport.get_url(), self.config.url)
+
+    def test_stop_closes_transport(self):
+        """
+        Stopping the service closes the transport, and returns what closing
+        it returns, so that asynchronous transports can be waited for.
+        """
+        self.service.transport.close = Mock(return_value="closed")
+        self.service.startService()
+        self.assertEqual("closed", self.service.stopService())
+        self.service.transport.close.assert_called_once_with()
+
     def test_message_store(self):
         """
         A L{BrokerService} instance has a proper C{message_store} attribute.
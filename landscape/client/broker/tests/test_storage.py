@@ -0,0 +1,414 @@
+import os
+
+import mock
+
+from landscape.lib.bpickle import dumps, loads
+from landscape.client.broker.storage import (
+    FileMessageStorage, SQLiteMessageStorage, migrate_messages,
+    get_message_storage, compress_message, decompress_message, FILES,
+    SQLITE, NO_COMPRESSION, ZLIB, LZMA, COMPRESSIONS)
+from landscape.client.tests.helpers import LandscapeTest
+
+
+class MessageStorageTestMixin(object):
+    """Tests shared by all the message storage engines."""
+
+    def test_walk_empty(self):
+        """An empty storage yields no entries."""
+        self.assertEqual([], list(self.storage.walk()))
+
+    def test_add_and_read(self):
+        """Added messages can be read back using their key."""
+        key = self.storage.add(b"data", type="test")
+        self.assertEqual(b"data", self.storage.read(key))
+
+    def test_walk_in_order(self):
+        """Entries are walked in the order they were added."""
+        keys = [self.storage.add(dumps(i)) for i in range(25)]
+        self.assertEqual([(key, "") for key in keys],
+                         list(self.storage.walk()))
+
+    def test_add_with_flags(self):
+        """Flags can be set when adding a message."""
+        self.storage.add(b"data", flags="h")
+        [(key, flags)] = list(self.storage.walk())
+        self.assertEqual("h", flags)
+        self.assertEqual(b"data", self.storage.read(key))
+
+    def test_walk_exclude(self):
+        """Entries having any of the excluded flags are skipped."""
+        self.storage.add(b"1", flags="h")
+        key2 = self.storage.add(b"2")
+        self.storage.add(b"3", flags="b")
+        key4 = self.storage.add(b"4", flags="x")
+        self.assertEqual([(key2, ""), (key4, "x")],
+                         list(self.storage.walk(exclude="hb")))
+
+    def test_set_flags(self):
+        """Flags can be changed, possibly changing the entry key."""
+        key = self.storage.add(b"data")
+        key = self.storage.set_flags(key, "hb")
+        self.assertEqual([(key, "bh")], list(self.storage.walk()))
+        key = self.storage.set_flags(key, "")
+        self.assertEqual([(key, "")], list(self.storage.walk()))
+        self.assertEqual(b"data", self.storage.read(key))
+
+    def test_get_id_is_stable(self):
+        """Message ids don't change when flags change or when requeuing."""
+        key = self.storage.add(b"data")
+        self.storage.add(b"other")
+        message_id = self.storage.get_id(key)
+        key = self.storage.set_flags(key, "h")
+        self.assertEqual(message_id, self.storage.get_id(key))
+        key = self.storage.requeue(key, "")
+        self.assertEqual(message_id, self.storage.get_id(key))
+
+    def test_requeue(self):
+        """Requeued entries are moved at the end of the queue."""
+        key1 = self.storage.add(b"1", flags="h")
+        key2 = self.storage.add(b"2")
+        key1 = self.storage.requeue(key1, "")
+        self.assertEqual([(key2, ""), (key1, "")], list(self.storage.walk()))
+        self.assertEqual(b"1", self.storage.read(key1))
+
+    def test_get_size(self):
+        """The size of a stored message can be retrieved."""
+        key = self.storage.add(b"data")
+        self.assertEqual(4, self.storage.get_size(key))
+
+    def test_delete(self):
+        """Deleted entries are removed from the queue."""
+        key1 = self.storage.add(b"1")
+        key2 = self.storage.add(b"2")
+        self.storage.delete(key1)
+        self.assertEqual([(key2, "")], list(self.storage.walk()))
+
+    def test_begin_and_commit(self):
+        """
+        Changes made between C{begin} and C{commit} are visible right away.
+        """
+        self.storage.begin()
+        key1 = self.storage.add(b"1")
+        key2 = self.storage.add(b"2", flags="h")
+        self.assertEqual([b"1", b"2"],
+                         [self.storage.read(key) for key, _ in
+                          self.storage.walk()])
+        self.storage.commit()
+        self.assertEqual([(key1, ""), (key2, "h")], list(self.storage.walk()))
+
+    def test_commit_without_begin(self):
+        """Calling C{commit} without C{begin} does nothing."""
+        self.storage.add(b"1")
+        self.storage.commit()
+        self.assertEqual(1, len(list(self.storage.walk())))
+
+    def test_replace(self):
+        """Replaced messages keep their position and their flags."""
+        key1 = self.storage.add(b"1", flags="h")
+        key2 = self.storage.add(b"2")
+        self.storage.replace(key1, b"3")
+        self.assertEqual([(key1, "h"), (key2, "")], list(self.storage.walk()))
+        self.assertEqual(b"3", self.storage.read(key1))
+
+    def test_delete_all(self):
+        """All entries can be removed at once."""
+        self.storage.add(b"1")
+        self.storage.add(b"2", flags="h")
+        self.storage.delete_all()
+        self.assertEqual([], list(self.storage.walk()))
+
+
+class FileMessageStorageTest(MessageStorageTestMixin, LandscapeTest):
+
+    def setUp(self):
+        super(FileMessageStorageTest, self).setUp()
+        self.directory = os.path.join(self.makeDir(), "messages")
+        self.storage = FileMessageStorage(self.directory, 10)
+
+    def test_creates_directory(self):
+        """The base directory is created if it doesn't exist."""
+        self.assertTrue(os.path.isdir(self.directory))
+
+    def test_wb_file_layout(self):
+        """
+        Messages are stored in sub-directories holding at most
+        C{directory_size} files each, with flags as file name suffix.
+        """
+        for i in range(11):
+            self.storage.add(dumps(i))
+        key = self.storage.add(b"held", flags="h")
+        self.assertEqual(os.path.join(self.directory, "1", "1_h"), key)
+        self.assertEqual(["0", "1"], sorted(os.listdir(self.directory)))
+
+    def test_add_scans_directory_once(self):
+        """
+        The file system is only scanned for the last message once, the
+        following messages are numbered from memory.
+        """
+        self.storage.add(dumps(0))
+        storage = FileMessageStorage(self.directory, 10)
+        with mock.patch("os.listdir", wraps=os.listdir) as listdir:
+            storage.add(dumps(1))
+            self.assertEqual(2, listdir.call_count)
+            for i in range(2, 11):
+                storage.add(dumps(i))
+            self.assertEqual(2, listdir.call_count)
+        self.assertEqual(list(range(11)),
+                         [loads(storage.read(key))
+                          for key, flags in storage.walk()])
+        self.assertEqual(os.path.join(self.directory, "1", "1"),
+                         storage.add(dumps(11)))
+
+    def test_add_after_removing_last_directory(self):
+        """
+        A new message is added in the directory of the last one, even if
+        it was removed along with all its files.
+        """
+        key = self.storage.add(dumps(0))
+        self.storage.delete(key)
+        key = self.storage.add(dumps(1))
+        self.assertEqual(os.path.join(self.directory, "0", "1"), key)
+        self.assertEqual(dumps(1), self.storage.read(key))
+
+    def test_add_is_durable(self):
+        """Added messages are flushed to disk, along with their directory."""
+        with mock.patch("os.fsync") as fsync:
+            self.storage.add(b"1")
+        self.assertEqual(2, fsync.call_count)
+
+    def test_commit_flushes_changes(self):
+        """
+        Files and directories changed after C{begin} are flushed to disk
+        once, when calling C{commit}, even if they were renamed.
+        """
+        with mock.patch("os.fsync") as fsync:
+            self.storage.begin()
+            for i in range(3):
+                key = self.storage.add(b"data", flags="h")
+            self.storage.set_flags(key, "")
+            self.assertEqual(0, fsync.call_count)
+            self.storage.commit()
+        # Three files and the directory holding them.
+        self.assertEqual(4, fsync.call_count)
+
+    def test_commit_limits_open_files(self):
+        """
+        Only up to C{max_unsynced_files} written files are kept open until
+        C{commit}, the previous ones are flushed to disk already, so large
+        groups of changes don't run out of file descriptors.
+        """
+        self.storage.max_unsynced_files = 2
+        with mock.patch("os.fsync") as fsync:
+            self.storage.begin()
+            for i in range(5):
+                self.storage.add(dumps(i))
+            self.assertEqual(4, fsync.call_count)
+            self.assertEqual(1, len(self.storage._unsynced_files))
+            self.storage.commit()
+        # Five files and the directory holding them.
+        self.assertEqual(6, fsync.call_count)
+
+    def test_wb_get_id_is_inode(self):
+        """The message id is the inode of the message file."""
+        key = self.storage.add(b"data")
+        self.assertEqual(os.stat(key).st_ino, self.storage.get_id(key))
+
+
+class SQLiteMessageStorageTest(MessageStorageTestMixin, LandscapeTest):
+
+    def setUp(self):
+        super(SQLiteMessageStorageTest, self).setUp()
+        self.filename = self.makeFile()
+        self.storage = SQLiteMessageStorage(self.filename)
+
+    def test_persistence(self):
+        """Messages are persisted in the database file."""
+        self.storage.add(b"1", type="test")
+        self.storage.add(b"2", flags="h")
+        storage = SQLiteMessageStorage(self.filename)
+        self.assertEqual([b"1", b"2"],
+                         [storage.read(key) for key, _ in storage.walk()])
+        self.assertEqual(["", "h"], [flags for _, flags in storage.walk()])
+
+    def test_commit_transaction(self):
+        """
+        Changes made after C{begin} are committed to the database only
+        when calling C{commit}.
+        """
+        self.storage.begin()
+        self.storage.add(b"1")
+        storage = SQLiteMessageStorage(self.filename)
+        self.assertEqual([], list(storage.walk()))
+        self.storage.commit()
+        self.assertEqual(1, len(list(storage.walk())))
+
+    def test_wb_type_is_stored(self):
+        """The message type is stored in its own indexed column."""
+        key = self.storage.add(b"1", type="test")
+        rows = list(self.storage._db.execute(
+            "SELECT type FROM message WHERE id=?", (key,)))
+        self.assertEqual([("test",)], rows)
+
+
+class MigrateMessagesTest(LandscapeTest):
+
+    def setUp(self):
+        super(MigrateMessagesTest, self).setUp()
+        self.directory = os.path.join(self.makeDir(), "messages")
+        self.filename = self.makeFile()
+
+    def test_migrate_messages(self):
+        """
+        Messages are moved to the target storage, keeping their order and
+        their flags.
+        """
+        source = FileMessageStorage(self.directory)
+        source.add(dumps({"type": "test", "data": 1}))
+        source.add(dumps({"type": "test", "data": 2}), flags="h")
+        target = SQLiteMessageStorage(self.filename)
+        self.assertEqual(2, migrate_messages(source, target))
+        self.assertEqual([], list(source.walk()))
+        entries = list(target.walk())
+        self.assertEqual(["", "h"], [flags for _, flags in entries])
+        self.assertEqual(
+            [dumps({"type": "test", "data": 1}),
+             dumps({"type": "test", "data": 2})],
+            [target.read(key) for key, _ in entries])
+
+    def test_migrate_messages_commits_before_deleting(self):
+        """
+        Messages are added to the target storage in a commit, and only
+        deleted from the source storage after it, so an interrupted
+        migration doesn't lose any of them.
+        """
+        source = FileMessageStorage(self.directory)
+        source.add(dumps({"type": "test", "data": 1}))
+        source.add(dumps({"type": "test", "data": 2}))
+        target = SQLiteMessageStorage(self.filename)
+        with mock.patch.object(target, "add",
+                               side_effect=[None, RuntimeError()]):
+            self.assertRaises(RuntimeError, migrate_messages, source, target)
+        self.assertEqual(2, len(list(source.walk())))
+        with mock.patch.object(target, "commit") as commit:
+            with mock.patch.object(source, "delete") as delete:
+                delete.side_effect = lambda key: commit.assert_called_once()
+                migrate_messages(source, target)
+        self.assertEqual(2, delete.call_count)
+
+    def test_migrate_messages_in_batches(self):
+        """
+        Messages are added to the target storage in batches, each of them
+        committed before its messages are deleted from the source storage.
+        """
+        source = FileMessageStorage(self.directory)
+        for i in range(5):
+            source.add(dumps({"type": "test", "data": i}))
+        target = SQLiteMessageStorage(self.filename)
+        commits = []
+        with mock.patch.object(target, "commit") as commit:
+            commit.side_effect = lambda: commits.append(
+                len(list(source.walk())))
+            self.assertEqual(5, migrate_messages(source, target, 2))
+        self.assertEqual([5, 3, 1], commits)
+        self.assertEqual([], list(source.walk()))
+        self.assertEqual(
+            [{"type": "test", "data": i} for i in range(5)],
+            [loads(target.read(key)) for key, _ in target.walk()])
+
+    def test_migrate_messages_logs_id_change(self):
+        """
+        The migration logs that the identifiers of the messages changed.
+        """
+        source = FileMessageStorage(self.directory)
+        source.add(dumps({"type": "test", "data": 1}))
+        migrate_messages(source, SQLiteMessageStorage(self.filename))
+        self.assertIn("The identifiers of the migrated messages changed",
+                      self.logfile.getvalue())
+
+    def test_migrate_compressed_messages(self):
+        """
+        Compressed messages are migrated as they are, and the type of the
+        message is still stored.
+        """
+        data = compress_message(dumps({"type": "test", "data": "x" * 100}),
+                                ZLIB)
+        source = FileMessageStorage(self.directory)
+        source.add(data)
+        target = SQLiteMessageStorage(self.filename)
+        migrate_messages(source, target)
+        [(key, flags)] = list(target.walk())
+        self.assertEqual(data, target.read(key))
+        rows = list(target._db.execute("SELECT type FROM message"))
+        self.assertEqual([("test",)], rows)
+
+    def test_migrate_broken_messages(self):
+        """Messages that can't be decoded are migrated anyway."""
+        source = SQLiteMessageStorage(self.filename)
+        source.add(b"broken", flags="b")
+        target = FileMessageStorage(self.directory)
+        self.assertEqual(1, migrate_messages(source, target))
+        [(key, flags)] = list(target.walk())
+        self.assertEqual("b", flags)
+        self.assertEqual(b"broken", target.read(key))
+
+    def test_get_message_storage(self):
+        """
+        L{get_message_storage} returns the storage for the given engine,
+        migrating messages left in the storage of the other engine.
+        """
+        storage = get_message_storage(FILES, self.directory, self.filename)
+        storage.add(dumps({"type": "test"}))
+        storage = get_message_storage(SQLITE, self.directory, self.filename)
+        self.assertIsInstance(storage, SQLiteMessageStorage)
+        self.assertEqual(1, len(list(storage.walk())))
+        storage = get_message_storage(FILES, self.directory, self.filename)
+        self.assertIsInstance(storage, FileMessageStorage)
+        self.assertEqual(1, len(list(storage.walk())))
+
+    def test_get_message_storage_unknown_engine(self):
+        """An unknown engine name results in a C{ValueError}."""
+        self.assertRaises(ValueError, get_message_storage, "foo",
+                          self.directory, self.filename)
+
+
+class CompressionTest(LandscapeTest):
+
+    data = dumps({"type": "test", "data": "data" * 100})
+
+    def test_no_compression(self):
+        """Messages are left as they are when compression is disabled."""
+        self.assertEqual(self.data,
+                         compress_message(self.data, NO_COMPRESSION))
+
+    def test_zlib(self):
+        """
+        Messages compressed with zlib are smaller and start with a header
+        byte, which is stripped when decompressing them.
+        """
+        compressed = compress_message(self.data, ZLIB)
+        self.assertTrue(len(compressed) < len(self.data))
+        self.assertEqual(b"\x01", compressed[:1])
+        self.assertEqual(self.data, decompress_message(compressed))
+
+    def test_lzma(self):
+        """Messages can be compressed with lzma."""
+        if LZMA not in COMPRESSIONS:
+            self.skipTest("lzma is not available.")
+        compressed = compress_message(self.data, LZMA)
+        self.assertTrue(len(compressed) < len(self.data))
+        self.assertEqual(b"\x02", compressed[:1])
+        self.assertEqual(self.data, decompress_message(compressed))
+
+    def test_compression_not_smaller(self):
+        """Messages are left as they are if compression doesn't help."""
+        data = dumps({"type": "test"})
+        self.assertEqual(data, compress_message(data, ZLIB))
+
+    def test_decompress_uncompressed(self):
+        """Uncompressed messages are returned as they are."""
+        self.assertEqual(self.data, decompress_message(self.data))
+
+    def test_decompress_corrupted(self):
+        """A C{ValueError} is raised for corrupted compressed messages."""
+        compressed = compress_message(self.data, ZLIB)
+        self.assertRaises(ValueError, decompress_message, compressed[:-10])
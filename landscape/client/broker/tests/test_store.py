@@ -6,15 +6,23 @@ from twisted.python.compat import intToBytes
 
 from landscape.lib.bpickle import dumps
 from landscape.lib.persist import Persist
-from landscape.lib.schema import InvalidError, Int, Bytes, Unicode
+from landscape.lib.schema import (
+    InvalidError, Int, Float, Bytes, Unicode, List, Tuple)
+from landscape.lib.testing import FakeReactor
 from landscape.message_schemas.message import Message
-from landscape.client.broker.store import MessageStore
+from landscape.client.broker.store import (
+    MessageStore, StoredMessage, LOW_PRIORITY)
+from landscape.client.broker.merging import get_mergers
+from landscape.client.broker.storage import (
+    SQLiteMessageStorage, NO_COMPRESSION, ZLIB, compress_message)
 
 from landscape.client.tests.helpers import LandscapeTest
 
 
 class MessageStoreTest(LandscapeTest):
 
+    compression = NO_COMPRESSION
+
     def setUp(self):
         super(MessageStoreTest, self).setUp()
         self.temp_dir = self.makeDir()
@@ -23,7 +31,8 @@ class MessageStoreTest(LandscapeTest):
 
     def create_store(self):
         persist = Persist(filename=self.persist_filename)
-        store = MessageStore(persist, self.temp_dir, 20)
+        store = MessageStore(persist, self.temp_dir, 20,
+                             compression=self.compression)
         store.set_accepted_types(["empty", "data", "resynchronize"])
         store.add_schema(Message("empty", {}))
         store.add_schema(Message("empty2", {}))
@@ -145,6 +154,51 @@ class MessageStoreTest(LandscapeTest):
                               "data": b"A thing",
                               "api": b"3.2"}])
 
+    def test_get_pending_stored_messages(self):
+        """
+        L{MessageStore.get_pending_stored_messages} returns the pending
+        messages as L{StoredMessage}s, holding the stored bytes.
+        """
+        self.store.add({"type": "data", "data": b"A thing"})
+        [message] = self.store.get_pending_stored_messages()
+        self.assertIsInstance(message, StoredMessage)
+        self.assertEqual(
+            dumps({"type": "data", "data": b"A thing", "api": b"3.2"}),
+            message.data)
+        self.assertEqual("data", message["type"])
+        self.assertEqual(b"3.2", message["api"])
+        self.assertEqual(
+            {"type": "data", "data": b"A thing", "api": b"3.2"}, message)
+
+    def test_stored_message_dumps_verbatim(self):
+        """
+        L{bpickle.dumps} embeds the serialized data of a L{StoredMessage} as
+        is, producing the same bytes as the decoded message would.
+        """
+        message = StoredMessage(dumps({"type": "data"}), "data", None)
+        self.assertEqual(dumps({"messages": [{"type": "data"}]}),
+                         dumps({"messages": [message]}))
+
+    def test_wb_stored_message_is_decoded_lazily(self):
+        """
+        The C{type} and C{api} of a L{StoredMessage} are available without
+        decoding the stored data.
+        """
+        message = StoredMessage(b"not bpickle data", "data", b"3.2")
+        self.assertEqual("data", message["type"])
+        self.assertEqual(b"3.2", message["api"])
+        self.assertIs(None, message._message)
+
+    def test_wb_get_pending_stored_messages_is_lazy(self):
+        """
+        Only the keys needed to filter pending messages get decoded.
+        """
+        self.store.add({"type": "data", "data": b"A thing"})
+        with mock.patch("landscape.lib.bpickle.loads") as loads:
+            [message] = self.store.get_pending_stored_messages()
+        self.assertFalse(loads.called)
+        self.assertEqual("data", message["type"])
+
     def test_max_pending(self):
         for i in range(10):
             self.store.add(dict(type="data", data=intToBytes(i)))
@@ -410,6 +464,62 @@ class MessageStoreTest(LandscapeTest):
             self.store.get_pending_messages(),
             [{"type": "data", "api": b"3.2", "data": b"foo"}])
 
+    def test_get_pending_stored_messages_max_bytes(self):
+        """
+        The size of the returned messages can be limited, but at least one
+        message is returned.
+        """
+        for i in range(3):
+            self.store.add({"type": "data", "data": b"data"})
+        [message] = self.store.get_pending_stored_messages(1)
+        size = len(message.data)
+        self.assertEqual(
+            2, len(self.store.get_pending_stored_messages(
+                max_bytes=size * 3 - 1)))
+        self.assertEqual(
+            1, len(self.store.get_pending_stored_messages(max_bytes=1)))
+
+    def test_schema_resolution_is_cached(self):
+        """
+        The schema to apply to a message type is resolved only once for a
+        given server API, and so are the APIs of pending messages.
+        """
+        self.store.add({"type": "data", "data": b"foo"})
+        self.store.get_pending_messages()
+        with mock.patch("landscape.client.broker.store.sort_versions") as \
+                sort_versions, \
+                mock.patch("landscape.client.broker.store.is_version_higher") \
+                as is_version_higher:
+            self.store.add({"type": "data", "data": b"bar"})
+            self.assertEqual(2, len(self.store.get_pending_messages()))
+        sort_versions.assert_not_called()
+        is_version_higher.assert_not_called()
+
+    def test_add_schema_clears_schema_resolution(self):
+        """
+        Adding a schema makes the store resolve again the schema to apply
+        to messages.
+        """
+        self.store.add({"type": "data", "data": b"foo"})
+        self.store.add_schema(Message("data", {"data": Int()}))
+        self.store.add({"type": "data", "data": 123})
+        self.assertEqual(
+            [{"type": "data", "api": b"3.2", "data": b"foo"},
+             {"type": "data", "api": b"3.2", "data": 123}],
+            self.store.get_pending_messages())
+
+    def test_set_server_api_clears_api_resolution(self):
+        """
+        Changing the server API makes the store check again the API of
+        pending messages.
+        """
+        self.store.set_accepted_types(["data"])
+        self.store.set_server_api(b"3.3")
+        self.store.add({"type": "data", "data": b"foo"})
+        self.assertEqual(1, len(self.store.get_pending_messages()))
+        self.store.set_server_api(b"3.2")
+        self.assertEqual([], self.store.get_pending_messages())
+
     def test_count_pending_messages(self):
         """It is possible to get the total number of pending messages."""
         self.assertEqual(self.store.count_pending_messages(), 0)
@@ -418,6 +528,55 @@ class MessageStoreTest(LandscapeTest):
         self.store.add({"type": "data", "data": b"yay"})
         self.assertEqual(self.store.count_pending_messages(), 2)
 
+    def test_count_pending_messages_with_held_and_broken(self):
+        """Held and broken messages are not counted as pending."""
+        self.log_helper.ignore_errors(ValueError)
+        self.store.add({"type": "empty"})
+        self.store.add({"type": "unaccepted", "data": b"blah"})
+        self.store.add({"type": "empty"})
+        self.store.add({"type": "empty"})
+        self.assertEqual(3, self.store.count_pending_messages())
+        with open(os.path.join(self.temp_dir, "0", "0"), "w") as fh:
+            fh.write("bpickle will break reading this")
+        self.store.get_pending_messages()
+        self.assertEqual(2, self.store.count_pending_messages())
+        self.store.set_pending_offset(1)
+        self.assertEqual(1, self.store.count_pending_messages())
+        self.store.set_pending_offset(3)
+        self.assertEqual(0, self.store.count_pending_messages())
+
+    def test_wb_count_pending_messages_does_not_scan_storage(self):
+        """
+        The messages in the storage are indexed only once, after that the
+        index is updated incrementally and pending messages are counted and
+        located without scanning the storage.
+        """
+        self.store.add({"type": "empty"})
+        self.store.add({"type": "unaccepted", "data": b"blah"})
+        walk = self.store._storage.walk
+        self.store._storage.walk = mock.Mock(side_effect=AssertionError)
+        self.store.add({"type": "data", "data": b"yay"})
+        self.store.set_pending_offset(1)
+        self.assertEqual(1, self.store.count_pending_messages())
+        self.assertEqual([b"yay"], [message["data"] for message in
+                                    self.store.get_pending_messages()])
+        self.store.delete_old_messages()
+        self.store.set_pending_offset(0)
+        self.assertEqual(1, self.store.count_pending_messages())
+        self.store._storage.walk = walk
+
+    def test_index_is_loaded_from_storage(self):
+        """A new store indexes the messages already in its storage."""
+        self.store.add({"type": "empty"})
+        self.store.add({"type": "unaccepted", "data": b"blah"})
+        self.store.add({"type": "data", "data": b"yay"})
+        self.store.set_pending_offset(1)
+        self.store.commit()
+        store = self.create_store()
+        self.assertEqual(1, store.count_pending_messages())
+        store.set_accepted_types(["empty", "data", "unaccepted"])
+        self.assertEqual(2, store.count_pending_messages())
+
     def test_commit(self):
         """
         The Message Store can be told to save its persistent data to disk on
@@ -481,6 +640,46 @@ class MessageStoreTest(LandscapeTest):
 
         self.assertTrue(self.store.is_pending(id))
 
+    def test_are_pending(self):
+        """
+        L{MessageStore.are_pending} tells which of the given messages are
+        pending, considering held messages pending and unknown ids not.
+        """
+        self.store.set_accepted_types(["empty"])
+        delivered_id = self.store.add({"type": "empty"})
+        held_id = self.store.add({"type": "data", "data": b"A thing"})
+        pending_id = self.store.add({"type": "empty"})
+        self.store.set_pending_offset(1)
+        self.assertEqual(
+            [False, True, True, False],
+            self.store.are_pending(
+                [delivered_id, held_id, pending_id, 1234567]))
+        self.store.set_pending_offset(2)
+        self.assertEqual([False, True, False],
+                         self.store.are_pending(
+                             [delivered_id, held_id, pending_id]))
+
+    def test_are_pending_after_unholding(self):
+        """Message ids stay valid when held messages are released."""
+        self.store.set_accepted_types(["empty"])
+        held_id = self.store.add({"type": "data", "data": b"A thing"})
+        pending_id = self.store.add({"type": "empty"})
+        self.store.set_pending_offset(1)
+        self.store.set_accepted_types(["empty", "data"])
+        self.assertEqual([True, False],
+                         self.store.are_pending([held_id, pending_id]))
+
+    def test_wb_are_pending_loaded_messages(self):
+        """
+        Ids of messages found in the storage when the store is created are
+        looked up once, then answered from the index.
+        """
+        message_id = self.store.add({"type": "empty"})
+        store = self.create_store()
+        self.assertEqual([True], store.are_pending([message_id]))
+        store._storage.get_id = mock.Mock(side_effect=AssertionError)
+        self.assertEqual([True], store.are_pending([message_id]))
+
     def test_is_pending_with_broken_message(self):
         """When a message breaks we consider it to be no longer there."""
 
@@ -647,6 +846,8 @@ class MessageStoreTest(LandscapeTest):
             fh.write(dumps({b"type": b"data",
                             b"data": b"A thing",
                             b"api": b"3.2"}))
+        # The store indexes the messages on disk once, so recreate it.
+        self.store = self.create_store()
         [message] = self.store.get_pending_messages()
         # message keys are decoded
         self.assertIn(u"type", message)
@@ -654,3 +855,568 @@ class MessageStoreTest(LandscapeTest):
         self.assertIsInstance(message[u"api"], bytes)  # api is bytes
         self.assertEqual(u"data", message[u"type"])  # message type is decoded
         self.assertEqual(b"A thing", message[u"data"])  # other are kept as-is
+
+
+class GroupedWritesMessageStoreTest(LandscapeTest):
+    """Tests for a L{MessageStore} grouping writes made in the same tick."""
+
+    def setUp(self):
+        super(GroupedWritesMessageStoreTest, self).setUp()
+        self.reactor = FakeReactor()
+        self.storage = SQLiteMessageStorage(self.makeFile())
+        persist = Persist(filename=self.makeFile())
+        self.store = MessageStore(persist, None, storage=self.storage,
+                                  reactor=self.reactor)
+        self.store.set_accepted_types(["data"])
+        self.store.add_schema(Message("data", {"data": Bytes()}))
+
+    def test_writes_are_committed_at_the_end_of_the_tick(self):
+        """
+        The messages added within a reactor iteration are committed to the
+        storage together, at the end of the iteration.
+        """
+        with mock.patch.object(self.storage, "commit") as commit:
+            self.store.add({"type": "data", "data": b"1"})
+            self.store.add({"type": "data", "data": b"2"})
+            self.assertEqual(2, len(self.store.get_pending_messages()))
+            commit.assert_not_called()
+            self.reactor.advance(0)
+            commit.assert_called_once_with()
+            self.store.add({"type": "data", "data": b"3"})
+            self.reactor.advance(0)
+            self.assertEqual(2, commit.call_count)
+
+    def test_commit_commits_pending_writes(self):
+        """
+        Pending writes are committed when the store is committed, and not
+        again at the end of the reactor iteration.
+        """
+        with mock.patch.object(self.storage, "commit") as commit:
+            self.store.add({"type": "data", "data": b"1"})
+            self.store.commit()
+            commit.assert_called_once_with()
+            self.reactor.advance(0)
+            commit.assert_called_once_with()
+
+    def test_flag_changes_are_committed_at_the_end_of_the_tick(self):
+        """
+        The messages held or unheld when the accepted types change are
+        committed to the storage together, at the end of the iteration.
+        """
+        for data in [b"1", b"2", b"3"]:
+            self.store.add({"type": "data", "data": data})
+        self.reactor.advance(0)
+        with mock.patch.object(self.storage, "commit") as commit:
+            self.store.set_accepted_types([])
+            self.store.set_accepted_types(["data"])
+            commit.assert_not_called()
+            self.reactor.advance(0)
+            commit.assert_called_once_with()
+        self.assertEqual(3, len(self.store.get_pending_messages()))
+
+    def test_held_messages_are_committed_at_the_end_of_the_tick(self):
+        """
+        The messages held while getting the pending ones are committed to
+        the storage together, at the end of the iteration.
+        """
+        for data in [b"1", b"2", b"3"]:
+            self.store.add({"type": "data", "data": data})
+        self.reactor.advance(0)
+        self.store._persist.set("accepted-types", [])
+        with mock.patch.object(self.storage, "commit") as commit:
+            self.assertEqual([], self.store.get_pending_messages())
+            commit.assert_not_called()
+            self.reactor.advance(0)
+            commit.assert_called_once_with()
+
+
+class MergingMessageStoreTest(LandscapeTest):
+    """Tests for a L{MessageStore} merging time series messages."""
+
+    def setUp(self):
+        super(MergingMessageStoreTest, self).setUp()
+        self.temp_dir = self.makeDir()
+        self.persist_filename = self.makeFile()
+        self.store = self.create_store()
+
+    def create_store(self):
+        persist = Persist(filename=self.persist_filename)
+        store = MessageStore(persist, self.temp_dir, max_size=1000000,
+                             mergers=get_mergers(["load-average"]))
+        store.set_accepted_types(["load-average", "data"])
+        store.add_schema(Message("load-average", {
+            "load-averages": List(Tuple(Int(), Float()))}))
+        store.add_schema(Message("data", {"data": Bytes()}))
+        return store
+
+    def add_load_averages(self, *samples):
+        return self.store.add({"type": "load-average",
+                               "load-averages": list(samples)})
+
+    def test_merge_pending_messages(self):
+        """
+        A new message of a mergeable type is merged into the most recent
+        pending message of the same type, even if other messages were
+        added in between.
+        """
+        self.add_load_averages((1, 0.5))
+        self.store.add({"type": "data", "data": b"x"})
+        message_id = self.add_load_averages((2, 1.0))
+        self.assertEqual(
+            [{"type": "load-average", "api": b"3.2",
+              "load-averages": [(1, 0.5), (2, 1.0)]},
+             {"type": "data", "api": b"3.2", "data": b"x"}],
+            self.store.get_pending_messages())
+        [(key, _), _] = self.store._storage.walk()
+        self.assertEqual(self.store._storage.get_id(key), message_id)
+        self.assertTrue(self.store.is_pending(message_id))
+        self.assertTrue(self.create_store().is_pending(message_id))
+
+    def test_merge_updates_size(self):
+        """The size of the store accounts for the merged message."""
+        self.add_load_averages((1, 0.5))
+        size = self.store.get_size()
+        self.add_load_averages((2, 1.0))
+        self.assertTrue(self.store.get_size() > size)
+        self.assertEqual(self.store.get_size(),
+                         self.create_store().get_size())
+
+    def test_no_merge_into_messages_in_flight(self):
+        """
+        Messages aren't merged into messages handed out for delivery, since
+        they may be part of an exchange in progress.
+        """
+        self.add_load_averages((1, 0.5))
+        self.store.get_pending_stored_messages(in_flight=True)
+        self.add_load_averages((2, 1.0))
+        self.assertEqual(2, len(self.store.get_pending_messages()))
+
+    def test_merge_after_get_pending_messages(self):
+        """
+        Just reading the pending messages doesn't hand them out for
+        delivery, so they can still be merged into.
+        """
+        self.add_load_averages((1, 0.5))
+        self.store.get_pending_messages()
+        self.store.get_pending_stored_messages()
+        self.add_load_averages((2, 1.0))
+        self.assertEqual(1, len(self.store.get_pending_messages()))
+
+    def test_no_merge_after_failed_exchanges(self):
+        """
+        Messages handed out for delivery aren't merged into even if the
+        exchange failed, since the server may have got them anyway, until
+        the server acknowledges the messages it got.
+        """
+        self.add_load_averages((1, 0.5))
+        self.store.get_pending_stored_messages(in_flight=True)
+        self.store.record_failure(0)
+        self.add_load_averages((2, 1.0))
+        self.add_load_averages((3, 1.5))
+        self.assertEqual(
+            [{"type": "load-average", "api": b"3.2",
+              "load-averages": [(1, 0.5)]},
+             {"type": "load-average", "api": b"3.2",
+              "load-averages": [(2, 1.0), (3, 1.5)]}],
+            self.store.get_pending_messages())
+        self.store.set_pending_offset(0)
+        self.add_load_averages((4, 2.0))
+        self.assertEqual(
+            [{"type": "load-average", "api": b"3.2",
+              "load-averages": [(1, 0.5)]},
+             {"type": "load-average", "api": b"3.2",
+              "load-averages": [(2, 1.0), (3, 1.5), (4, 2.0)]}],
+            self.store.get_pending_messages())
+
+    def test_merge_into_messages_not_in_flight(self):
+        """
+        Messages can be merged into pending messages which weren't handed
+        out for delivery, while an exchange is in progress.
+        """
+        self.add_load_averages((1, 0.5))
+        self.store.get_pending_stored_messages(in_flight=True)
+        self.add_load_averages((2, 1.0))
+        self.add_load_averages((3, 1.5))
+        self.store.add_pending_offset(1)
+        self.assertEqual(
+            [{"type": "load-average", "api": b"3.2",
+              "load-averages": [(2, 1.0), (3, 1.5)]}],
+            self.store.get_pending_messages())
+
+    def test_no_merge_after_acknowledgment(self):
+        """
+        Messages aren't merged into messages acknowledged by the server.
+        """
+        self.add_load_averages((1, 0.5))
+        self.store.get_pending_stored_messages(in_flight=True)
+        self.store.add_pending_offset(1)
+        self.add_load_averages((2, 1.0))
+        self.assertEqual(
+            [{"type": "load-average", "api": b"3.2",
+              "load-averages": [(2, 1.0)]}],
+            self.store.get_pending_messages())
+
+    def test_merge_after_restart(self):
+        """
+        Messages are merged into the pending messages found in storage at
+        startup.
+        """
+        self.add_load_averages((1, 0.5))
+        self.add_load_averages((2, 1.0))
+        self.store.get_pending_stored_messages(in_flight=True)
+        self.store.add({"type": "data", "data": b"x"})
+        self.store = self.create_store()
+        self.add_load_averages((3, 1.5))
+        self.assertEqual(
+            [{"type": "load-average", "api": b"3.2",
+              "load-averages": [(1, 0.5), (2, 1.0), (3, 1.5)]},
+             {"type": "data", "api": b"3.2", "data": b"x"}],
+            self.store.get_pending_messages())
+
+    def test_merge_after_restart_returns_id(self):
+        """
+        Messages merged into the pending messages found in storage at
+        startup get the identifier of the merged message.
+        """
+        self.add_load_averages((1, 0.5))
+        self.store = self.create_store()
+        message_id = self.add_load_averages((2, 1.0))
+        [(key, _)] = self.store._storage.walk()
+        self.assertEqual(self.store._storage.get_id(key), message_id)
+        self.assertTrue(self.store.is_pending(message_id))
+
+    def test_no_merge_of_held_messages(self):
+        """Messages of types not accepted by the server aren't merged."""
+        self.store.set_accepted_types(["data"])
+        self.add_load_averages((1, 0.5))
+        self.add_load_averages((2, 1.0))
+        self.store.set_accepted_types(["load-average"])
+        self.assertEqual(2, len(self.store.get_pending_messages()))
+
+    def test_no_merge_with_different_api(self):
+        """Messages tagged with different APIs aren't merged."""
+        self.add_load_averages((1, 0.5))
+        self.store.set_server_api(b"3.3")
+        self.add_load_averages((2, 1.0))
+        self.assertEqual([b"3.2", b"3.3"],
+                         [message["api"] for message in
+                          self.store.get_pending_messages()])
+
+    def test_no_merge_of_too_many_samples(self):
+        """
+        A new message is queued when merging it would make the pending one
+        too big.
+        """
+        self.add_load_averages(*[(i, 0.5) for i in range(600)])
+        self.add_load_averages(*[(i, 0.5) for i in range(600, 1200)])
+        self.assertEqual(2, len(self.store.get_pending_messages()))
+
+    def test_no_merge_after_delete_all_messages(self):
+        """Messages aren't merged into deleted messages."""
+        self.add_load_averages((1, 0.5))
+        self.store.delete_all_messages()
+        self.add_load_averages((2, 1.0))
+        self.assertEqual(
+            [{"type": "load-average", "api": b"3.2",
+              "load-averages": [(2, 1.0)]}],
+            self.store.get_pending_messages())
+
+    def test_snapshot_messages_are_superseded(self):
+        """
+        A new snapshot message replaces the pending one of the same type,
+        or updates it if it holds only what changed.
+        """
+        self.store.set_accepted_types(["computer-info", "distribution-info"])
+        self.store.add_schema(Message(
+            "computer-info", {"hostname": Unicode(), "total-memory": Int()},
+            optional=["hostname", "total-memory"]))
+        self.store.add_schema(Message(
+            "distribution-info",
+            {"release": Unicode(), "code-name": Unicode()},
+            optional=["code-name"]))
+        self.store.add({"type": "computer-info", "hostname": u"old"})
+        self.store.add({"type": "distribution-info", "release": u"18.04",
+                        "code-name": u"bionic"})
+        self.store.add({"type": "computer-info", "total-memory": 1024})
+        self.store.add({"type": "distribution-info", "release": u"20.04"})
+        self.assertEqual(
+            [{"type": "computer-info", "api": b"3.2", "hostname": u"old",
+              "total-memory": 1024},
+             {"type": "distribution-info", "api": b"3.2",
+              "release": u"20.04"}],
+            self.store.get_pending_messages())
+
+    def test_snapshot_messages_not_superseded_after_failed_exchanges(self):
+        """
+        Snapshot messages handed out for delivery aren't superseded once
+        the exchange failed, since the server may have got them anyway.
+        """
+        self.store.set_accepted_types(["distribution-info"])
+        self.store.add_schema(Message(
+            "distribution-info", {"release": Unicode()}))
+        self.store.add({"type": "distribution-info", "release": u"18.04"})
+        self.store.get_pending_stored_messages(in_flight=True)
+        self.store.record_failure(0)
+        self.store.add({"type": "distribution-info", "release": u"20.04"})
+        self.assertEqual(
+            [{"type": "distribution-info", "api": b"3.2",
+              "release": u"18.04"},
+             {"type": "distribution-info", "api": b"3.2",
+              "release": u"20.04"}],
+            self.store.get_pending_messages())
+
+    def test_other_types_are_not_merged(self):
+        """Messages of types without a merger are queued as usual."""
+        self.store.add({"type": "data", "data": b"x"})
+        self.store.add({"type": "data", "data": b"y"})
+        self.assertEqual(2, len(self.store.get_pending_messages()))
+
+
+class SizeLimitedMessageStoreTest(LandscapeTest):
+    """Tests for a L{MessageStore} with a size limit."""
+
+    def setUp(self):
+        super(SizeLimitedMessageStoreTest, self).setUp()
+        self.temp_dir = self.makeDir()
+        self.persist_filename = self.makeFile()
+        self.store = self.create_store()
+        # All the test messages have the same size, see add_message.
+        self.add_message("data")
+        self.message_size = self.store.get_size()
+        self.store.delete_all_messages()
+
+    def create_store(self, max_size=1000, eviction_priorities=None):
+        persist = Persist(filename=self.persist_filename)
+        store = MessageStore(persist, self.temp_dir, max_size=max_size,
+                             eviction_priorities=eviction_priorities)
+        store.set_accepted_types(["data", "cpu-usage", "operation-result"])
+        for type in ["data", "cpu-usage", "load-average", "operation-result"]:
+            store.add_schema(Message(type, {"data": Bytes()}))
+        return store
+
+    def add_message(self, type):
+        """Add a message of the given C{type}, padded to a fixed size."""
+        self.store.add({"type": type, "data": b"x" * (20 - len(type))})
+
+    def fill_store(self, types):
+        """
+        Replace the store with one fitting only the messages of the given
+        C{types}, and add them to it.
+        """
+        self.store = self.create_store(len(types) * self.message_size)
+        for type in types:
+            self.add_message(type)
+
+    def get_pending_types(self):
+        return [message["type"]
+                for message in self.store.get_pending_messages()]
+
+    def test_get_size(self):
+        """
+        The store keeps track of the size of the stored messages, including
+        the ones it finds in storage at startup.
+        """
+        self.add_message("data")
+        self.add_message("data")
+        self.assertEqual(2 * self.message_size, self.store.get_size())
+        self.store = self.create_store()
+        self.assertEqual(2 * self.message_size, self.store.get_size())
+        self.store.set_pending_offset(1)
+        self.store.delete_old_messages()
+        self.assertEqual(self.message_size, self.store.get_size())
+
+    def test_get_size_without_limit(self):
+        """The size of the store is not tracked when it has no limit."""
+        self.store = self.create_store(max_size=None)
+        self.add_message("data")
+        self.assertEqual(0, self.store.get_size())
+
+    def test_low_priority_messages_are_evicted_first(self):
+        """
+        When the store exceeds its size limit, time series messages are
+        evicted first, oldest first.
+        """
+        self.fill_store(["data", "cpu-usage", "data", "cpu-usage"])
+        self.add_message("data")
+        self.assertEqual(["data", "data", "cpu-usage", "data"],
+                         self.get_pending_types())
+        self.assertEqual(4 * self.message_size, self.store.get_size())
+
+    def test_operation_results_are_evicted_last(self):
+        """Results of operations are evicted after other messages."""
+        self.fill_store(["operation-result", "data"])
+        self.add_message("operation-result")
+        self.assertEqual(["operation-result", "operation-result"],
+                         self.get_pending_types())
+        self.add_message("operation-result")
+        self.assertEqual(["operation-result", "operation-result"],
+                         self.get_pending_types())
+
+    def test_held_and_broken_messages_are_evicted(self):
+        """
+        Held messages can be evicted, and broken messages are evicted before
+        any other message.
+        """
+        self.log_helper.ignore_errors(ValueError)
+        self.fill_store(["load-average", "cpu-usage", "data"])
+        with open(self.store._index[2].key, "wb") as fh:
+            fh.write(b"broken!")
+        self.assertEqual(["cpu-usage"], self.get_pending_types())
+        self.add_message("data")
+        self.assertEqual(["cpu-usage", "data"], self.get_pending_types())
+        self.add_message("data")
+        self.assertEqual(["cpu-usage", "data", "data"],
+                         self.get_pending_types())
+        self.assertEqual(["cpu-usage", "data", "data"],
+                         [entry.type for entry in self.store._index])
+
+    def test_sent_messages_are_not_evicted(self):
+        """
+        Messages which were already sent to the server are not evicted, as
+        the server may ask for them again.
+        """
+        self.fill_store(["cpu-usage", "cpu-usage", "data"])
+        self.store.set_pending_offset(2)
+        self.add_message("data")
+        self.store.set_pending_offset(0)
+        self.assertEqual(["cpu-usage", "cpu-usage", "data"],
+                         self.get_pending_types())
+
+    def test_messages_in_flight_are_not_evicted(self):
+        """
+        Messages handed out for delivery are not evicted until the server
+        acknowledges them, as they may be part of the payload in flight.
+        """
+        self.fill_store(["cpu-usage"] * 3)
+        self.store.get_pending_stored_messages(in_flight=True)
+        self.add_message("cpu-usage")
+        self.add_message("data")
+        self.assertEqual(2, self.store.get_evicted_count())
+        self.store.add_pending_offset(3)
+        self.store.set_pending_offset(0)
+        self.assertEqual(["cpu-usage"] * 3, self.get_pending_types())
+
+    def test_messages_in_flight_are_evicted_after_failure(self):
+        """
+        Messages handed out for delivery can be evicted again once the
+        exchange failed.
+        """
+        self.fill_store(["cpu-usage", "data"])
+        self.store.get_pending_stored_messages(in_flight=True)
+        self.store.record_failure(0)
+        self.add_message("data")
+        self.assertEqual(["data", "data"], self.get_pending_types())
+
+    def test_messages_found_in_storage_are_evicted(self):
+        """
+        The type of messages found in storage at startup is read when they
+        need to be evicted.
+        """
+        self.fill_store(["data", "cpu-usage"])
+        self.store = self.create_store(2 * self.message_size)
+        self.add_message("data")
+        self.assertEqual(["data", "data"], self.get_pending_types())
+
+    def test_eviction_priorities(self):
+        """The eviction priority of message types can be customized."""
+        self.fill_store(["data", "cpu-usage"])
+        self.store = self.create_store(
+            2 * self.message_size, eviction_priorities={"data": LOW_PRIORITY})
+        self.add_message("cpu-usage")
+        self.assertEqual(["cpu-usage", "cpu-usage"], self.get_pending_types())
+
+    def test_eviction_is_counted_and_logged(self):
+        """Evicted messages are counted and logged."""
+        self.fill_store(["cpu-usage", "load-average"])
+        self.add_message("data")
+        self.add_message("data")
+        self.assertEqual(2, self.store.get_evicted_count())
+        self.assertIn("evicted 1 messages (load-average)",
+                      self.logfile.getvalue())
+
+
+class CompressedMessageStoreTest(MessageStoreTest):
+    """Run the L{MessageStore} tests compressing messages with zlib."""
+
+    compression = ZLIB
+
+    def test_messages_are_compressed(self):
+        """Messages are compressed before being handed to the storage."""
+        self.store.add({"type": "data", "data": b"x" * 1000})
+        [(key, flags)] = list(self.store._storage.walk())
+        self.assertTrue(len(self.store._storage.read(key)) < 1000)
+        self.assertEqual(
+            [{"type": "data", "api": b"3.2", "data": b"x" * 1000}],
+            self.store.get_pending_messages())
+
+    def test_mixed_compressed_and_uncompressed_messages(self):
+        """
+        Messages stored uncompressed, because compressing them didn't make
+        them smaller or because an older client stored them, are read back
+        along with compressed ones, and so are held messages.
+        """
+        self.store.add({"type": "data", "data": b"old"})
+        self.store.add({"type": "unaccepted", "data": b"x" * 1000})
+        self.store._storage.add(
+            compress_message(dumps({"type": "data", "data": b"y" * 1000,
+                                    "api": b"3.2"}), ZLIB))
+        self.store = self.create_store()
+        self.store.set_accepted_types(["data", "unaccepted"])
+        self.assertEqual(
+            [{"type": "data", "api": b"3.2", "data": b"old"},
+             {"type": "data", "api": b"3.2", "data": b"y" * 1000},
+             {"type": "unaccepted", "api": b"3.2", "data": b"x" * 1000}],
+            self.store.get_pending_messages())
+
+
+class SQLiteMessageStoreTest(LandscapeTest):
+    """Tests for a L{MessageStore} using the SQLite storage engine."""
+
+    def setUp(self):
+        super(SQLiteMessageStoreTest, self).setUp()
+        self.database_filename = self.makeFile()
+        self.persist_filename = self.makeFile()
+        self.store = self.create_store()
+
+    def create_store(self):
+        persist = Persist(filename=self.persist_filename)
+        storage = SQLiteMessageStorage(self.database_filename)
+        store = MessageStore(persist, None, storage=storage)
+        store.set_accepted_types(["data"])
+        store.add_schema(Message("data", {"data": Bytes()}))
+        store.add_schema(Message("unaccepted", {"data": Bytes()}))
+        return store
+
+    def test_pending_messages(self):
+        """Pending messages are read back from the database."""
+        for i in range(5):
+            self.store.add({"type": "data", "data": intToBytes(i)})
+        self.store.set_pending_offset(2)
+        self.assertEqual(3, self.store.count_pending_messages())
+        self.assertEqual(
+            [intToBytes(i) for i in [2, 3, 4]],
+            [message["data"] for message in self.store.get_pending_messages()])
+        self.store.delete_old_messages()
+        self.store.set_pending_offset(0)
+        self.store.commit()
+        store = self.create_store()
+        self.assertEqual(
+            [intToBytes(i) for i in [2, 3, 4]],
+            [message["data"] for message in store.get_pending_messages()])
+
+    def test_held_messages(self):
+        """Unaccepted messages are held and requeued when accepted."""
+        for i in range(4):
+            self.store.add({"type": ["data", "unaccepted"][i % 2],
+                            "data": intToBytes(i)})
+        message_id = self.store.add({"type": "unaccepted", "data": b"4"})
+        self.assertEqual(
+            [b"0", b"2"],
+            [message["data"] for message in self.store.get_pending_messages()])
+        self.store.set_accepted_types(["data", "unaccepted"])
+        self.assertEqual(
+            [b"0", b"2", b"1", b"3", b"4"],
+            [message["data"] for message in self.store.get_pending_messages()])
+        self.assertTrue(self.store.is_pending(message_id))
+        self.store.set_pending_offset(5)
+        self.assertFalse(self.store.is_pending(message_id))
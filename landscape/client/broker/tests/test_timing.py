@@ -0,0 +1,53 @@
+from landscape.client.broker.timing import (
+    RollingHistogram, ExchangeTimings, PAYLOAD, TRANSFER)
+from landscape.client.tests.helpers import LandscapeTest
+
+
+class RollingHistogramTest(LandscapeTest):
+
+    def test_no_samples(self):
+        """There's no summary without samples."""
+        self.assertIs(None, RollingHistogram().get_summary())
+
+    def test_summary(self):
+        """The summary holds the percentiles of the samples."""
+        histogram = RollingHistogram()
+        for value in range(100, 0, -1):
+            histogram.add(value)
+        self.assertEqual(
+            {"count": 100, "mean": 50.5, "p50": 51, "p90": 91, "p99": 100,
+             "max": 100},
+            histogram.get_summary())
+
+    def test_rolling(self):
+        """Only the most recent samples are kept."""
+        histogram = RollingHistogram(size=2)
+        for value in (100, 1, 3):
+            histogram.add(value)
+        self.assertEqual(
+            {"count": 2, "mean": 2.0, "p50": 3, "p90": 3, "p99": 3, "max": 3},
+            histogram.get_summary())
+
+
+class ExchangeTimingsTest(LandscapeTest):
+
+    def test_record(self):
+        """The durations of each phase are summarized separately."""
+        timings = ExchangeTimings()
+        timings.record({PAYLOAD: 0.5, TRANSFER: 2.0})
+        timings.record({PAYLOAD: 1.5})
+        summary = timings.get_summary()
+        self.assertEqual([PAYLOAD, TRANSFER], sorted(summary))
+        self.assertEqual(2, summary[PAYLOAD]["count"])
+        self.assertEqual(1.0, summary[PAYLOAD]["mean"])
+        self.assertEqual(1, summary[TRANSFER]["count"])
+
+    def test_format(self):
+        """
+        The formatted timings hold the median and 90th percentile of the
+        phases, in the order they happen.
+        """
+        timings = ExchangeTimings()
+        timings.record({TRANSFER: 2.0, PAYLOAD: 0.5})
+        self.assertEqual("payload 0.500s/0.500s, transfer 2.000s/2.000s",
+                         timings.format())
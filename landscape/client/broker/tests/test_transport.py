@@ -1,18 +1,25 @@
 # -*- coding: utf-8 -*-
 import os
+import threading
+import zlib
+
+import mock
 
 from landscape import VERSION
-from landscape.client.broker.transport import HTTPTransport
+from landscape.client.broker.transport import (
+    HTTPTransport, AsyncHTTPTransport)
 from landscape.lib import bpickle
-from landscape.lib.fetch import PyCurlError
-from landscape.lib.testing import LogKeeperHelper
+from landscape.lib.fetch import HTTPCodeError, PyCurlError
+from landscape.lib.testing import FakeReactor, LogKeeperHelper
 
 from landscape.client.tests.helpers import LandscapeTest
 
 from twisted.web import server, resource
 from twisted.internet import reactor
-from twisted.internet.ssl import DefaultOpenSSLContextFactory
+from twisted.internet.ssl import (
+    Certificate, DefaultOpenSSLContextFactory, trustRootFromCertificates)
 from twisted.internet.threads import deferToThread
+from twisted.internet.task import Clock
 
 
 def sibpath(path):
@@ -38,6 +45,33 @@ class DataCollectingResource(resource.Resource):
         return bpickle.dumps("Great.")
 
 
+class CompressionResource(resource.Resource):
+    """Accept gzip requests, optionally rejecting them with a 415 error."""
+
+    def __init__(self, reject=False):
+        resource.Resource.__init__(self)
+        self.reject = reject
+        self.encodings = []
+        self.contents = []
+
+    def getChild(self, request, name):
+        return self
+
+    def render(self, request):
+        encoding = request.getHeader("content-encoding")
+        self.encodings.append(encoding)
+        if encoding == "gzip":
+            if self.reject:
+                request.setResponseCode(415)
+                return b""
+            content = zlib.decompress(request.content.read(),
+                                      16 + zlib.MAX_WBITS)
+        else:
+            content = request.content.read()
+        self.contents.append(bpickle.loads(content))
+        return bpickle.dumps({"accepted-content-encodings": [b"gzip"]})
+
+
 class HTTPTransportTest(LandscapeTest):
 
     helpers = [LogKeeperHelper]
@@ -105,6 +139,141 @@ class HTTPTransportTest(LandscapeTest):
         """
         return self.request_with_payload(payload=u"проба")
 
+    def test_connection_reuse(self):
+        """
+        The connection to the server is set up once, and reused by the
+        following exchanges.
+        """
+        resource = DataCollectingResource()
+        port = reactor.listenTCP(
+            0, server.Site(resource), interface="127.0.0.1")
+        self.ports.append(port)
+        transport = HTTPTransport(
+            None, "http://localhost:%d/" % (port.getHost().port,))
+
+        def exchange_twice():
+            transport.exchange("HI", message_api="X.Y")
+            transport.exchange("HO", message_api="X.Y")
+
+        result = deferToThread(exchange_twice)
+
+        def got_result(ignored):
+            self.assertEqual(bpickle.loads(resource.content), "HO")
+            logs = self.logfile.getvalue()
+            self.assertEqual(1, logs.count("Connected to http://localhost"))
+            self.assertEqual(
+                1, logs.count("Reused the connection to http://localhost"))
+            self.assertEqual(
+                ["connect", "decode", "encode", "name-lookup", "tls",
+                 "transfer"], sorted(transport.timings))
+            transport.set_url("http://example/message-system")
+            self.assertIs(None, transport._curl_handle)
+
+        result.addCallback(got_result)
+        return result
+
+    def test_connection_discarded_after_error(self):
+        """
+        The curl handle is discarded after a failed exchange, so that the
+        next one starts over with a new connection.
+        """
+        self.log_helper.ignore_errors(PyCurlError)
+        transport = HTTPTransport(None, "http://localhost:1/")
+        error = PyCurlError(7, "Couldn't connect")
+        with mock.patch("landscape.client.broker.transport.fetch",
+                        side_effect=error):
+            self.assertRaises(PyCurlError, transport.exchange, "HI")
+        self.assertIs(None, transport._curl_handle)
+
+    def test_close_during_exchange(self):
+        """
+        Closing the transport while an exchange is in progress doesn't wait
+        for it: the curl handle is discarded once the exchange is done.
+        """
+        transport = HTTPTransport(None, "http://localhost:1/")
+        fetching = threading.Event()
+        closed = threading.Event()
+        responses = []
+        waits = []
+
+        def fetch(*args, **kwargs):
+            fetching.set()
+            waits.append(closed.wait(5))
+            return bpickle.dumps("OK")
+
+        with mock.patch("landscape.client.broker.transport.fetch",
+                        side_effect=fetch):
+            thread = threading.Thread(
+                target=lambda: responses.append(transport.exchange("HI")))
+            thread.start()
+            self.assertTrue(fetching.wait(10))
+            transport.close()
+            self.assertIs(None, transport._curl_handle)
+            closed.set()
+            thread.join(10)
+        self.assertEqual([True], waits)
+        self.assertEqual(["OK"], responses)
+        self.assertIs(None, transport._curl_handle)
+
+    def exchange_with(self, resource, payloads):
+        """Exchange the given payloads with a server using C{resource}."""
+        port = reactor.listenTCP(
+            0, server.Site(resource), interface="127.0.0.1")
+        self.ports.append(port)
+        transport = HTTPTransport(
+            None, "http://localhost:%d/" % (port.getHost().port,))
+
+        def exchange():
+            for payload in payloads:
+                transport.exchange(payload, message_api="X.Y")
+
+        return deferToThread(exchange)
+
+    def test_compression(self):
+        """
+        Payloads are compressed with gzip once the server advertises that it
+        accepts compressed requests.
+        """
+        resource = CompressionResource()
+        payload = u"x" * 2048
+        result = self.exchange_with(resource, [payload, payload])
+
+        def got_result(ignored):
+            self.assertEqual([None, "gzip"], resource.encodings)
+            self.assertEqual([payload, payload], resource.contents)
+            self.assertIn("Compressing the payloads sent to the server.",
+                          self.logfile.getvalue())
+
+        result.addCallback(got_result)
+        return result
+
+    def test_no_compression_for_small_payloads(self):
+        """Small payloads aren't compressed."""
+        resource = CompressionResource()
+        result = self.exchange_with(resource, ["HI", "HO"])
+
+        def got_result(ignored):
+            self.assertEqual([None, None], resource.encodings)
+
+        result.addCallback(got_result)
+        return result
+
+    def test_compression_rejected(self):
+        """
+        If the server rejects a compressed payload, it's sent again
+        uncompressed.
+        """
+        resource = CompressionResource(reject=True)
+        payload = u"x" * 2048
+        result = self.exchange_with(resource, [payload, payload])
+
+        def got_result(ignored):
+            self.assertEqual([None, "gzip", None], resource.encodings)
+            self.assertEqual([payload, payload], resource.contents)
+
+        result.addCallback(got_result)
+        return result
+
     def test_ssl_verification_positive(self):
         """
         The client transport should complete an upload of messages to
@@ -163,3 +332,194 @@ class HTTPTransportTest(LandscapeTest):
                             in self.logfile.getvalue())
         result.addErrback(got_result)
         return result
+
+
+class ErrorResource(resource.Resource):
+
+    def getChild(self, request, name):
+        return self
+
+    def render(self, request):
+        request.setResponseCode(500)
+        return b"Oops"
+
+
+class AsyncHTTPTransportTest(LandscapeTest):
+
+    helpers = [LogKeeperHelper]
+
+    def setUp(self):
+        super(AsyncHTTPTransportTest, self).setUp()
+        self.ports = []
+
+    def tearDown(self):
+        super(AsyncHTTPTransportTest, self).tearDown()
+        for port in self.ports:
+            port.stopListening()
+
+    def get_transport(self, resource, pubkey=None):
+        """Return a transport talking to a server using C{resource}."""
+        port = reactor.listenTCP(
+            0, server.Site(resource), interface="127.0.0.1")
+        self.ports.append(port)
+        transport = AsyncHTTPTransport(
+            FakeReactor(), "http://localhost:%d/" % (port.getHost().port,),
+            pubkey)
+        self.addCleanup(transport.close)
+        return transport
+
+    def test_request_data(self):
+        """
+        The exchange returns a L{Deferred} firing with the response of the
+        server, and sends the same headers as L{HTTPTransport}.
+        """
+        resource = DataCollectingResource()
+        transport = self.get_transport(resource)
+        result = transport.exchange(u"проба", computer_id="34",
+                                    exchange_token="abcd-efgh",
+                                    message_api="X.Y")
+
+        def got_result(response):
+            get_header = resource.request.requestHeaders.getRawHeaders
+            self.assertEqual("Great.", response)
+            self.assertEqual(get_header("x-computer-id"), ["34"])
+            self.assertEqual(get_header("x-exchange-token"), ["abcd-efgh"])
+            self.assertEqual(
+                get_header("user-agent"), ["landscape-client/%s" % (VERSION,)])
+            self.assertEqual(get_header("x-message-api"), ["X.Y"])
+            self.assertEqual(get_header("accept-encoding"), ["gzip"])
+            self.assertEqual(bpickle.loads(resource.content), u"проба")
+
+        return result.addCallback(got_result)
+
+    def test_compression(self):
+        """
+        Payloads are compressed once the server advertises that it accepts
+        compressed requests.
+        """
+        resource = CompressionResource()
+        transport = self.get_transport(resource)
+        payload = u"x" * 2048
+        result = transport.exchange(payload, message_api="X.Y")
+        result.addCallback(
+            lambda ignored: transport.exchange(payload, message_api="X.Y"))
+
+        def got_result(response):
+            self.assertEqual({"accepted-content-encodings": [b"gzip"]},
+                             response)
+            self.assertEqual([None, "gzip"], resource.encodings)
+            self.assertEqual([payload, payload], resource.contents)
+
+        return result.addCallback(got_result)
+
+    def test_compression_rejected(self):
+        """
+        If the server rejects a compressed payload, it's sent again
+        uncompressed.
+        """
+        resource = CompressionResource(reject=True)
+        transport = self.get_transport(resource)
+        transport._compress = True
+        payload = u"x" * 2048
+        result = transport.exchange(payload, message_api="X.Y")
+
+        def got_result(response):
+            self.assertEqual([u"gzip", None], resource.encodings)
+            self.assertEqual([payload], resource.contents)
+
+        return result.addCallback(got_result)
+
+    def test_http_code_error(self):
+        """
+        An L{HTTPCodeError} is raised when the server replies with an error
+        code.
+        """
+        self.log_helper.ignore_errors(HTTPCodeError)
+        transport = self.get_transport(ErrorResource())
+        result = transport.exchange("HI", message_api="X.Y")
+        self.assertFailure(result, HTTPCodeError)
+
+        def got_error(error):
+            self.assertEqual(500, error.http_code)
+            self.assertEqual(b"Oops", error.body)
+            self.assertIn("Error contacting the server at http://localhost",
+                          self.logfile.getvalue())
+
+        return result.addCallback(got_error)
+
+    def test_connection_error(self):
+        """
+        A L{PyCurlError} with the error code curl would use is raised when
+        the server can't be reached.
+        """
+        self.log_helper.ignore_errors(PyCurlError)
+        port = reactor.listenTCP(0, server.Site(DataCollectingResource()),
+                                 interface="127.0.0.1")
+        url = "http://localhost:%d/" % (port.getHost().port,)
+        port.stopListening()
+        transport = AsyncHTTPTransport(FakeReactor(), url)
+        self.addCleanup(transport.close)
+        result = transport.exchange("HI", message_api="X.Y")
+        self.assertFailure(result, PyCurlError)
+
+        def got_error(error):
+            self.assertEqual(7, error.error_code)
+
+        return result.addCallback(got_error)
+
+    def test_reactor(self):
+        """
+        Requests are made with the Twisted reactor wrapped by the given one.
+        """
+        fake_reactor = FakeReactor()
+        fake_reactor._reactor = Clock()
+        transport = AsyncHTTPTransport(fake_reactor, "http://localhost/")
+        self.assertIs(fake_reactor._reactor, transport._pool._reactor)
+        self.assertIs(fake_reactor._reactor, transport._twisted_reactor)
+
+    def test_ssl_verification_bundle(self):
+        """
+        All the certificates of the bundle given as public key are trusted,
+        like with curl.
+        """
+        bundle = self.makeFile()
+        certificates = []
+        with open(bundle, "wb") as fd:
+            for filename in [BADPUBKEY, PUBKEY]:
+                with open(filename, "rb") as pubkey:
+                    data = pubkey.read()
+                fd.write(data)
+                certificates.append(Certificate.loadPEM(data))
+        with mock.patch("twisted.internet.ssl.trustRootFromCertificates",
+                        wraps=trustRootFromCertificates) as trust:
+            AsyncHTTPTransport(FakeReactor(), "https://localhost/",
+                               pubkey=bundle)
+        [trusted] = trust.call_args[0]
+        self.assertEqual([cert.digest() for cert in certificates],
+                         [cert.digest() for cert in trusted])
+
+    def test_ssl_verification_negative(self):
+        """
+        If the certificate of the server can't be verified, a L{PyCurlError}
+        with the code curl uses for verification errors is raised, and no
+        message data is uploaded.
+        """
+        self.log_helper.ignore_errors(PyCurlError)
+        r = DataCollectingResource()
+        context_factory = DefaultOpenSSLContextFactory(
+            BADPRIVKEY, BADPUBKEY)
+        port = reactor.listenSSL(0, server.Site(r), context_factory,
+                                 interface="127.0.0.1")
+        self.ports.append(port)
+        transport = AsyncHTTPTransport(
+            FakeReactor(), "https://localhost:%d/" % (port.getHost().port,),
+            pubkey=PUBKEY)
+        self.addCleanup(transport.close)
+        result = transport.exchange("HI", message_api="X.Y")
+        self.assertFailure(result, PyCurlError)
+
+        def got_error(error):
+            self.assertEqual(60, error.error_code)
+            self.assertIs(r.content, None)
+
+        return result.addCallback(got_error)
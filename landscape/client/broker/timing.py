@@ -0,0 +1,96 @@
+"""Keep track of how long the phases of message exchanges take.
+
+The L{MessageExchange} records the time spent in each phase of an exchange,
+building the payload from the message store, encoding it, the network round
+trip (name lookup, connection, TLS handshake and transfer), decoding the
+response and dispatching the messages it holds, in L{ExchangeTimings}.
+"""
+from collections import deque
+
+# The phases of an exchange, in the order they happen.
+PAYLOAD = "payload"
+ENCODE = "encode"
+NAME_LOOKUP = "name-lookup"
+CONNECT = "connect"
+TLS = "tls"
+TRANSFER = "transfer"
+DECODE = "decode"
+DISPATCH = "dispatch"
+PHASES = (PAYLOAD, ENCODE, NAME_LOOKUP, CONNECT, TLS, TRANSFER, DECODE,
+          DISPATCH)
+
+
+class RollingHistogram(object):
+    """Summarize the distribution of the most recent samples of a duration.
+
+    @param size: The number of samples kept.
+    """
+
+    def __init__(self, size=1000):
+        self._samples = deque(maxlen=size)
+
+    def add(self, value):
+        """Add a sample, dropping the oldest one if the window is full."""
+        self._samples.append(value)
+
+    def get_summary(self):
+        """Return a C{dict} summarizing the samples.
+
+        It holds the C{count} of samples, their C{mean} and C{max}, and the
+        C{p50}, C{p90} and C{p99} percentiles, or C{None} if there are no
+        samples.
+        """
+        if not self._samples:
+            return None
+        samples = sorted(self._samples)
+        count = len(samples)
+
+        def percentile(percent):
+            return samples[min(count - 1, count * percent // 100)]
+
+        return {"count": count,
+                "mean": sum(samples) / float(count),
+                "p50": percentile(50),
+                "p90": percentile(90),
+                "p99": percentile(99),
+                "max": samples[-1]}
+
+
+class ExchangeTimings(object):
+    """Rolling histograms of the duration of each phase of exchanges.
+
+    @param size: The number of exchanges kept for each phase.
+    """
+
+    def __init__(self, size=1000):
+        self._histograms = dict(
+            (phase, RollingHistogram(size)) for phase in PHASES)
+
+    def record(self, timings):
+        """Record the durations of the phases of an exchange.
+
+        @param timings: A C{dict} mapping phases to durations, in seconds.
+        """
+        for phase, duration in timings.items():
+            self._histograms[phase].add(duration)
+
+    def get_summary(self):
+        """
+        Return a C{dict} mapping the phases having samples to the summary of
+        their durations, see L{RollingHistogram.get_summary}.
+        """
+        summary = {}
+        for phase, histogram in self._histograms.items():
+            phase_summary = histogram.get_summary()
+            if phase_summary is not None:
+                summary[phase] = phase_summary
+        return summary
+
+    def format(self):
+        """Return a line summarizing the median and 90th percentile timings.
+        """
+        summary = self.get_summary()
+        return ", ".join(
+            "%s %.3fs/%.3fs" % (phase, summary[phase]["p50"],
+                                summary[phase]["p90"])
+            for phase in PHASES if phase in summary)
@@ -2,29 +2,85 @@
 import time
 import logging
 import pprint
+import re
+import threading
 import uuid
+import zlib
 
 import pycurl
 
-from twisted.python.compat import unicode, _PY3
+from zope.interface import implementer
+
+from twisted.internet import defer, error
+from twisted.python.compat import unicode, networkString, _PY3
+from twisted.web.client import (
+    Agent, BrowserLikePolicyForHTTPS, ContentDecoderAgent, GzipDecoder,
+    HTTPConnectionPool, PartialDownloadError, readBody)
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import IBodyProducer
 
 from landscape.lib import bpickle
-from landscape.lib.fetch import fetch
+from landscape.lib.fetch import fetch, HTTPCodeError, PyCurlError
 from landscape.lib.format import format_delta
+from landscape.client.broker.timing import (
+    ENCODE, NAME_LOOKUP, CONNECT, TLS, TRANSFER, DECODE)
 from landscape import SERVER_API, VERSION
 
 
+# The number of seconds the address of the server is cached by the curl
+# handle reused across exchanges.
+DNS_CACHE_TIMEOUT = 300
+
+# Payloads smaller than this aren't worth compressing.
+MIN_COMPRESSED_SIZE = 1024
+
+# The transports performing HTTP requests, by name.
+CURL = "curl"
+TWISTED = "twisted"
+HTTP_TRANSPORTS = (CURL, TWISTED)
+
+# The certificates found in a PEM bundle, like the ones curl accepts.
+PEM_CERTIFICATE = re.compile(
+    b"-----BEGIN CERTIFICATE-----.+?-----END CERTIFICATE-----", re.DOTALL)
+
+
 class HTTPTransport(object):
     """Transport makes a request to exchange message data over HTTP.
 
     @param url: URL of the remote Landscape server message system.
     @param pubkey: SSH public key used for secure communication.
+
+    The same curl handle is used for all the exchanges with the server, so
+    that its connection, the resolved server address and the TLS session are
+    reused, instead of being set up again for every exchange. The handle is
+    discarded after an error, or when the server URL changes.
+
+    Payloads are compressed with gzip once the server advertises that it
+    accepts compressed requests, and sent uncompressed again if it stops
+    doing so, or rejects a compressed request.
+
+    The C{exchange} method blocks until the server replies, so it's meant to
+    be run in a thread.
+
+    @ivar timings: A C{dict} mapping the phases of the last exchange to
+        their duration, see L{landscape.client.broker.timing}.
     """
 
+    asynchronous = False
+
     def __init__(self, reactor, url, pubkey=None):
         self._reactor = reactor
         self._url = url
         self._pubkey = pubkey
+        # The curl handle reused across exchanges, which is taken out of
+        # here while an exchange uses it. The lock is only held to hand it
+        # over, never while a request is in progress.
+        self._curl_handle = None
+        self._curl_in_use = False
+        self._discard_curl = False
+        self._curl_lock = threading.Lock()
+        self._compress = False
+        self.timings = {}
 
     def get_url(self):
         """Get the URL of the remote message system."""
@@ -32,9 +88,119 @@ class HTTPTransport(object):
 
     def set_url(self, url):
         """Set the URL of the remote message system."""
-        self._url = url
+        with self._curl_lock:
+            self._url = url
+            self._close_curl()
+
+    def close(self):
+        """Close the connection to the server.
+
+        If an exchange is in progress, its connection is closed by the
+        exchange thread once it's done, rather than waiting for it here.
+        """
+        with self._curl_lock:
+            self._close_curl()
+
+    def _close_curl(self):
+        """
+        Discard the reused curl handle, along with its connection, or flag
+        it to be discarded if an exchange is using it.
+
+        It must be called with C{_curl_lock} held.
+        """
+        if self._curl_in_use:
+            self._discard_curl = True
+        elif self._curl_handle is not None:
+            self._curl_handle.close()
+            self._curl_handle = None
+
+    def _take_curl(self):
+        """Take the curl handle reused across exchanges, for an exchange.
+
+        @return: The curl handle and the URL to fetch.
+        """
+        with self._curl_lock:
+            curl, self._curl_handle = self._curl_handle, None
+            self._curl_in_use = True
+            self._discard_curl = False
+            url = self._url
+        if curl is None:
+            curl = pycurl.Curl()
+        else:
+            # Resetting the options of the handle keeps its live connection,
+            # its DNS cache and its TLS session cache.
+            curl.reset()
+        curl.setopt(pycurl.TCP_KEEPALIVE, 1)
+        return curl, url
+
+    def _release_curl(self, curl, discard=False):
+        """
+        Give back the curl handle taken by L{_take_curl}, closing it if
+        C{discard} is true or if it was flagged to be discarded meanwhile.
+        """
+        with self._curl_lock:
+            self._curl_in_use = False
+            discard = discard or self._discard_curl
+            self._discard_curl = False
+            if not discard:
+                self._curl_handle = curl
+        if discard:
+            curl.close()
+
+    def _record_curl_timings(self, curl):
+        """Record the durations of the network phases of the last request.
+
+        The times reported by curl are counted from the start of the
+        request, and are zero for the phases which didn't happen, like the
+        TLS handshake of plain HTTP requests, or the connection when it's
+        reused.
+        """
+        name_lookup = curl.getinfo(pycurl.NAMELOOKUP_TIME)
+        connect = max(name_lookup, curl.getinfo(pycurl.CONNECT_TIME))
+        tls = max(connect, curl.getinfo(pycurl.APPCONNECT_TIME))
+        self.timings[NAME_LOOKUP] = name_lookup
+        self.timings[CONNECT] = connect - name_lookup
+        self.timings[TLS] = tls - connect
+        self.timings[TRANSFER] = max(
+            0.0, curl.getinfo(pycurl.TOTAL_TIME) - tls)
 
-    def _curl(self, payload, computer_id, exchange_token, message_api):
+    def _log_connection(self, curl):
+        """Log the time spent setting up the connection to the server."""
+        if curl.getinfo(pycurl.NUM_CONNECTS) == 0:
+            logging.debug("Reused the connection to %s.", self._url)
+        else:
+            # The TLS handshake is included in the APPCONNECT_TIME, which is
+            # zero for plain HTTP connections.
+            setup_time = (curl.getinfo(pycurl.APPCONNECT_TIME) or
+                          curl.getinfo(pycurl.CONNECT_TIME))
+            logging.info("Connected to %s in %s.", self._url,
+                         format_delta(setup_time))
+
+    def _encode(self, spayload):
+        """Return the request body for a serialized payload, and its encoding.
+        """
+        if self._compress and len(spayload) >= MIN_COMPRESSED_SIZE:
+            # Adding 16 to the window bits makes zlib write a gzip stream.
+            compressor = zlib.compressobj(
+                6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            return compressor.compress(spayload) + compressor.flush(), "gzip"
+        return spayload, None
+
+    def _update_compression(self, response):
+        """Compress the next payloads if the server accepts gzip requests."""
+        encodings = ()
+        if isinstance(response, dict):
+            encodings = response.get("accepted-content-encodings") or ()
+        compress = any(encoding in (b"gzip", u"gzip")
+                       for encoding in encodings)
+        if compress != self._compress:
+            logging.info("%s the payloads sent to the server.",
+                         "Compressing" if compress else "Not compressing")
+            self._compress = compress
+
+    def _get_headers(self, computer_id, exchange_token, message_api,
+                     content_encoding):
+        """Return the HTTP headers of an exchange request."""
         # There are a few "if _PY3" checks below, because for Python 3 we
         # want to convert a number of values from bytes to string, before
         # assigning them to the headers.
@@ -51,9 +217,48 @@ class HTTPTransport(object):
             if _PY3 and isinstance(exchange_token, bytes):
                 exchange_token = exchange_token.decode("ascii")
             headers["X-Exchange-Token"] = str(exchange_token)
-        curl = pycurl.Curl()
-        return (curl, fetch(self._url, post=True, data=payload,
-                            headers=headers, cainfo=self._pubkey, curl=curl))
+        if content_encoding:
+            headers["Content-Encoding"] = content_encoding
+        return headers
+
+    def _parse_response(self, data):
+        """Return the response decoded from the data sent by the server.
+
+        C{None} is returned if the data is invalid.
+        """
+        start_time = time.time()
+        try:
+            response = bpickle.loads(data)
+        except Exception:
+            logging.exception("Server returned invalid data: %r" % data)
+            return None
+        else:
+            self.timings[DECODE] = time.time() - start_time
+            if logging.getLogger().getEffectiveLevel() <= logging.DEBUG:
+                logging.debug(
+                    "Received payload:\n%s", pprint.pformat(response))
+            self._update_compression(response)
+
+        return response
+
+    def _curl(self, payload, computer_id, exchange_token, message_api,
+              content_encoding=None):
+        headers = self._get_headers(computer_id, exchange_token, message_api,
+                                    content_encoding)
+        curl, url = self._take_curl()
+        try:
+            data = fetch(url, post=True, data=payload,
+                         headers=headers, cainfo=self._pubkey, curl=curl,
+                         dns_cache_timeout=DNS_CACHE_TIMEOUT)
+        except Exception:
+            # The connection may be left in an unknown state, start over
+            # with a new one at the next exchange.
+            self._release_curl(curl, discard=True)
+            raise
+        self._log_connection(curl)
+        self._record_curl_timings(curl)
+        self._release_curl(curl)
+        return (curl, data)
 
     def exchange(self, payload, computer_id=None, exchange_token=None,
                  message_api=SERVER_API):
@@ -73,37 +278,248 @@ class HTTPTransport(object):
         @note: This code is thread safe (HOPEFULLY).
 
         """
+        self.timings = {}
+        start_time = time.time()
         spayload = bpickle.dumps(payload)
+        self.timings[ENCODE] = time.time() - start_time
         start_time = time.time()
         if logging.getLogger().getEffectiveLevel() <= logging.DEBUG:
             logging.debug("Sending payload:\n%s", pprint.pformat(payload))
+        body, content_encoding = self._encode(spayload)
         try:
-            curly, data = self._curl(spayload, computer_id, exchange_token,
-                                     message_api)
+            try:
+                curly, data = self._curl(body, computer_id, exchange_token,
+                                         message_api, content_encoding)
+            except HTTPCodeError as error:
+                # 415 is Unsupported Media Type.
+                if content_encoding is None or error.http_code != 415:
+                    raise
+                logging.info("The server rejected a compressed payload, "
+                             "sending it uncompressed.")
+                self._compress = False
+                body = spayload
+                curly, data = self._curl(body, computer_id, exchange_token,
+                                         message_api)
         except Exception:
             logging.exception("Error contacting the server at %s." % self._url)
             raise
         else:
             logging.info("Sent %d bytes and received %d bytes in %s.",
-                         len(spayload), len(data),
+                         len(body), len(data),
                          format_delta(time.time() - start_time))
 
-        try:
-            response = bpickle.loads(data)
-        except Exception:
-            logging.exception("Server returned invalid data: %r" % data)
-            return None
+        return self._parse_response(data)
+
+
+def get_curl_error_code(failure):
+    """
+    Return the curl error code matching the failure of a request made with
+    Twisted's HTTP client.
+    """
+    if failure.check(defer.TimeoutError, defer.CancelledError,
+                     error.TimeoutError):
+        return pycurl.E_OPERATION_TIMEDOUT
+    if failure.check(error.DNSLookupError):
+        return pycurl.E_COULDNT_RESOLVE_HOST
+    if failure.check(error.ConnectError):
+        return pycurl.E_COULDNT_CONNECT
+    from OpenSSL import SSL
+    # Errors occurring while a request is in flight wrap the failures
+    # which caused them.
+    for reason in getattr(failure.value, "reasons", ()):
+        if reason.check(SSL.Error):
+            # The same code curl uses when the server certificate can't be
+            # verified, which is by far the most likely SSL error.
+            return pycurl.E_SSL_CACERT
+    return pycurl.E_RECV_ERROR
+
+
+@implementer(IBodyProducer)
+class BytesProducer(object):
+    """Produce the body of a request, already held in memory."""
+
+    def __init__(self, body):
+        self._body = body
+        self.length = len(body)
+
+    def startProducing(self, consumer):
+        consumer.write(self._body)
+        return defer.succeed(None)
+
+    def pauseProducing(self):
+        pass
+
+    def resumeProducing(self):
+        pass
+
+    def stopProducing(self):
+        pass
+
+
+class AsyncHTTPTransport(HTTPTransport):
+    """Transport exchanging message data with Twisted's HTTP client.
+
+    Unlike the one of L{HTTPTransport}, the C{exchange} method doesn't
+    block: it returns a L{Deferred} firing with the server's response, so no
+    thread is tied up while waiting for the server. Requests share a pool of
+    persistent connections, and failures are reported with the same
+    L{HTTPCodeError} and L{PyCurlError} errors.
+
+    @note: Unlike curl, this transport doesn't honour the C{http_proxy} and
+        C{https_proxy} settings.
+    """
+
+    asynchronous = True
+
+    def __init__(self, reactor, url, pubkey=None, connect_timeout=30,
+                 total_timeout=600):
+        super(AsyncHTTPTransport, self).__init__(reactor, url, pubkey)
+        # The HTTP client needs the Twisted reactor our own one wraps.
+        twisted_reactor = reactor._reactor
+        self._twisted_reactor = twisted_reactor
+        self._total_timeout = total_timeout
+        self._pool = HTTPConnectionPool(twisted_reactor, persistent=True)
+        agent = Agent(twisted_reactor, contextFactory=self._get_tls_policy(),
+                      connectTimeout=connect_timeout, pool=self._pool)
+        self._agent = ContentDecoderAgent(agent, [(b"gzip", GzipDecoder)])
+
+    def _get_tls_policy(self):
+        """Return the policy checking the certificate of the server."""
+        if self._pubkey is None:
+            return BrowserLikePolicyForHTTPS()
+        from twisted.internet.ssl import (
+            Certificate, trustRootFromCertificates)
+        with open(self._pubkey, "rb") as fd:
+            certificates = [Certificate.loadPEM(pem)
+                            for pem in PEM_CERTIFICATE.findall(fd.read())]
+        return BrowserLikePolicyForHTTPS(
+            trustRoot=trustRootFromCertificates(certificates))
+
+    def close(self):
+        """Close the connections to the server.
+
+        @return: A L{Deferred} firing once the connections are closed.
+        """
+        return self._pool.closeCachedConnections()
+
+    def _post(self, body, computer_id, exchange_token, message_api,
+              content_encoding=None):
+        """Post the body of an exchange request to the server.
+
+        @return: A L{Deferred} firing with the data sent by the server.
+        """
+        headers = Headers()
+        for name, value in self._get_headers(
+                computer_id, exchange_token, message_api,
+                content_encoding).items():
+            headers.addRawHeader(networkString(name), networkString(value))
+        deferred = self._agent.request(
+            b"POST", networkString(self._url), headers,
+            BytesProducer(body))
+        deferred.addTimeout(self._total_timeout, self._twisted_reactor)
+        deferred.addCallback(self._read_response)
+        deferred.addErrback(self._convert_error)
+        return deferred
+
+    def _read_response(self, response):
+        """Return a L{Deferred} firing with the body of the response."""
+
+        def got_partial_body(failure):
+            # Servers closing the connection to mark the end of the body
+            # don't tell its length in advance.
+            failure.trap(PartialDownloadError)
+            return failure.value.response
+
+        def check_code(body):
+            if response.code != 200:
+                raise HTTPCodeError(response.code, body)
+            return body
+
+        deferred = readBody(response)
+        deferred.addErrback(got_partial_body)
+        return deferred.addCallback(check_code)
+
+    def _convert_error(self, failure):
+        """Turn the failure of a request into a L{PyCurlError}."""
+        if failure.check(HTTPCodeError, PyCurlError):
+            return failure
+        reasons = getattr(failure.value, "reasons", None)
+        if reasons:
+            message = reasons[0].getErrorMessage()
         else:
-            if logging.getLogger().getEffectiveLevel() <= logging.DEBUG:
-                logging.debug(
-                    "Received payload:\n%s", pprint.pformat(response))
+            message = failure.getErrorMessage()
+        raise PyCurlError(get_curl_error_code(failure), message)
 
-        return response
+    def exchange(self, payload, computer_id=None, exchange_token=None,
+                 message_api=SERVER_API):
+        """Exchange message data with the server.
+
+        See L{HTTPTransport.exchange} for the parameters.
+
+        @return: A L{Deferred} firing with the server's response to the sent
+            message, or C{None} in case of invalid data.
+        """
+        self.timings = {}
+        start_time = time.time()
+        spayload = bpickle.dumps(payload)
+        self.timings[ENCODE] = time.time() - start_time
+        start_time = time.time()
+        if logging.getLogger().getEffectiveLevel() <= logging.DEBUG:
+            logging.debug("Sending payload:\n%s", pprint.pformat(payload))
+        body, content_encoding = self._encode(spayload)
+        deferred = self._post(body, computer_id, exchange_token, message_api,
+                              content_encoding)
+        deferred.addCallback(lambda data: (body, data))
+
+        def retry_uncompressed(failure):
+            # 415 is Unsupported Media Type.
+            if (content_encoding is None or
+                    not failure.check(HTTPCodeError) or
+                    failure.value.http_code != 415):
+                return failure
+            logging.info("The server rejected a compressed payload, "
+                         "sending it uncompressed.")
+            self._compress = False
+            deferred = self._post(spayload, computer_id, exchange_token,
+                                  message_api)
+            return deferred.addCallback(lambda data: (spayload, data))
+
+        def log_error(failure):
+            logging.error("Error contacting the server at %s." % self._url,
+                          exc_info=(failure.type, failure.value,
+                                    failure.getTracebackObject()))
+            return failure
+
+        def got_data(result):
+            body, data = result
+            # The phases of the round trip can't be told apart.
+            self.timings[TRANSFER] = time.time() - start_time
+            logging.info("Sent %d bytes and received %d bytes in %s.",
+                         len(body), len(data),
+                         format_delta(time.time() - start_time))
+            return self._parse_response(data)
+
+        deferred.addErrback(retry_uncompressed)
+        deferred.addCallbacks(got_data, log_error)
+        return deferred
+
+
+def get_transport_factory(name):
+    """Return the class of the HTTP transport with the given name.
+
+    @param name: One of L{HTTP_TRANSPORTS}.
+    """
+    if name == TWISTED:
+        return AsyncHTTPTransport
+    return HTTPTransport
 
 
 class FakeTransport(object):
     """Fake transport for testing purposes."""
 
+    asynchronous = False
+    timings = {}
+
     def __init__(self, reactor=None, url=None, pubkey=None):
         self._pubkey = pubkey
         self.payloads = []
@@ -123,6 +539,9 @@ class FakeTransport(object):
     def set_url(self, url):
         self._url = url
 
+    def close(self):
+        pass
+
     def exchange(self, payload, computer_id=None, exchange_token=None,
                  message_api=SERVER_API):
         self.payloads.append(payload)
@@ -42,9 +42,14 @@ class MonitorService(LandscapeService):
         def start_plugins(broker):
             self.broker = broker
             self.monitor.broker = broker
+            self.broker.batch_messages()
             for plugin in self.plugins:
                 self.monitor.add(plugin)
-            return self.broker.register_client(self.service_name)
+            # Once registered, we're told about changes to the accepted
+            # message types, so they can be cached.
+            result = self.broker.register_client(self.service_name)
+            return result.addCallback(
+                lambda ignored: self.broker.cache_accepted_types())
 
         self.connector = RemoteBrokerConnector(self.reactor, self.config)
         connected = self.connector.connect()
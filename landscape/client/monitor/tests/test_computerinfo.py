@@ -127,10 +127,12 @@ VmallocChunk:   107432 kB
         self.assertEqual(len(messages), 1)
         self.assertEqual(messages[0]["hostname"], "ooga")
 
+        # The server got the first message, so it's not superseded.
+        self.mstore.add_pending_offset(1)
         plugin.exchange()
         messages = self.mstore.get_pending_messages()
-        self.assertEqual(len(messages), 2)
-        self.assertEqual(messages[1]["hostname"], "wubble")
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0]["hostname"], "wubble")
 
     def test_get_total_memory(self):
         self.mstore.set_accepted_types(["computer-info"])
@@ -167,9 +169,11 @@ VmallocChunk:   107432 kB
         self.assertEqual(message["total-memory"], 1510)
         self.assertTrue("total-swap" in message)
 
+        # The server got the first message, so it's not superseded.
+        self.mstore.add_pending_offset(1)
         plugin._get_memory_info = lambda: (2048, 1584)
         plugin.exchange()
-        message = self.mstore.get_pending_messages()[1]
+        message = self.mstore.get_pending_messages()[0]
         self.assertEqual(message["total-memory"], 2048)
         self.assertTrue("total-swap" not in message)
 
@@ -184,9 +188,11 @@ VmallocChunk:   107432 kB
         self.assertEqual(message["total-swap"], 1584)
         self.assertTrue("total-memory" in message)
 
+        # The server got the first message, so it's not superseded.
+        self.mstore.add_pending_offset(1)
         plugin._get_memory_info = lambda: (1510, 2048)
         plugin.exchange()
-        message = self.mstore.get_pending_messages()[1]
+        message = self.mstore.get_pending_messages()[0]
         self.assertEqual(message["total-swap"], 2048)
         self.assertTrue("total-memory" not in message)
 
@@ -260,6 +266,8 @@ VmallocChunk:   107432 kB
         self.assertEqual(message["release"], "6.06")
         self.assertEqual(message["code-name"], "dapper")
 
+        # The server got the first message, so it's not superseded.
+        self.mstore.add_pending_offset(1)
         plugin._lsb_release_filename = self.makeFile("""\
 DISTRIB_ID=Ubuntu
 DISTRIB_RELEASE=6.10
@@ -267,7 +275,7 @@ DISTRIB_CODENAME=edgy
 DISTRIB_DESCRIPTION="Ubuntu 6.10"
 """)
         plugin.exchange()
-        message = self.mstore.get_pending_messages()[1]
+        message = self.mstore.get_pending_messages()[0]
         self.assertEqual(message["type"], "distribution-info")
         self.assertEqual(message["distributor-id"], "Ubuntu")
         self.assertEqual(message["description"], "Ubuntu 6.10")
@@ -300,6 +308,7 @@ DISTRIB_NEW_UNEXPECTED_KEY=ooga
         all computer info should be generated.
         """
         self.mstore.set_accepted_types(["distribution-info", "computer-info"])
+        self.mstore.add = mock.Mock(wraps=self.mstore.add)
         meminfo_filename = self.makeFile(self.sample_memory_info)
         plugin = ComputerInfo(get_fqdn=get_fqdn,
                               meminfo_filename=meminfo_filename,
@@ -310,6 +319,7 @@ DISTRIB_NEW_UNEXPECTED_KEY=ooga
         plugin.exchange()
         self.reactor.fire("resynchronize", scopes=["computer"])
         plugin.exchange()
+        self.assertEqual(self.mstore.add.call_count, 4)
         computer_info = {"type": "computer-info", "hostname": "ooga.local",
                          "timestamp": 0, "total-memory": 1510,
                          "total-swap": 1584}
@@ -317,9 +327,9 @@ DISTRIB_NEW_UNEXPECTED_KEY=ooga
         dist_info = {"type": "distribution-info",
                      "code-name": "dapper", "description": "Ubuntu 6.06.1 LTS",
                      "distributor-id": "Ubuntu", "release": "6.06"}
+        # The messages sent after resynchronizing supersede the pending ones.
         self.assertMessages(self.mstore.get_pending_messages(),
-                            [computer_info, dist_info,
-                             computer_info, dist_info])
+                            [computer_info, dist_info])
 
     def test_computer_info_call_on_accepted(self):
         plugin = ComputerInfo(fetch_async=self.fetch_func)
@@ -48,16 +48,18 @@ class ResynchTest(LandscapeTest):
     def test_resynchronize(self):
         """
         The "resynchronize" reactor message should cause the plugin to
-        send fresh data.
+        send fresh data, which supersedes the pending message.
         """
         self.mstore.set_accepted_types(["processor-info"])
+        self.mstore.add = Mock(wraps=self.mstore.add)
         plugin = ProcessorInfo()
         self.monitor.add(plugin)
         plugin.run()
         self.reactor.fire("resynchronize", scopes=["cpu"])
         plugin.run()
+        self.assertEqual(self.mstore.add.call_count, 2)
         messages = self.mstore.get_pending_messages()
-        self.assertEqual(len(messages), 2)
+        self.assertEqual(len(messages), 1)
 
 
 class PowerPCMessageTest(LandscapeTest):
@@ -588,7 +590,10 @@ bogomips        : 1198.25
         self.makeFile(self.SMP_OPTERON, path=filename)
         plugin.run()
 
-        self.assertEqual(len(self.mstore.get_pending_messages()), 2)
+        # The new message supersedes the pending one.
+        messages = self.mstore.get_pending_messages()
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(len(messages[0]["processors"]), 2)
 
     def test_no_message_if_not_accepted(self):
         """
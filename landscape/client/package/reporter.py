@@ -12,14 +12,15 @@ import apt_pkg
 import re
 
 from twisted.internet.defer import (
-    Deferred, succeed, inlineCallbacks, returnValue)
+    Deferred, succeed, gatherResults, inlineCallbacks, returnValue)
 
 from landscape.lib import bpickle
+from landscape.lib.amp import MethodCallError
 from landscape.lib.apt.package.store import (
         UnknownHashIDRequest, FakePackageStore)
 from landscape.lib.config import get_bindir
 from landscape.lib.sequenceranges import sequence_to_ranges
-from landscape.lib.twisted_util import gather_results, spawn_process
+from landscape.lib.twisted_util import spawn_process
 from landscape.lib.fetch import fetch_async
 from landscape.lib.fs import touch_file, create_binary_file
 from landscape.lib.lsb_release import parse_lsb_release, LSB_RELEASE_FILENAME
@@ -463,15 +464,16 @@ class PackageReporter(PackageTaskHandler):
         now = time.time()
         timeout = now - HASH_ID_REQUEST_TIMEOUT
 
-        def update_or_remove(is_pending, request):
-            if is_pending:
-                # Request is still in the queue.  Update the timestamp.
-                request.timestamp = now
-            elif request.timestamp < timeout:
-                # Request was delivered, and is older than the threshold.
-                request.remove()
+        def update_or_remove(pending, requests):
+            for is_pending, request in zip(pending, requests):
+                if is_pending:
+                    # Request is still in the queue.  Update the timestamp.
+                    request.timestamp = now
+                elif request.timestamp < timeout:
+                    # Request was delivered, and is older than the threshold.
+                    request.remove()
 
-        results = []
+        requests = []
         for request in self._store.iter_hash_id_requests():
             if request.message_id is None:
                 # May happen in some rare cases, when a send_message() is
@@ -479,11 +481,26 @@ class PackageReporter(PackageTaskHandler):
                 # request is removed and so we don't get here.
                 request.remove()
             else:
-                result = self._broker.is_message_pending(request.message_id)
-                result.addCallback(update_or_remove, request)
-                results.append(result)
+                requests.append(request)
+
+        if not requests:
+            return succeed(None)
 
-        return gather_results(results)
+        message_ids = [request.message_id for request in requests]
+
+        def ask_one_by_one(failure):
+            # Brokers older than us don't know about are_messages_pending,
+            # for example while the client is being upgraded.
+            failure.trap(MethodCallError)
+            return gatherResults(
+                [self._broker.is_message_pending(message_id)
+                 for message_id in message_ids])
+
+        # Ask about all the messages at once, rather than making one broker
+        # round-trip per request.
+        result = self._broker.are_messages_pending(message_ids)
+        result.addErrback(ask_one_by_one)
+        return result.addCallback(update_or_remove, requests)
 
     def request_unknown_hashes(self):
         """Detect available packages for which we have no hash=>id mappings.
@@ -12,6 +12,7 @@ from twisted.internet import reactor
 
 
 from landscape.lib import bpickle
+from landscape.lib.amp import MethodCallError
 from landscape.lib.apt.package.facade import AptFacade
 from landscape.lib.apt.package.store import (
     PackageStore, UnknownHashIDRequest, FakePackageStore)
@@ -632,6 +633,52 @@ class PackageReporterAptTest(LandscapeTest):
         result = self.reporter.remove_expired_hash_id_requests()
         return result.addCallback(got_result)
 
+    def test_remove_expired_hash_id_request_asks_broker_once(self):
+        """
+        The broker is asked about the messages of all the requests at once.
+        """
+        request1 = self.store.add_hash_id_request([b"hash1"])
+        request1.message_id = 9998
+        request2 = self.store.add_hash_id_request([b"hash2"])
+        request2.message_id = 9999
+        self.remote.are_messages_pending = mock.Mock(
+            return_value=succeed([True, True]))
+        self.remote.is_message_pending = mock.Mock()
+
+        def got_result(result):
+            self.remote.are_messages_pending.assert_called_once_with(
+                [9998, 9999])
+            self.remote.is_message_pending.assert_not_called()
+
+        result = self.reporter.remove_expired_hash_id_requests()
+        return result.addCallback(got_result)
+
+    def test_remove_expired_hash_id_request_with_old_broker(self):
+        """
+        Brokers not knowing about C{are_messages_pending} are asked about
+        each message in turn.
+        """
+        request1 = self.store.add_hash_id_request([b"hash1"])
+        message_store = self.broker_service.message_store
+        request1.message_id = message_store.add(
+            {"type": "add-packages", "packages": [],
+             "request-id": request1.id})
+        request2 = self.store.add_hash_id_request([b"hash2"])
+        request2.message_id = 9999
+        request2.timestamp -= HASH_ID_REQUEST_TIMEOUT
+        initial_timestamp = request1.timestamp
+        self.remote.are_messages_pending = mock.Mock(
+            return_value=fail(MethodCallError(
+                "Forbidden method 'are_messages_pending'")))
+
+        def got_result(result):
+            self.assertTrue(request1.timestamp > initial_timestamp)
+            self.assertRaises(UnknownHashIDRequest,
+                              self.store.get_hash_id_request, request2.id)
+
+        result = self.reporter.remove_expired_hash_id_requests()
+        return result.addCallback(got_result)
+
     def test_remove_expired_hash_id_request_removes_when_no_message_id(self):
         request = self.store.add_hash_id_request([b"hash1"])
 
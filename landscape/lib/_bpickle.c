@@ -0,0 +1,527 @@
+/*
+ * Compiled implementation of the bpickle encoder and decoder.
+ *
+ * This module is optional: landscape.lib.bpickle uses it when available and
+ * falls back to its pure Python implementation otherwise. Both must produce
+ * the same output for the same input, byte for byte.
+ *
+ * Only built-in types are handled here. Objects of other types are encoded by
+ * calling the function registered for their type in the conversion map given
+ * to dumps(), so that Python extensions of the format keep working.
+ */
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+
+
+/* Encoder */
+
+typedef struct {
+    char *data;
+    Py_ssize_t size;
+    Py_ssize_t allocated;
+} Buffer;
+
+static int
+buffer_reserve(Buffer *buffer, Py_ssize_t size)
+{
+    Py_ssize_t needed = buffer->size + size;
+    if (needed > buffer->allocated) {
+        Py_ssize_t allocated = buffer->allocated * 2;
+        char *data;
+        if (allocated < needed)
+            allocated = needed;
+        data = PyMem_Realloc(buffer->data, allocated);
+        if (data == NULL) {
+            PyErr_NoMemory();
+            return -1;
+        }
+        buffer->data = data;
+        buffer->allocated = allocated;
+    }
+    return 0;
+}
+
+static int
+buffer_write(Buffer *buffer, const char *data, Py_ssize_t size)
+{
+    if (buffer_reserve(buffer, size) < 0)
+        return -1;
+    memcpy(buffer->data + buffer->size, data, size);
+    buffer->size += size;
+    return 0;
+}
+
+static int
+buffer_write_char(Buffer *buffer, char c)
+{
+    return buffer_write(buffer, &c, 1);
+}
+
+/* Write a type character, the decimal representation of a length and a
+ * colon, like the "s%d:" prefix of byte strings. */
+static int
+buffer_write_length(Buffer *buffer, char type, Py_ssize_t length)
+{
+    char prefix[32];
+    int size = PyOS_snprintf(prefix, sizeof(prefix), "%c%zd:", type, length);
+    return buffer_write(buffer, prefix, size);
+}
+
+/* Write a type character, the ASCII string returned by str() or repr() for
+ * the given object and a semicolon, like the "i%d;" format of integers. */
+static int
+buffer_write_number(Buffer *buffer, char type, PyObject *string)
+{
+    const char *data;
+    Py_ssize_t size;
+    int result = -1;
+
+    if (string == NULL)
+        return -1;
+    data = PyUnicode_AsUTF8AndSize(string, &size);
+    if (data != NULL &&
+        buffer_write_char(buffer, type) == 0 &&
+        buffer_write(buffer, data, size) == 0 &&
+        buffer_write_char(buffer, ';') == 0)
+        result = 0;
+    Py_DECREF(string);
+    return result;
+}
+
+static int dump(Buffer *buffer, PyObject *obj, PyObject *table);
+
+static int
+dump_items(Buffer *buffer, PyObject *seq, PyObject *table)
+{
+    Py_ssize_t i;
+    /* The sequence may be a list, which must not shrink under our feet
+     * while items are being encoded, so its size is checked every time. */
+    for (i = 0; i < PySequence_Fast_GET_SIZE(seq); i++) {
+        PyObject *item = PySequence_Fast_GET_ITEM(seq, i);
+        int result;
+        Py_INCREF(item);
+        result = dump(buffer, item, table);
+        Py_DECREF(item);
+        if (result < 0)
+            return -1;
+    }
+    return 0;
+}
+
+static int
+dump_dict(Buffer *buffer, PyObject *obj, PyObject *table)
+{
+    PyObject *keys;
+    Py_ssize_t i;
+    int result = -1;
+
+    keys = PyDict_Keys(obj);
+    if (keys == NULL)
+        return -1;
+    if (PyList_Sort(keys) < 0)
+        goto exit;
+    if (buffer_write_char(buffer, 'd') < 0)
+        goto exit;
+    for (i = 0; i < PyList_GET_SIZE(keys); i++) {
+        PyObject *key = PyList_GET_ITEM(keys, i);
+        PyObject *value = PyDict_GetItemWithError(obj, key);
+        if (value == NULL) {
+            if (!PyErr_Occurred())
+                PyErr_SetObject(PyExc_KeyError, key);
+            goto exit;
+        }
+        Py_INCREF(value);
+        if (dump(buffer, key, table) < 0 || dump(buffer, value, table) < 0) {
+            Py_DECREF(value);
+            goto exit;
+        }
+        Py_DECREF(value);
+    }
+    result = buffer_write_char(buffer, ';');
+exit:
+    Py_DECREF(keys);
+    return result;
+}
+
+static int
+dump_other(Buffer *buffer, PyObject *obj, PyObject *table)
+{
+    PyObject *type = (PyObject *)Py_TYPE(obj);
+    PyObject *function, *data;
+    int result;
+
+    function = PyObject_GetItem(table, type);
+    if (function == NULL)
+        return -1;
+    data = PyObject_CallFunctionObjArgs(function, obj, NULL);
+    Py_DECREF(function);
+    if (data == NULL)
+        return -1;
+    if (!PyBytes_Check(data)) {
+        PyErr_Format(PyExc_TypeError,
+                     "conversion of %.200s returned %.200s, not bytes",
+                     Py_TYPE(obj)->tp_name, Py_TYPE(data)->tp_name);
+        Py_DECREF(data);
+        return -1;
+    }
+    result = buffer_write(buffer, PyBytes_AS_STRING(data),
+                          PyBytes_GET_SIZE(data));
+    Py_DECREF(data);
+    return result;
+}
+
+static int
+dump(Buffer *buffer, PyObject *obj, PyObject *table)
+{
+    PyTypeObject *type = Py_TYPE(obj);
+    int result;
+
+    if (obj == Py_None)
+        return buffer_write_char(buffer, 'n');
+    if (type == &PyBool_Type)
+        return buffer_write(buffer, obj == Py_True ? "b1" : "b0", 2);
+    if (type == &PyLong_Type)
+        return buffer_write_number(buffer, 'i', PyObject_Str(obj));
+    if (type == &PyFloat_Type)
+        return buffer_write_number(buffer, 'f', PyObject_Repr(obj));
+    if (type == &PyBytes_Type) {
+        if (buffer_write_length(buffer, 's', PyBytes_GET_SIZE(obj)) < 0)
+            return -1;
+        return buffer_write(buffer, PyBytes_AS_STRING(obj),
+                            PyBytes_GET_SIZE(obj));
+    }
+    if (type == &PyUnicode_Type) {
+        Py_ssize_t size;
+        const char *data = PyUnicode_AsUTF8AndSize(obj, &size);
+        if (data == NULL || buffer_write_length(buffer, 'u', size) < 0)
+            return -1;
+        return buffer_write(buffer, data, size);
+    }
+    if (type != &PyList_Type && type != &PyTuple_Type &&
+        type != &PyDict_Type)
+        return dump_other(buffer, obj, table);
+
+    if (Py_EnterRecursiveCall(" while serializing an object"))
+        return -1;
+    if (type == &PyDict_Type) {
+        result = dump_dict(buffer, obj, table);
+    }
+    else {
+        result = buffer_write_char(buffer, type == &PyList_Type ? 'l' : 't');
+        if (result == 0)
+            result = dump_items(buffer, obj, table);
+        if (result == 0)
+            result = buffer_write_char(buffer, ';');
+    }
+    Py_LeaveRecursiveCall();
+    return result;
+}
+
+static PyObject *
+bpickle_dumps(PyObject *self, PyObject *args)
+{
+    PyObject *obj, *table, *result = NULL;
+    Buffer buffer = {NULL, 0, 0};
+
+    if (!PyArg_ParseTuple(args, "OO:dumps", &obj, &table))
+        return NULL;
+    if (buffer_reserve(&buffer, 256) == 0 && dump(&buffer, obj, table) == 0)
+        result = PyBytes_FromStringAndSize(buffer.data, buffer.size);
+    PyMem_Free(buffer.data);
+    return result;
+}
+
+
+/* Decoder */
+
+typedef struct {
+    const char *data;
+    Py_ssize_t size;
+    Py_ssize_t pos;
+    int as_is;
+} Reader;
+
+static PyObject *load(Reader *reader);
+
+/* Raise the error the pure Python decoder raises for an unknown type
+ * character, which is also what it raises on truncated containers. */
+static PyObject *
+unknown_type(Reader *reader)
+{
+    Py_ssize_t size = reader->pos < reader->size ? 1 : 0;
+    PyObject *character = PyBytes_FromStringAndSize(
+        reader->data + reader->pos, size);
+    if (character != NULL) {
+        PyErr_Format(PyExc_ValueError, "Unknown type character: %R",
+                     character);
+        Py_DECREF(character);
+    }
+    return NULL;
+}
+
+/* Return the position of the given character, starting from the current
+ * one, raising ValueError like bytes.index() if it's not there. */
+static Py_ssize_t
+find(Reader *reader, char c)
+{
+    const char *found = memchr(reader->data + reader->pos, c,
+                               reader->size - reader->pos);
+    if (found == NULL) {
+        PyErr_SetString(PyExc_ValueError, "subsection not found");
+        return -1;
+    }
+    return found - reader->data;
+}
+
+/* Convert the given range to a number with the given type, like the pure
+ * Python decoder does by calling int() or float() on a byte slice. */
+static PyObject *
+to_number(Reader *reader, Py_ssize_t start, Py_ssize_t end,
+          PyObject *(*convert)(PyObject *))
+{
+    PyObject *string, *number;
+
+    if (end > reader->size)
+        end = reader->size;
+    string = PyBytes_FromStringAndSize(reader->data + start, end - start);
+    if (string == NULL)
+        return NULL;
+    number = convert(string);
+    Py_DECREF(string);
+    return number;
+}
+
+static PyObject *
+load_number(Reader *reader, PyObject *(*convert)(PyObject *))
+{
+    PyObject *number;
+    Py_ssize_t end = find(reader, ';');
+
+    if (end < 0)
+        return NULL;
+    number = to_number(reader, reader->pos + 1, end, convert);
+    reader->pos = end + 1;
+    return number;
+}
+
+static PyObject *
+load_bool(Reader *reader)
+{
+    PyObject *number = to_number(reader, reader->pos + 1, reader->pos + 2,
+                                 PyNumber_Long);
+    int value;
+
+    if (number == NULL)
+        return NULL;
+    value = PyObject_IsTrue(number);
+    Py_DECREF(number);
+    if (value < 0)
+        return NULL;
+    reader->pos += 2;
+    return PyBool_FromLong(value);
+}
+
+static PyObject *
+load_string(Reader *reader, int unicode)
+{
+    PyObject *length;
+    PY_LONG_LONG value;
+    int overflow;
+    Py_ssize_t start, size, colon = find(reader, ':');
+
+    if (colon < 0)
+        return NULL;
+    length = to_number(reader, reader->pos + 1, colon, PyNumber_Long);
+    if (length == NULL)
+        return NULL;
+    value = PyLong_AsLongLongAndOverflow(length, &overflow);
+    Py_DECREF(length);
+    if (value == -1 && PyErr_Occurred())
+        return NULL;
+    if (overflow > 0 || value > PY_SSIZE_T_MAX) {
+        /* Huge lengths go past the end of the data anyway. */
+        size = PY_SSIZE_T_MAX;
+    }
+    else if (overflow < 0 || value < 0) {
+        PyErr_SetString(PyExc_ValueError, "Corrupted data");
+        return NULL;
+    }
+    else
+        size = (Py_ssize_t)value;
+    start = colon + 1;
+    /* Like slicing, tolerate lengths going past the end of the data. */
+    if (size > reader->size - start)
+        size = reader->size - start;
+    reader->pos = start + size;
+    if (unicode)
+        return PyUnicode_DecodeUTF8(reader->data + start, size, "strict");
+    return PyBytes_FromStringAndSize(reader->data + start, size);
+}
+
+static int
+at_end(Reader *reader)
+{
+    return reader->pos < reader->size && reader->data[reader->pos] == ';';
+}
+
+static PyObject *
+load_list(Reader *reader)
+{
+    PyObject *list = PyList_New(0);
+
+    if (list == NULL)
+        return NULL;
+    reader->pos++;
+    while (!at_end(reader)) {
+        PyObject *item = load(reader);
+        if (item == NULL || PyList_Append(list, item) < 0) {
+            Py_XDECREF(item);
+            Py_DECREF(list);
+            return NULL;
+        }
+        Py_DECREF(item);
+    }
+    reader->pos++;
+    return list;
+}
+
+static PyObject *
+load_tuple(Reader *reader)
+{
+    PyObject *tuple, *list = load_list(reader);
+
+    if (list == NULL)
+        return NULL;
+    tuple = PyList_AsTuple(list);
+    Py_DECREF(list);
+    return tuple;
+}
+
+static PyObject *
+load_dict(Reader *reader)
+{
+    PyObject *dict = PyDict_New();
+
+    if (dict == NULL)
+        return NULL;
+    reader->pos++;
+    while (!at_end(reader)) {
+        PyObject *key, *value = NULL;
+        int result = -1;
+
+        key = load(reader);
+        if (key != NULL)
+            value = load(reader);
+        if (value != NULL && !reader->as_is && PyBytes_Check(key)) {
+            /* Although the wire format of dictionary keys is ASCII bytes,
+             * the code actually expects them to be strings. */
+            PyObject *decoded = PyUnicode_DecodeASCII(
+                PyBytes_AS_STRING(key), PyBytes_GET_SIZE(key), "strict");
+            Py_DECREF(key);
+            key = decoded;
+        }
+        if (key != NULL && value != NULL)
+            result = PyDict_SetItem(dict, key, value);
+        Py_XDECREF(key);
+        Py_XDECREF(value);
+        if (result < 0) {
+            Py_DECREF(dict);
+            return NULL;
+        }
+    }
+    reader->pos++;
+    return dict;
+}
+
+static PyObject *
+load(Reader *reader)
+{
+    PyObject *result;
+
+    if (reader->pos >= reader->size)
+        return unknown_type(reader);
+    switch (reader->data[reader->pos]) {
+    case 'n':
+        reader->pos++;
+        Py_RETURN_NONE;
+    case 'b':
+        return load_bool(reader);
+    case 'i':
+        return load_number(reader, PyNumber_Long);
+    case 'f':
+        return load_number(reader, PyNumber_Float);
+    case 's':
+        return load_string(reader, 0);
+    case 'u':
+        return load_string(reader, 1);
+    case 'l':
+    case 't':
+    case 'd':
+        break;
+    default:
+        return unknown_type(reader);
+    }
+    if (Py_EnterRecursiveCall(" while deserializing an object"))
+        return NULL;
+    switch (reader->data[reader->pos]) {
+    case 'l':
+        result = load_list(reader);
+        break;
+    case 't':
+        result = load_tuple(reader);
+        break;
+    default:
+        result = load_dict(reader);
+    }
+    Py_LeaveRecursiveCall();
+    return result;
+}
+
+static PyObject *
+bpickle_loads(PyObject *self, PyObject *args)
+{
+    Py_buffer view;
+    Reader reader;
+    int as_is = 0;
+    PyObject *result;
+
+    if (!PyArg_ParseTuple(args, "y*|p:loads", &view, &as_is))
+        return NULL;
+    if (view.len == 0) {
+        PyBuffer_Release(&view);
+        PyErr_SetString(PyExc_ValueError, "Can't load empty string");
+        return NULL;
+    }
+    reader.data = view.buf;
+    reader.size = view.len;
+    reader.pos = 0;
+    reader.as_is = as_is;
+    result = load(&reader);
+    PyBuffer_Release(&view);
+    return result;
+}
+
+
+static PyMethodDef bpickle_methods[] = {
+    {"dumps", bpickle_dumps, METH_VARARGS,
+     "dumps(obj, table) -> bytes\n\n"
+     "Serialize obj, using table to convert objects of non built-in types."},
+    {"loads", bpickle_loads, METH_VARARGS,
+     "loads(buffer, as_is=False) -> object\n\n"
+     "Load serialized data from any object supporting the buffer protocol."},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef bpickle_module = {
+    PyModuleDef_HEAD_INIT,
+    "_bpickle",
+    "Compiled implementation of landscape.lib.bpickle.",
+    -1,
+    bpickle_methods
+};
+
+PyMODINIT_FUNC
+PyInit__bpickle(void)
+{
+    return PyModule_Create(&bpickle_module);
+}
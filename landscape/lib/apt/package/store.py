@@ -385,7 +385,7 @@ class HashIDRequest(object):
     def hashes(self, cursor):
         cursor.execute("SELECT hashes FROM hash_id_request WHERE id=?",
                        (self.id,))
-        return bpickle.loads(bytes(cursor.fetchone()[0]))
+        return bpickle.loads_buffer(cursor.fetchone()[0])
 
     @with_cursor
     def _get_timestamp(self, cursor):
@@ -434,7 +434,7 @@ class PackageTask(object):
 
         self.queue = row[0]
         self.timestamp = row[1]
-        self.data = bpickle.loads(bytes(row[2]))
+        self.data = bpickle.loads_buffer(row[2])
 
     @with_cursor
     def remove(self, cursor):
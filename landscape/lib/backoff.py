@@ -0,0 +1,56 @@
+import random
+
+
+class Backoff(object):
+    """Exponential backoff with decorrelated jitter.
+
+    After each consecutive failure, the delay before the next attempt is
+    picked at random between the normal interval and three times the
+    previous delay, up to a maximum. The randomness spreads the attempts of
+    many clients which failed at the same time, for example because their
+    server was down, instead of having them all retry at once.
+
+    @param max_delay: The maximum delay between attempts, in seconds. It's
+        ignored if the normal interval is longer.
+    @param random: The L{random.Random} used to pick delays.
+    """
+
+    def __init__(self, max_delay, random=random):
+        self.max_delay = max_delay
+        self.failures = 0
+        self.delay = None
+        self._random = random
+
+    def failed(self, interval):
+        """Record a failed attempt, and return the delay before the next one.
+
+        @param interval: The normal interval between attempts, in seconds.
+        """
+        previous = max(interval, self.delay or interval)
+        delay = self._random.uniform(interval, previous * 3)
+        self.delay = max(interval, min(self.max_delay, delay))
+        self.failures += 1
+        return self.delay
+
+    def succeeded(self):
+        """Record a successful attempt, ending the backoff."""
+        self.failures = 0
+        self.delay = None
+
+    def get_interval(self, interval):
+        """Return the delay before the next attempt.
+
+        @param interval: The normal interval between attempts, in seconds.
+        """
+        if self.delay is None:
+            return interval
+        return max(interval, self.delay)
+
+    def get_state(self):
+        """Return a C{dict} describing the backoff.
+
+        It holds the number of consecutive C{failures}, and the current
+        C{delay} before the next attempt, or C{None} if attempts aren't being
+        delayed.
+        """
+        return {"failures": self.failures, "delay": self.delay}
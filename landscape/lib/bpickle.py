@@ -32,17 +32,87 @@ This file is modified from the original to work with python3, but should be
 wire compatible and behave the same way (bugs notwithstanding).
 """
 
+import io
+import mmap
+import os
+
 from twisted.python.compat import _PY3
 
+try:
+    # The compiled implementation, built along with the package when
+    # possible. It produces the same output as the Python one.
+    from landscape.lib import _bpickle as speedups
+except ImportError:
+    speedups = None
+
 dumps_table = {}
 loads_table = {}
+skip_table = {}
+buffer_loads_table = {}
 
 
 def dumps(obj, _dt=dumps_table):
+    pieces = []
     try:
-        return _dt[type(obj)](obj)
+        if speedups is not None and _dt is dumps_table:
+            return speedups.dumps(obj, _dt)
+        _dump(obj, pieces.append, _dt)
     except KeyError as e:
         raise ValueError("Unsupported type: %s" % e)
+    return b"".join(pieces)
+
+
+def dump(obj, fileobj, _dt=dumps_table):
+    """Serialize C{obj}, writing the result to C{fileobj}.
+
+    Nested lists, tuples and dicts are not serialized to intermediate byte
+    strings: their items are written to C{fileobj} one by one as they get
+    serialized.
+
+    @param obj: the object to serialize
+    @param fileobj: a file-like object with a C{write} method
+    @param _dt: the conversion map
+    """
+    try:
+        _dump(obj, fileobj.write, _dt)
+    except KeyError as e:
+        raise ValueError("Unsupported type: %s" % e)
+
+
+def _dump(obj, write, _dt):
+    # Containers and byte strings are handled here, so they can be written
+    # piece by piece. Everything else goes through the conversion map, which
+    # is also used directly for the other items of containers to save calls.
+    obj_type = type(obj)
+    if obj_type is dict:
+        write(b"d")
+        for key in sorted(obj):
+            write(_dt[type(key)](key))
+            val = obj[key]
+            val_type = type(val)
+            if val_type in _streamed:
+                _dump(val, write, _dt)
+            else:
+                write(_dt[val_type](val))
+        write(b";")
+    elif obj_type is list or obj_type is tuple:
+        write(b"l" if obj_type is list else b"t")
+        for val in obj:
+            val_type = type(val)
+            if val_type in _streamed:
+                _dump(val, write, _dt)
+            else:
+                write(_dt[val_type](val))
+        write(b";")
+    elif obj_type is bytes:
+        # Don't copy strings just to prepend their length.
+        write(("s%d:" % (len(obj),)).encode("utf-8"))
+        write(obj)
+    else:
+        write(_dt[obj_type](obj))
+
+
+_streamed = frozenset([dict, list, tuple, bytes])
 
 
 def loads(byte_string, _lt=loads_table, as_is=False):
@@ -52,6 +122,9 @@ def loads(byte_string, _lt=loads_table, as_is=False):
     @param _lt: the conversion map
     @param as_is: don't reinterpret dict keys as str
     """
+    if (speedups is not None and _lt is loads_table and
+            isinstance(byte_string, bytes)):
+        return speedups.loads(byte_string, as_is)
     if not byte_string:
         raise ValueError("Can't load empty string")
     try:
@@ -64,6 +137,104 @@ def loads(byte_string, _lt=loads_table, as_is=False):
         raise ValueError("Corrupted data")
 
 
+def loads_buffer(buffer, as_is=False, _lt=buffer_loads_table):
+    """Load serialized data from a buffer, without copying it first.
+
+    The buffer can be any object supporting item access and C{find}, like
+    C{bytes}, C{bytearray} or C{mmap}. Only the values being built are
+    copied out of it, and the type of each value is looked up by index
+    rather than by slicing. A C{memoryview} is decoded in place if it spans
+    the whole object it was taken from, and is copied otherwise. With the
+    compiled speedups, any object supporting the buffer protocol is decoded
+    in place.
+
+    The result is the same that L{loads} would return.
+
+    @param buffer: the serialized data
+    @param as_is: don't reinterpret dict keys as str
+    @param _lt: the conversion map, by type character code
+    """
+    if speedups is not None and _lt is buffer_loads_table:
+        return speedups.loads(buffer, as_is)
+    if isinstance(buffer, memoryview):
+        obj = buffer.obj
+        if (hasattr(obj, "find") and buffer.contiguous and
+                buffer.nbytes == len(obj)):
+            buffer = obj
+        else:
+            buffer = buffer.tobytes()
+    if not len(buffer):
+        raise ValueError("Can't load empty string")
+    try:
+        return _lt[buffer[0]](buffer, 0, as_is=as_is)[0]
+    except KeyError as e:
+        raise ValueError("Unknown type character: %s" % e)
+    except IndexError:
+        raise ValueError("Corrupted data")
+
+
+def load(fileobj, as_is=False):
+    """Load serialized data from a file.
+
+    Regular files are memory-mapped and decoded with L{loads_buffer},
+    rather than being read in memory first. Data is read from the start
+    of the file.
+
+    @param fileobj: a file-like object with a C{read} method
+    @param as_is: don't reinterpret dict keys as str
+    """
+    try:
+        fileno = fileobj.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        return loads_buffer(fileobj.read(), as_is=as_is)
+    if os.fstat(fileno).st_size == 0:
+        raise ValueError("Can't load empty string")
+    data = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+    try:
+        return loads_buffer(data, as_is=as_is)
+    finally:
+        data.close()
+
+
+def loads_keys(byte_string, keys, _lt=loads_table, _st=skip_table,
+               as_is=False):
+    """Load only some of the top-level keys of a serialized dict.
+
+    The values of the other keys are skipped over without being built, so
+    this is much cheaper than L{loads} when only a few small values of a
+    big dict are needed.
+
+    @param byte_string: the serialized dict
+    @param keys: the keys to load
+    @param _lt: the conversion map
+    @param _st: the skipping map
+    @param as_is: don't reinterpret dict keys as str
+    @return: a dict holding the requested keys that were found
+    """
+    if byte_string[0:1] != b"d":
+        # Let loads() report corrupted data, if that's the case.
+        loads(byte_string, _lt=_lt, as_is=as_is)
+        raise ValueError("Not a serialized dict")
+    res = {}
+    pos = 1
+    try:
+        while byte_string[pos:pos+1] != b";":
+            key, pos = _lt[byte_string[pos:pos+1]](
+                byte_string, pos, as_is=as_is)
+            if _PY3 and not as_is and isinstance(key, bytes):
+                key = key.decode("ascii")
+            if key in keys:
+                res[key], pos = _lt[byte_string[pos:pos+1]](
+                    byte_string, pos, as_is=as_is)
+            else:
+                pos = _st[byte_string[pos:pos+1]](byte_string, pos)
+    except KeyError as e:
+        raise ValueError("Unknown type character: %s" % e)
+    except IndexError:
+        raise ValueError("Corrupted data")
+    return res
+
+
 def dumps_bool(obj):
     return ("b%d" % int(obj)
             ).encode("utf-8")
@@ -127,15 +298,23 @@ def loads_float(bytestring, pos, as_is=False):
     return float(bytestring[pos+1:endpos]), endpos+1
 
 
+def _get_length(data, pos, startpos):
+    """Return the length of the string whose data starts at C{startpos}."""
+    length = int(data[pos+1:startpos-1])
+    if length < 0:
+        raise ValueError("Corrupted data")
+    return length
+
+
 def loads_bytes(bytestring, pos, as_is=False):
     startpos = bytestring.index(b":", pos)+1
-    endpos = startpos+int(bytestring[pos+1:startpos-1])
+    endpos = startpos+_get_length(bytestring, pos, startpos)
     return bytestring[startpos:endpos], endpos
 
 
 def loads_unicode(bytestring, pos, as_is=False):
     startpos = bytestring.index(b":", pos)+1
-    endpos = startpos+int(bytestring[pos+1:startpos-1])
+    endpos = startpos+_get_length(bytestring, pos, startpos)
     return bytestring[startpos:endpos].decode("utf-8"), endpos
 
 
@@ -178,6 +357,97 @@ def loads_none(str, pos, as_is=False):
     return None, pos+1
 
 
+def _find_in_buffer(buffer, delimiter, pos):
+    """Like C{bytes.index}, which C{mmap} objects don't have."""
+    index = buffer.find(delimiter, pos)
+    if index == -1:
+        raise ValueError("Corrupted data")
+    return index
+
+
+def loads_buffer_bool(buffer, pos, as_is=False):
+    return bool(int(buffer[pos+1:pos+2])), pos+2
+
+
+def loads_buffer_int(buffer, pos, as_is=False):
+    endpos = _find_in_buffer(buffer, b";", pos)
+    return int(buffer[pos+1:endpos]), endpos+1
+
+
+def loads_buffer_float(buffer, pos, as_is=False):
+    endpos = _find_in_buffer(buffer, b";", pos)
+    return float(buffer[pos+1:endpos]), endpos+1
+
+
+def loads_buffer_bytes(buffer, pos, as_is=False):
+    startpos = _find_in_buffer(buffer, b":", pos)+1
+    endpos = startpos+_get_length(buffer, pos, startpos)
+    return bytes(buffer[startpos:endpos]), endpos
+
+
+def loads_buffer_unicode(buffer, pos, as_is=False):
+    startpos = _find_in_buffer(buffer, b":", pos)+1
+    endpos = startpos+_get_length(buffer, pos, startpos)
+    return buffer[startpos:endpos].decode("utf-8"), endpos
+
+
+def loads_buffer_list(buffer, pos, _lt=buffer_loads_table, as_is=False):
+    pos += 1
+    res = []
+    append = res.append
+    while buffer[pos] != _SEMICOLON:
+        obj, pos = _lt[buffer[pos]](buffer, pos, as_is=as_is)
+        append(obj)
+    return res, pos+1
+
+
+def loads_buffer_tuple(buffer, pos, as_is=False):
+    res, pos = loads_buffer_list(buffer, pos, as_is=as_is)
+    return tuple(res), pos
+
+
+def loads_buffer_dict(buffer, pos, _lt=buffer_loads_table, as_is=False):
+    pos += 1
+    res = {}
+    while buffer[pos] != _SEMICOLON:
+        key, pos = _lt[buffer[pos]](buffer, pos, as_is=as_is)
+        val, pos = _lt[buffer[pos]](buffer, pos, as_is=as_is)
+        if not as_is and isinstance(key, bytes):
+            key = key.decode("ascii")
+        res[key] = val
+    return res, pos+1
+
+
+def loads_buffer_none(buffer, pos, as_is=False):
+    return None, pos+1
+
+
+def skip_bool(bytestring, pos):
+    return pos+2
+
+
+def skip_number(bytestring, pos):
+    return bytestring.index(b";", pos)+1
+
+
+def skip_string(bytestring, pos):
+    startpos = bytestring.index(b":", pos)+1
+    return startpos+_get_length(bytestring, pos, startpos)
+
+
+def skip_sequence(bytestring, pos, _st=skip_table):
+    # Lists, tuples and dicts are all terminated by a semicolon, and dict
+    # items are just a sequence of keys and values.
+    pos += 1
+    while bytestring[pos:pos+1] != b";":
+        pos = _st[bytestring[pos:pos+1]](bytestring, pos)
+    return pos+1
+
+
+def skip_none(bytestring, pos):
+    return pos+1
+
+
 dumps_table.update({
     bool: dumps_bool,
     int: dumps_int,
@@ -203,6 +473,40 @@ loads_table.update({
 })
 
 
+skip_table.update({
+    b"b": skip_bool,
+    b"i": skip_number,
+    b"f": skip_number,
+    b"l": skip_sequence,
+    b"t": skip_sequence,
+    b"d": skip_sequence,
+    b"n": skip_none,
+    b"s": skip_string,
+    b"u": skip_string,
+})
+
+
+if _PY3:
+    _SEMICOLON = ord(";")
+
+    buffer_loads_table.update({
+        ord("b"): loads_buffer_bool,
+        ord("i"): loads_buffer_int,
+        ord("f"): loads_buffer_float,
+        ord("l"): loads_buffer_list,
+        ord("t"): loads_buffer_tuple,
+        ord("d"): loads_buffer_dict,
+        ord("n"): loads_buffer_none,
+        ord("s"): loads_buffer_bytes,
+        ord("u"): loads_buffer_unicode,
+    })
+else:
+    # Python 2.x: Indexing buffers returns characters rather than codes,
+    # so just decode a copy of the data with the regular loaders.
+    def loads_buffer(buffer, as_is=False):  # noqa
+        return loads(buffer[:], as_is=as_is)
+
+
 if bytes is str:
     # Python 2.x: We need to map internal unicode strings to UTF-8
     # encoded strings, and longs to ints.
@@ -46,7 +46,7 @@ class PyCurlError(FetchError):
 
 def fetch(url, post=False, data="", headers={}, cainfo=None, curl=None,
           connect_timeout=30, total_timeout=600, insecure=False, follow=True,
-          user_agent=None, proxy=None):
+          user_agent=None, proxy=None, dns_cache_timeout=0):
     """Retrieve a URL and return the content.
 
     @param url: The url to be fetched.
@@ -63,6 +63,9 @@ def fetch(url, post=False, data="", headers={}, cainfo=None, curl=None,
     @param follow: If True, follow HTTP redirects (default True).
     @param user_agent: The user-agent to set in the request.
     @param proxy: The proxy url to use for the request.
+    @param dns_cache_timeout: The number of seconds resolved host names are
+        cached by the C{curl} handle, only useful when it's reused for
+        several requests.
     """
     import pycurl
     if not isinstance(data, bytes):
@@ -109,7 +112,7 @@ def fetch(url, post=False, data="", headers={}, cainfo=None, curl=None,
     curl.setopt(pycurl.LOW_SPEED_TIME, total_timeout)
     curl.setopt(pycurl.NOSIGNAL, 1)
     curl.setopt(pycurl.WRITEFUNCTION, input.write)
-    curl.setopt(pycurl.DNS_CACHE_TIMEOUT, 0)
+    curl.setopt(pycurl.DNS_CACHE_TIMEOUT, dns_cache_timeout)
     curl.setopt(pycurl.ENCODING, b"gzip,deflate")
 
     try:
@@ -620,10 +620,18 @@ class BPickleBackend(Backend):
 
     def load(self, filepath):
         with open(filepath, "rb") as fd:
-            return self._bpickle.loads(fd.read())
+            return self._bpickle.load(fd)
 
     def save(self, filepath, map):
-        with open(filepath, "wb") as fd:
-            fd.write(self._bpickle.dumps(map))
+        # Stream the data to a temporary file, so that failing to encode it
+        # midway doesn't leave a truncated file behind.
+        temppath = filepath + ".new"
+        try:
+            with open(temppath, "wb") as fd:
+                self._bpickle.dump(map, fd)
+        except Exception:
+            os.remove(temppath)
+            raise
+        os.rename(temppath, filepath)
 
 # vim:ts=4:sw=4:et
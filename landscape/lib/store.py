@@ -14,6 +14,10 @@ def with_cursor(method):
     until the cursor was closed.  With this in mind, instead of using
     the autocommit mode, we explicitly terminate transactions and enforce
     cursor closing with this decorator.
+
+    Stores can group several calls in a single transaction by setting their
+    C{_defer_commit} attribute, in which case they're responsible for
+    committing it.
     """
 
     def inner(self, *args, **kwargs):
@@ -31,9 +35,13 @@ def with_cursor(method):
                 result = method(self, cursor, *args, **kwargs)
             finally:
                 cursor.close()
-            self._db.commit()
+            if not getattr(self, "_defer_commit", False):
+                self._db.commit()
         except BaseException:
-            self._db.rollback()
+            # A failed statement doesn't affect the rest of a deferred
+            # transaction, so there's nothing to roll back in that case.
+            if not getattr(self, "_defer_commit", False):
+                self._db.rollback()
             raise
         return result
     return inner
@@ -0,0 +1,66 @@
+import unittest
+
+from landscape.lib.backoff import Backoff
+
+
+class FakeRandom(object):
+    """Pick the given fraction of the range, and record the ranges."""
+
+    def __init__(self, fraction):
+        self.fraction = fraction
+        self.ranges = []
+
+    def uniform(self, low, high):
+        self.ranges.append((low, high))
+        return low + (high - low) * self.fraction
+
+
+class BackoffTest(unittest.TestCase):
+
+    def test_no_failures(self):
+        """The normal interval is used when no attempt failed."""
+        backoff = Backoff(3600)
+        self.assertEqual(60, backoff.get_interval(60))
+        self.assertEqual({"failures": 0, "delay": None}, backoff.get_state())
+
+    def test_failed(self):
+        """
+        Each delay is picked between the normal interval and three times the
+        previous delay.
+        """
+        random = FakeRandom(1)
+        backoff = Backoff(3600, random=random)
+        self.assertEqual(180, backoff.failed(60))
+        self.assertEqual(540, backoff.failed(60))
+        self.assertEqual([(60, 180), (60, 540)], random.ranges)
+        self.assertEqual(540, backoff.get_interval(60))
+        self.assertEqual({"failures": 2, "delay": 540}, backoff.get_state())
+
+    def test_jitter(self):
+        """The delays are picked at random."""
+        backoff = Backoff(3600, random=FakeRandom(0.5))
+        self.assertEqual(120, backoff.failed(60))
+        self.assertEqual(210, backoff.failed(60))
+
+    def test_max_delay(self):
+        """The delays don't exceed the maximum delay."""
+        backoff = Backoff(1000, random=FakeRandom(1))
+        for i in range(10):
+            backoff.failed(60)
+        self.assertEqual(1000, backoff.delay)
+
+    def test_max_delay_below_interval(self):
+        """The delays are never shorter than the normal interval."""
+        backoff = Backoff(1000, random=FakeRandom(0))
+        self.assertEqual(3600, backoff.failed(3600))
+        self.assertEqual(3600, backoff.get_interval(60))
+        self.assertEqual(7200, backoff.get_interval(7200))
+
+    def test_succeeded(self):
+        """A successful attempt resets the backoff."""
+        backoff = Backoff(3600, random=FakeRandom(1))
+        backoff.failed(60)
+        backoff.succeeded()
+        self.assertEqual(60, backoff.get_interval(60))
+        self.assertEqual({"failures": 0, "delay": None}, backoff.get_state())
+        self.assertEqual(180, backoff.failed(60))
@@ -1,3 +1,5 @@
+import io
+import tempfile
 import unittest
 
 from landscape.lib import bpickle
@@ -61,3 +63,191 @@ class BPickleTest(unittest.TestCase):
     def test_long(self):
         long = 99999999999999999999999999999
         self.assertEqual(bpickle.loads(bpickle.dumps(long)), long)
+
+    def test_loads_keys(self):
+        """Only the requested top-level keys of a dict are loaded."""
+        data = bpickle.dumps({"type": "test", "api": b"3.2",
+                              "data": [1, 2.5, (None, True), {"a": b"b"}],
+                              "name": u"\xc0", "z": 1})
+        self.assertEqual({"type": "test", "api": b"3.2"},
+                         bpickle.loads_keys(data, ("type", "api")))
+        self.assertEqual({"name": u"\xc0", "z": 1},
+                         bpickle.loads_keys(data, ("name", "z", "missing")))
+
+    def test_loads_keys_bytes_keys(self):
+        """
+        Bytes keys are reinterpreted as str, unless C{as_is} is passed.
+        """
+        data = bpickle.dumps({b"type": b"test"})
+        self.assertEqual({"type": b"test"},
+                         bpickle.loads_keys(data, ("type",)))
+        self.assertEqual({}, bpickle.loads_keys(data, ("type",), as_is=True))
+
+    def test_loads_keys_not_a_dict(self):
+        """Only dicts can be loaded by key."""
+        self.assertRaises(ValueError, bpickle.loads_keys,
+                          bpickle.dumps([1]), ("type",))
+
+    def test_loads_keys_corrupted_data(self):
+        """Truncated data is detected even if it's skipped over."""
+        data = bpickle.dumps({"type": "test", "z": [1, 2, 3]})
+        self.assertRaises(ValueError, bpickle.loads_keys, data[:-4],
+                          ("type",))
+
+    def test_loads_buffer_truncated_data(self):
+        """
+        Like L{bpickle.loads}, L{bpickle.loads_buffer} raises a
+        C{ValueError} for truncated data.
+        """
+        for data in [b"lf1.0", b"i1", b"f1.0", b"s3", b"u3", b"di1;s1"]:
+            self.assertRaises(ValueError, bpickle.loads, data)
+            self.assertRaises(ValueError, bpickle.loads_buffer, data)
+            self.assertRaises(ValueError, bpickle.loads_buffer,
+                              bytearray(data))
+
+    def test_dump(self):
+        """
+        L{bpickle.dump} writes to a file the same data L{bpickle.dumps}
+        returns.
+        """
+        obj = {"type": "test", "data": [b"foo", (1, 2.5, None), {"a": True}],
+               "name": u"\xc0"}
+        fileobj = io.BytesIO()
+        bpickle.dump(obj, fileobj)
+        self.assertEqual(bpickle.dumps(obj), fileobj.getvalue())
+        self.assertEqual(obj, bpickle.loads(fileobj.getvalue()))
+
+    def test_dump_unsupported_type(self):
+        """Unsupported types result in a C{ValueError}."""
+        self.assertRaises(ValueError, bpickle.dump, [object()], io.BytesIO())
+        self.assertRaises(ValueError, bpickle.dumps, {"a": [object()]})
+
+    def test_loads_buffer(self):
+        """
+        L{bpickle.loads_buffer} decodes buffers to the same objects
+        L{bpickle.loads} returns.
+        """
+        obj = {"type": "test", "data": [b"foo", (1, -2.5, None), {"a": True}],
+               "name": u"\xc0", "legacy": {b"key": False}}
+        data = bpickle.dumps(obj)
+        for buffer in [data, bytearray(data), memoryview(data),
+                       memoryview(data)[:]]:
+            result = bpickle.loads_buffer(buffer)
+            self.assertEqual(bpickle.loads(data), result)
+            self.assertIs(bytes, type(result["data"][0]))
+        self.assertEqual(bpickle.loads(data, as_is=True),
+                         bpickle.loads_buffer(data, as_is=True))
+
+    def test_loads_buffer_partial_memoryview(self):
+        """A view on part of a buffer is decoded from a copy."""
+        data = b"padding" + bpickle.dumps([1, b"foo"])
+        self.assertEqual([1, b"foo"],
+                         bpickle.loads_buffer(memoryview(data)[7:]))
+
+    def test_loads_buffer_errors(self):
+        """Empty and corrupted data result in a C{ValueError}."""
+        self.assertRaises(ValueError, bpickle.loads_buffer, b"")
+        self.assertRaises(ValueError, bpickle.loads_buffer, b"x")
+        self.assertRaises(ValueError, bpickle.loads_buffer, b"l")
+
+    def test_load(self):
+        """L{bpickle.load} decodes data from a memory-mapped file."""
+        obj = {"type": "test", "data": [b"foo", 1, None], "name": u"\xc0"}
+        with tempfile.TemporaryFile() as fileobj:
+            bpickle.dump(obj, fileobj)
+            fileobj.flush()
+            self.assertEqual(obj, bpickle.load(fileobj))
+
+    def test_load_file_like(self):
+        """
+        L{bpickle.load} reads the data from objects that aren't real files.
+        """
+        self.assertEqual([1], bpickle.load(io.BytesIO(bpickle.dumps([1]))))
+
+    def test_load_empty_file(self):
+        """Loading an empty file results in a C{ValueError}."""
+        with tempfile.TemporaryFile() as fileobj:
+            self.assertRaises(ValueError, bpickle.load, fileobj)
+
+
+class PurePythonBPickleTest(BPickleTest):
+    """Run the L{BPickleTest} tests without the compiled speedups."""
+
+    def setUp(self):
+        super(PurePythonBPickleTest, self).setUp()
+        self.speedups = bpickle.speedups
+        bpickle.speedups = None
+
+    def tearDown(self):
+        bpickle.speedups = self.speedups
+        super(PurePythonBPickleTest, self).tearDown()
+
+
+class SpeedupsTest(unittest.TestCase):
+    """The compiled speedups produce the same output as the Python code."""
+
+    def setUp(self):
+        super(SpeedupsTest, self).setUp()
+        if bpickle.speedups is None:
+            self.skipTest("The compiled bpickle speedups are not built")
+
+    def dumps(self, obj):
+        speedups = bpickle.speedups
+        bpickle.speedups = None
+        try:
+            return bpickle.dumps(obj)
+        finally:
+            bpickle.speedups = speedups
+
+    def test_same_output(self):
+        obj = {"type": "add-packages", "api": b"3.2",
+               "packages": [{"name": u"f\xf6\xf6", "size": 2 ** 70,
+                             "ratio": 0.1 + 0.2, "flags": (True, False),
+                             "missing": None, "data": b"\x00\xff" * 10}]}
+        data = self.dumps(obj)
+        self.assertEqual(data, bpickle.speedups.dumps(obj,
+                                                      bpickle.dumps_table))
+        self.assertEqual(obj, bpickle.speedups.loads(data))
+        self.assertEqual(obj, bpickle.speedups.loads(bytearray(data)))
+
+    def test_registered_types(self):
+        """
+        Objects of types registered in the conversion map are converted by
+        the registered function.
+        """
+
+        class Raw(object):
+            pass
+
+        bpickle.dumps_table[Raw] = lambda obj: b"n"
+        self.addCleanup(bpickle.dumps_table.pop, Raw)
+        self.assertEqual(b"l" + b"n;", bpickle.dumps([Raw()]))
+
+    def test_unsupported_type(self):
+        self.assertRaises(ValueError, bpickle.dumps, {"a": [object()]})
+
+    def test_corrupted_data(self):
+        """The same errors are raised for corrupted data."""
+        for data in [b"x", b"l", b"li1;", b"dn", b"s3", b"i1", b"bx",
+                     b"s-1:", b"u-99999999999999999999:"]:
+            speedups = bpickle.speedups
+            bpickle.speedups = None
+            try:
+                error = self.assertRaises(ValueError, bpickle.loads, data)
+            finally:
+                bpickle.speedups = speedups
+            speedups_error = self.assertRaises(ValueError,
+                                               bpickle.speedups.loads, data)
+            self.assertEqual(str(error), str(speedups_error))
+
+    def test_truncated_string(self):
+        """Like slicing, string lengths past the end are tolerated."""
+        self.assertEqual(b"ab", bpickle.speedups.loads(b"s5:ab"))
+        self.assertEqual(b"ab", bpickle.speedups.loads(
+            b"s99999999999999999999:ab"))
+        speedups = bpickle.speedups
+        bpickle.speedups = None
+        try:
+            self.assertEqual(b"ab", bpickle.loads(b"s99999999999999999999:ab"))
+        finally:
+            bpickle.speedups = speedups
@@ -128,6 +128,11 @@ class FetchTest(testing.FSTestCase, testing.TwistedTestCase,
                           pycurl.DNS_CACHE_TIMEOUT: 0,
                           pycurl.ENCODING: b"gzip,deflate"})
 
+    def test_dns_cache_timeout(self):
+        curl = CurlStub(b"result")
+        fetch("http://example.com", curl=curl, dns_cache_timeout=300)
+        self.assertEqual(300, curl.options[pycurl.DNS_CACHE_TIMEOUT])
+
     def test_post_data(self):
         curl = CurlStub(b"result")
         result = fetch("http://example.com", post=True, data="data", curl=curl)
@@ -5,7 +5,7 @@ import unittest
 from landscape.lib import testing
 from landscape.lib.persist import (
     path_string_to_tuple, path_tuple_to_string, Persist, RootedPersist,
-    PickleBackend, PersistError, PersistReadOnlyError)
+    PickleBackend, BPickleBackend, PersistError, PersistReadOnlyError)
 
 
 class PersistHelpersTest(unittest.TestCase):
@@ -448,6 +448,22 @@ class PicklePersistTest(GeneralPersistTest, SaveLoadPersistTest):
         return Persist(PickleBackend(), *args, **kwargs)
 
 
+class BPickleBackendTest(testing.FSTestCase, unittest.TestCase):
+
+    def test_save_failure_keeps_file(self):
+        """
+        If the data can't be encoded, the file saved previously is left
+        untouched, and no temporary file is left behind.
+        """
+        backend = BPickleBackend()
+        filename = self.makeFile()
+        backend.save(filename, {"a": 1})
+        self.assertRaises(ValueError, backend.save, filename,
+                          {"a": [1, object()]})
+        self.assertEqual({"a": 1}, backend.load(filename))
+        self.assertFalse(os.path.exists(filename + ".new"))
+
+
 class RootedPersistTest(GeneralPersistTest):
 
     def build_persist(self, *args, **kwargs):
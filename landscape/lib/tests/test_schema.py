@@ -2,7 +2,7 @@ import unittest
 
 from landscape.lib.schema import (
     InvalidError, Constant, Bool, Int, Float, Bytes, Unicode, List, KeyDict,
-    Dict, Tuple, Any)
+    Dict, Tuple, Any, compile_schema)
 
 from twisted.python.compat import long
 
@@ -201,3 +201,64 @@ class BasicTypesTest(unittest.TestCase):
 
     def test_dict_wrong_type(self):
         self.assertRaises(InvalidError, Dict(Int(), Int()).coerce, 32)
+
+
+class CompiledSchemaTest(unittest.TestCase):
+    """
+    Compiled schemas return the same results and raise the same errors as
+    the C{coerce} method of the schema they were compiled from.
+    """
+
+    def assertSameCoercion(self, schema, *values):
+        compiled = compile_schema(schema)
+        for value in values:
+            try:
+                expected = schema.coerce(value)
+            except InvalidError as e:
+                with self.assertRaises(InvalidError) as context:
+                    compiled(value)
+                self.assertEqual(str(e), str(context.exception))
+            else:
+                result = compiled(value)
+                self.assertEqual(expected, result)
+                self.assertIs(type(expected), type(result))
+
+    def test_basic_types(self):
+        self.assertSameCoercion(Constant("foo"), "foo", "bar", None)
+        self.assertSameCoercion(Bool(), True, False, 1, None)
+        self.assertSameCoercion(Int(), 1, long(1), True, 1.5, "1")
+        self.assertSameCoercion(Float(), 1, 1.5, "1.5", None)
+        self.assertSameCoercion(Bytes(), b"foo", u"foo", 1)
+        self.assertSameCoercion(Unicode(), u"foo", b"foo", b"\xff", 1)
+        self.assertSameCoercion(Unicode(encoding="latin-1"), b"\xff")
+        self.assertSameCoercion(Any(Constant(None), Int()), None, 1, "1")
+
+    def test_containers(self):
+        self.assertSameCoercion(List(Unicode()), [u"a", b"b"], [u"a", 1],
+                                (u"a",), [])
+        self.assertSameCoercion(Tuple(Int(), Unicode()), (1, b"a"), (1,),
+                                (1, 2), [1, u"a"])
+        self.assertSameCoercion(Dict(Int(), Unicode()), {1: b"a"}, {1: 1},
+                                {"1": u"a"}, [])
+        self.assertSameCoercion(Dict(DummySchema(), DummySchema()), {1: 2})
+
+    def test_list_of_none(self):
+        """
+        A C{List(None)} schema, only ever used for empty lists, can be
+        compiled.
+        """
+        self.assertSameCoercion(List(None), [], ())
+
+    def test_key_dict(self):
+        schema = KeyDict({"foo": Int(), "bar": List(Unicode())},
+                         optional=["bar"])
+        self.assertSameCoercion(
+            schema, {"foo": 1}, {"foo": 1, "bar": [b"a"]}, {"bar": []},
+            {"foo": 1, "baz": 2}, {"foo": 1, "bar": [1]}, {}, [])
+
+    def test_compile_without_compile_method(self):
+        """
+        Schemas without a C{compile} method are used through their C{coerce}
+        method.
+        """
+        self.assertEqual("hello!", compile_schema(DummySchema())("hello"))
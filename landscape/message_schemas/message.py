@@ -15,10 +15,14 @@ class Message(KeyDict):
     @param optional: An optional list of keys that should be optional.
     @param api: The server API version needed to send this message,
         if C{None} any version is fine.
+
+    The schema is compiled the first time a message is coerced, so it
+    must not be changed afterwards.
     """
     def __init__(self, type, schema, optional=None, api=None):
         self.type = type
         self.api = api
+        self._compiled_coerce = None
         schema["timestamp"] = Float()
         schema["api"] = Any(Bytes(), Constant(None))
         schema["type"] = Constant(type)
@@ -29,11 +33,21 @@ class Message(KeyDict):
         super(Message, self).__init__(schema, optional=optional)
 
     def coerce(self, value):
-        for k in list(value.keys()):
-            if k not in self.schema:
-                # We don't know about this field, just discard it. This
-                # is useful when a client that introduced some new field
-                # in a message talks to an older server, that don't understand
-                # the new field yet.
-                value.pop(k)
-        return super(Message, self).coerce(value)
+        if self._compiled_coerce is None:
+            self._compiled_coerce = self.compile()
+        return self._compiled_coerce(value)
+
+    def compile(self):
+        schema = self.schema
+        keydict_coerce = super(Message, self).compile()
+
+        def coerce(value):
+            for k in list(value.keys()):
+                if k not in schema:
+                    # We don't know about this field, just discard it. This
+                    # is useful when a client that introduced some new field
+                    # in a message talks to an older server, that don't
+                    # understand the new field yet.
+                    value.pop(k)
+            return keydict_coerce(value)
+        return coerce
@@ -1,6 +1,6 @@
 import unittest
 
-from landscape.lib.schema import Int
+from landscape.lib.schema import InvalidError, Int
 from landscape.message_schemas.message import Message
 
 
@@ -51,3 +51,23 @@ class MessageTest(unittest.TestCase):
         schema = Message("foo", {})
         self.assertEqual({"type": "foo"},
                          schema.coerce({"type": "foo", "crap": 123}))
+
+    def test_compiled_once(self):
+        """
+        The L{Message} schema is compiled the first time it's used, and the
+        compiled function is reused afterwards.
+        """
+        schema = Message("foo", {"data": Int()})
+        self.assertIsNone(schema._compiled_coerce)
+        schema.coerce({"type": "foo", "data": 3})
+        compiled = schema._compiled_coerce
+        self.assertIsNotNone(compiled)
+        schema.coerce({"type": "foo", "data": 4})
+        self.assertIs(compiled, schema._compiled_coerce)
+
+    def test_invalid_error(self):
+        """Invalid messages are reported with the usual L{InvalidError}."""
+        schema = Message("foo", {"data": Int()})
+        with self.assertRaises(InvalidError) as context:
+            schema.coerce({"type": "foo", "data": "3"})
+        self.assertIn("'3' isn't an int or long", str(context.exception))
@@ -45,12 +45,14 @@ import setup_lib, setup_sysinfo, setup_client
 PACKAGES = []
 MODULES = []
 SCRIPTS = []
+EXT_MODULES = []
 DEB_REQUIRES = []
 REQUIRES = []
 for sub in (setup_lib, setup_sysinfo, setup_client):
     PACKAGES += sub.PACKAGES
     MODULES += sub.MODULES
     SCRIPTS += sub.SCRIPTS
+    EXT_MODULES += sub.EXT_MODULES
     DEB_REQUIRES += sub.DEB_REQUIRES
     REQUIRES += sub.REQUIRES
     
@@ -62,4 +64,5 @@ if __name__ == "__main__":
         packages=PACKAGES,
         modules=MODULES,
         scripts=SCRIPTS,
+        ext_modules=EXT_MODULES,
         )
@@ -40,6 +40,7 @@ if sys.version_info[0] > 2:
         "scripts/landscape-package-reporter",
         "scripts/landscape-release-upgrader",
         ]
+EXT_MODULES = []
 
 # Dependencies
 
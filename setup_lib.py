@@ -1,5 +1,9 @@
 #!/usr/bin/python
 
+import sys
+
+from distutils.core import Extension
+
 
 NAME = "landscape-lib",
 DESCRIPTION = "Common code used by Landscape applications"
@@ -14,6 +18,14 @@ MODULES = [
         "landscape.constants",
         ]
 SCRIPTS = []
+EXT_MODULES = []
+if sys.version_info[0] > 2:
+    # Optional speedups for landscape.lib.bpickle, which falls back to its
+    # pure Python implementation if they can't be built.
+    EXT_MODULES += [
+        Extension("landscape.lib._bpickle", ["landscape/lib/_bpickle.c"],
+                  optional=True),
+        ]
 
 # Dependencies
 
@@ -37,4 +49,5 @@ if __name__ == "__main__":
         packages=PACKAGES,
         modules=MODULES,
         scripts=SCRIPTS,
+        ext_modules=EXT_MODULES,
         )
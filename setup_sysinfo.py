@@ -16,6 +16,7 @@ if sys.version_info[0] > 2:
     SCRIPTS += [
         "scripts/landscape-sysinfo",
         ]
+EXT_MODULES = []
 
 # Dependencies
 